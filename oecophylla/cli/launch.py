@@ -3,11 +3,16 @@ import yaml
 import os
 import glob
 from os.path import join
-from oecophylla.util.parse import (illumina_filenames_to_df,
+from oecophylla.util.parse import (scan_input_dirs,
+                                   index_input_files,
                                    extract_sample_reads,
-                                   extract_sample_paths,
                                    read_sample_sheet,
                                    extract_samples_from_sample_sheet)
+from oecophylla.util.manifest import (MANIFEST_FN,
+                                      read_manifest,
+                                      write_manifest,
+                                      get_sample_table,
+                                      set_sample_table)
 import subprocess
 
 """
@@ -38,13 +43,32 @@ def run():
     pass
 
 
-#TODO will be used, once we add multiple directory support
 def _arg_split(ctx, param, value):
     # split columns by ',' and remove whitespace
-    _files = [c.strip() for c in value.split(',')]
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = [value]
+    _files = [c.strip() for v in value for c in v.split(',') if c.strip()]
     return _files
 
 
+def _expand_input_dirs(patterns):
+    # expand glob patterns into directories, keeping the given order, and
+    # drop directories reached more than once, e.g. through symbolic links
+    input_dirs = {}
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(d for d in glob.glob(pattern) if os.path.isdir(d))
+            if not matches:
+                raise IOError('No input directories match %s' % pattern)
+        else:
+            matches = [pattern]
+        for d in matches:
+            input_dirs.setdefault(os.path.realpath(d), os.path.abspath(d))
+    return list(input_dirs.values())
+
+
 def _create_dir(_path):
     if not os.path.exists(_path):
         os.makedirs(_path)
@@ -135,7 +159,7 @@ def _setup_test():
     d = _oeco_dir()
 
     # set inputs
-    input_dir = join(d, 'test_data/test_reads')
+    input_dir = [join(d, 'test_data/test_reads')]
     sample_sheet = join(d, 'test_data/test_config/example_sample_sheet.txt')
     # set params
     params = join(d, 'test_data/test_config/test_params.yml')
@@ -156,10 +180,11 @@ def _setup_test():
 
 @run.command()
 @click.argument('targets', nargs=-1)
-#TODO add an option to process multiple directories
 @click.option('--input-dir', '-i', required=False, type=click.STRING,
-              help='Input directory with all of the samples.')
-#TODO add an option to process multiple directories
+              multiple=True, callback=_arg_split,
+              help='Input directory with all of the samples.  Can be given '
+                   'several times, as a comma separated list, or as glob '
+                   'patterns; the directories are scanned in parallel.')
 @click.option('--sample-sheet', '-s', required=False, type=click.STRING,
               default=None,
               help='Sample sheets used to demultiplex the Illumina run.')
@@ -202,8 +227,6 @@ def workflow(targets, input_dir, sample_sheet, params, envs,
              cluster_config, cluster_logs, local_scratch, workflow_type,
              profile, output_dir, snakemake_args, local_cores, jobs,
              force, just_config, test):
-    import snakemake
-
     # SNAKEMAKE
     snakefile = '%s/../../Snakefile' % os.path.abspath(os.path.dirname(__file__))
 
@@ -216,12 +239,13 @@ def workflow(targets, input_dir, sample_sheet, params, envs,
 
     # Check to see if config.yaml exists in output dir. If it does, warn
     # and continue with execution
-    if os.path.exists(join(output_dir, 'config.yaml')):
+    if os.path.exists(join(output_dir, 'config.yaml')) and not force:
         config_fp = '%s/%s' % (output_dir, 'config.yaml')
     # Otherwise, make a config file and continue with execution
     elif (os.path.exists(params) and
           os.path.exists(envs) and
-          os.path.exists(input_dir)):
+          input_dir and
+          all(os.path.exists(d) or glob.has_magic(d) for d in input_dir)):
 
         # OUTPUT
         # create output directory, if does not exist
@@ -232,21 +256,35 @@ def workflow(targets, input_dir, sample_sheet, params, envs,
         # reverse reads will be automatically identified using regex.
         # Input dir will be converted to abspath.
 
-        input_dir = os.path.abspath(input_dir)
-
-        if sample_sheet:
-            _sheet = read_sample_sheet(sample_sheet)
-            sample_dict = extract_samples_from_sample_sheet(_sheet, input_dir)
-        else:
-            sample_dict = extract_sample_paths(input_dir)
+        input_dir = _expand_input_dirs(input_dir)
+
+        # The input manifest records the directory listings, so that the
+        # sample table is only rebuilt if an input directory changed.
+        manifest_fp = join(output_dir, MANIFEST_FN)
+        manifest = read_manifest(manifest_fp)
+        input_dir, listings = scan_input_dirs(input_dir, manifest)
+
+        # file names are only parsed if the cached table is out of date
+        sample_dict = get_sample_table(manifest, input_dir, sample_sheet)
+        if sample_dict is None:
+            files_df = index_input_files(input_dir, listings, manifest)
+            if sample_sheet:
+                _sheet = read_sample_sheet(sample_sheet)
+                sample_dict = extract_samples_from_sample_sheet(
+                    _sheet, None, files_df=files_df, file_col='Path')
+            else:
+                sample_dict = extract_sample_reads(files_df, None,
+                                                   file_col='Path')
+            set_sample_table(manifest, input_dir, sample_dict, sample_sheet)
+        write_manifest(manifest_fp, manifest)
 
         # PARAMS
         with open(params, 'r') as f:
-            params_dict = yaml.load(f)
+            params_dict = yaml.safe_load(f)
 
         # ENVS
         with open(envs, 'r') as f:
-            envs_dict = yaml.load(f)
+            envs_dict = yaml.safe_load(f)
 
         # CONFIG
         # merge PARAMS, SAMPLE_DICT, ENVS
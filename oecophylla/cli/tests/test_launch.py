@@ -1,8 +1,9 @@
 import os
-from unittest import TestCase, main
+from unittest import TestCase, main, mock
+from pathlib import Path
 from click.testing import CliRunner
 import shutil
-from oecophylla.cli.launch import workflow
+from oecophylla.cli.launch import workflow, _arg_split, _expand_input_dirs
 import yaml
 import subprocess
 
@@ -43,6 +44,77 @@ class ProcessingTests(TestCase):
         # make sure that the tests complete
         self.assertEqual(proc.returncode, 0)
 
+    def test_input_dirs(self):
+        self.assertListEqual(_arg_split(None, None, ('a, b', 'c')),
+                             ['a', 'b', 'c'])
+        self.assertListEqual(_arg_split(None, None, ()), [])
+
+        for run in ('run2', 'run1'):
+            os.mkdir(os.path.join(self.local_dir, run))
+        obs = _expand_input_dirs([os.path.join(self.local_dir, 'run*'),
+                                  os.path.join(self.local_dir, 'run1'),
+                                  self.curdir])
+        self.assertListEqual(obs, [os.path.join(self.local_dir, 'run1'),
+                                   os.path.join(self.local_dir, 'run2'),
+                                   self.curdir])
+        with self.assertRaises(IOError):
+            _expand_input_dirs([os.path.join(self.local_dir, 'none*')])
+
+        # a link to a directory already given is dropped
+        link = os.path.join(self.local_dir, 'link1')
+        os.symlink(os.path.join(self.local_dir, 'run1'), link)
+        obs = _expand_input_dirs([os.path.join(self.local_dir, 'run1'), link])
+        self.assertListEqual(obs, [os.path.join(self.local_dir, 'run1')])
+
+    def test_input_dirs_symlink(self):
+        # a run given a directory and a link to it
+        run1 = os.path.join(self.local_dir, 'run1')
+        os.mkdir(run1)
+        for r in ('R1', 'R2'):
+            Path(os.path.join(run1, 'S1_S1_L001_%s_001.fastq.gz' % r)).touch()
+        link = os.path.join(self.local_dir, 'link1')
+        os.symlink(run1, link)
+        _params = ['--input-dir', '%s,%s' % (run1, link),
+                   '--params', '%s/data/tool_params.yml' % self.curdir,
+                   '--envs', '%s/data/envs.yml' % self.curdir,
+                   '--local-scratch', self.local_dir,
+                   '--output-dir', self.output_dir,
+                   '--just-config']
+        for _ in range(2):
+            res = CliRunner().invoke(workflow, _params + ['--force'])
+            self.assertIsNone(res.exception)
+            with open(os.path.join(self.output_dir, 'config.yaml')) as f:
+                config = yaml.safe_load(f)
+            self.assertDictEqual(config['samples'], {'S1': {
+                'forward': ['%s/S1_S1_L001_R1_001.fastq.gz' % run1],
+                'reverse': ['%s/S1_S1_L001_R2_001.fastq.gz' % run1]}})
+
+    def test_input_dirs_cached(self):
+        run1 = os.path.join(self.local_dir, 'run1')
+        os.mkdir(run1)
+        for r in ('R1', 'R2'):
+            Path(os.path.join(run1, 'S1_S1_L001_%s_001.fastq.gz' % r)).touch()
+        # pretend the directory was last modified a minute ago
+        st = os.stat(run1)
+        os.utime(run1, ns=(st.st_atime_ns, st.st_mtime_ns - 60 * 10**9))
+        _params = ['--input-dir', run1,
+                   '--params', '%s/data/tool_params.yml' % self.curdir,
+                   '--envs', '%s/data/envs.yml' % self.curdir,
+                   '--local-scratch', self.local_dir,
+                   '--output-dir', self.output_dir,
+                   '--just-config', '--force']
+        res = CliRunner().invoke(workflow, _params)
+        self.assertIsNone(res.exception)
+
+        # the cached sample table is used without parsing file names
+        with mock.patch('oecophylla.cli.launch.index_input_files') as index:
+            res = CliRunner().invoke(workflow, _params)
+        self.assertIsNone(res.exception)
+        index.assert_not_called()
+        with open(os.path.join(self.output_dir, 'config.yaml')) as f:
+            config = yaml.safe_load(f)
+        self.assertListEqual(list(config['samples']), ['S1'])
+
     def test_slurm(self):
         # TODO
         pass
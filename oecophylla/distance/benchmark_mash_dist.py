@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Benchmark of mash distances across sample counts, as computed by mash_dist.
+
+Sketches random genomes, and times running mash dist once per pair of
+sketches (as mash_dist used to) against filling a new store of distances
+with mash_compare, whose outputs are checked to be identical. Also times
+adding a tenth more samples to the filled store. Needs mash on the PATH.
+"""
+import os
+import time
+import argparse
+import tempfile
+import subprocess
+from itertools import combinations
+
+import numpy as np
+
+from oecophylla.distance.mash import mash_compare, write_mash_dist
+from oecophylla.distance.store import update_store, read_store
+
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('-n', '--counts', type=str, default='10,50,100',
+                    help='comma separated numbers of samples [Default: '
+                         '10,50,100]')
+
+parser.add_argument('-l', '--length', type=int, default=100000,
+                    help='length of the random genomes [Default: 100000]')
+
+parser.add_argument('-t', '--threads', type=int, default=4,
+                    help='threads of mash dist [Default: 4]')
+
+parser.add_argument('--tile', type=int, default=0,
+                    help='sketches per tile [Default: 0, a single tile]')
+
+parser.add_argument('--max_pairwise', type=int, default=100,
+                    help='largest number of samples to also time pairwise '
+                         'runs for [Default: 100]')
+
+
+def sketch_genomes(count, length, out_dir, seed=0):
+    """ Sketches random genomes, which share half of their sequence. """
+    rng = np.random.RandomState(seed)
+    core = rng.choice(list('ACGT'), length // 2)
+    sketches = []
+    for i in range(count):
+        genome = np.concatenate([core, rng.choice(list('ACGT'),
+                                                  length - len(core))])
+        fasta = os.path.join(out_dir, 'genome_%d.fa' % i)
+        with open(fasta, 'w') as f:
+            f.write('>genome_%d\n%s\n' % (i, ''.join(genome)))
+        subprocess.run(['mash', 'sketch', '-o', fasta, fasta], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        sketches.append(fasta + '.msh')
+    return sketches
+
+
+def stored(sketches, store_fp, output_fp, temp_dir, threads, tile):
+    """ Updates a store with mash_compare, as mash_dist does. """
+    positions = update_store(
+        store_fp, sketches,
+        lambda old, new: mash_compare(old, new, temp_dir, threads=threads,
+                                      tile=tile))
+    names, values = read_store(store_fp, positions)
+    write_mash_dist(names, values, output_fp)
+
+
+def pairwise(sketches, output_fp):
+    """ Runs mash dist once per pair of sketches. """
+    with open(output_fp, 'w') as f:
+        for i, j in combinations(sketches, 2):
+            subprocess.run(['mash', 'dist', i, j], stdout=f, check=True)
+
+
+def main():
+    args = parser.parse_args()
+    print('samples\tpairwise_s\tstore_s\tstore_add_s')
+    for count in [int(x) for x in args.counts.split(',')]:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            added = max(count // 10, 1)
+            sketches = sketch_genomes(count + added, args.length, temp_dir)
+            store = os.path.join(temp_dir, 'mash.store.h5')
+            out_store = os.path.join(temp_dir, 'store.txt')
+
+            start = time.time()
+            stored(sketches[:count], store, out_store, temp_dir,
+                   args.threads, args.tile)
+            elapsed_store = time.time() - start
+
+            elapsed_pairwise = float('nan')
+            if count <= args.max_pairwise:
+                out_pairwise = os.path.join(temp_dir, 'pairwise.txt')
+                start = time.time()
+                pairwise(sketches[:count], out_pairwise)
+                elapsed_pairwise = time.time() - start
+                with open(out_store) as f_all, open(out_pairwise) as f_pair:
+                    if f_all.read() != f_pair.read():
+                        raise ValueError('Outputs differ for %d samples'
+                                         % count)
+
+            start = time.time()
+            stored(sketches, store, out_store, temp_dir, args.threads,
+                   args.tile)
+            elapsed_add = time.time() - start
+            print('%d\t%.2f\t%.2f\t%.2f' % (count, elapsed_pairwise,
+                                             elapsed_store, elapsed_add))
+
+if __name__ == "__main__":
+    main()
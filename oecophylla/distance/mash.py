@@ -0,0 +1,240 @@
+import os
+import csv
+import subprocess
+
+import h5py
+import numpy as np
+import pandas as pd
+
+
+# columns of mash dist output
+MASH_COLUMNS = ['reference', 'query', 'distance', 'p', 'shared']
+
+
+def _run(cmd, env=''):
+    """Runs a command line with bash, after setting up its environment."""
+    if env:
+        cmd = 'set +u; %s; set -u\n%s' % (env, cmd)
+    subprocess.run(cmd, shell=True, executable='/bin/bash', check=True)
+
+
+def tiles(n, size=0):
+    """Splits n items into consecutive tiles.
+
+    Parameters
+    ----------
+    n : int
+        number of items
+    size : int (optional)
+        maximum number of items per tile, 0 for a single tile
+
+    Returns
+    -------
+    list of (int, int)
+        start and stop of each tile
+    """
+    if not size or size >= n:
+        return [(0, n)]
+    return [(i, min(i + size, n)) for i in range(0, n, size)]
+
+
+def _paste(sketches, prefix, env=''):
+    """Pastes sketches into one sketch."""
+    _run('mash paste %s %s' % (prefix, ' '.join(sketches)), env)
+    return prefix + '.msh'
+
+
+def read_mash_dist(file):
+    """Reads mash dist output, keeping values as written."""
+    return pd.read_csv(file, sep='\t', header=None, names=MASH_COLUMNS,
+                       dtype=str, quoting=csv.QUOTE_NONE,
+                       keep_default_na=False)
+
+
+def _dist_block(reference, query, temp_dir, threads=1, env=''):
+    """Runs mash dist between two (pasted) sketches.
+
+    Returns the names of the references and queries, and the distances,
+    p-values, shared and total hashes of every query (rows) to every
+    reference (columns).
+    """
+    file = os.path.join(temp_dir, 'dist.txt')
+    _run('mash dist -p %d %s %s > %s' % (threads, reference, query, file),
+         env)
+    result = read_mash_dist(file)
+    os.remove(file)
+
+    # mash reports every reference for each query, both in sketch order
+    refs = pd.unique(result['reference'])
+    queries = pd.unique(result['query'])
+    r = pd.Categorical(result['reference'], categories=refs).codes
+    q = pd.Categorical(result['query'], categories=queries).codes
+    shared = result['shared'].str.split('/', expand=True).astype(np.int64)
+    values = {'distance': result['distance'].values.astype(np.float64),
+              'p': result['p'].values.astype(np.float64),
+              'shared': shared[0].values,
+              'hashes': shared[1].values}
+    blocks = {}
+    for field, value in values.items():
+        blocks[field] = np.zeros((len(queries), len(refs)), dtype=value.dtype)
+        blocks[field][q, r] = value
+    return list(refs), list(queries), blocks
+
+
+def mash_compare(old, new, temp_dir, threads=1, tile=0, env=''):
+    """Computes mash distances of new sketches to old and new sketches.
+
+    Parameters
+    ----------
+    old : list of str
+        paths to sketches already compared to each other
+    new : list of str
+        paths to sketches to compare to all sketches
+    temp_dir : str
+        directory to write pasted sketches and intermediate outputs to
+    threads : int (optional)
+        number of threads of mash dist
+    tile : int (optional)
+        maximum number of sketches per pasted sketch, 0 for a single one
+    env : str (optional)
+        command line to set up the environment of mash
+
+    Returns
+    -------
+    list of str
+        names of the new sketches, as reported by mash
+    dict of str: numpy.array
+        distance, p-value, shared and total hashes of every new sketch
+        (rows) to every old, then new, sketch (columns), as expected by
+        oecophylla.distance.store.update_store
+    """
+    sketches = list(old) + list(new)
+    bounds = tiles(len(old), tile) if old else []
+    first_new = len(bounds)
+    bounds += [(len(old) + start, len(old) + stop)
+               for start, stop in tiles(len(new), tile)]
+    pasted = [_paste(sketches[start:stop],
+                     os.path.join(temp_dir, 'tile_%d' % a), env)
+              for a, (start, stop) in enumerate(bounds)]
+
+    names = [None] * len(new)
+    values = {}
+    for b in range(first_new, len(bounds)):
+        q_start, q_stop = [x - len(old) for x in bounds[b]]
+        for a in range(b + 1):
+            r_start, r_stop = bounds[a]
+            _, queries, blocks = _dist_block(pasted[a], pasted[b], temp_dir,
+                                             threads, env)
+            names[q_start:q_stop] = queries
+            for field, block in blocks.items():
+                matrix = values.setdefault(field, np.zeros(
+                    (len(new), len(sketches)), dtype=block.dtype))
+                matrix[q_start:q_stop, r_start:r_stop] = block
+                if a >= first_new:
+                    matrix[r_start - len(old):r_stop - len(old),
+                           len(old) + q_start:len(old) + q_stop] = block.T
+    return names, values
+
+
+def write_mash_dist(names, values, output_fp):
+    """Writes mash distances between all pairs of sketches.
+
+    Parameters
+    ----------
+    names : list of str
+        names of the sketches
+    values : dict of str: numpy.array
+        square matrices of distances, p-values, shared and total hashes
+    output_fp : str
+        path to write the distances to, in the format of
+        "mash dist i j" for every pair of sketches i before j
+    """
+    i, j = np.triu_indices(len(names), 1)
+    names = np.array(names, dtype=object)
+    shared = pd.Series(values['shared'][i, j]).astype(str) + '/' + \
+        pd.Series(values['hashes'][i, j]).astype(str)
+    table = pd.DataFrame({'reference': names[i], 'query': names[j],
+                          'distance': values['distance'][i, j],
+                          'p': values['p'][i, j], 'shared': shared},
+                         columns=MASH_COLUMNS)
+    # mash writes values with 6 significant digits
+    table.to_csv(output_fp, sep='\t', header=False, index=False,
+                 float_format='%g', quoting=csv.QUOTE_NONE)
+
+
+def mash_matrices(dist_fp, temp_dir=None):
+    """Builds distance and p-value matrices from mash dist output.
+
+    Parameters
+    ----------
+    dist_fp : str
+        path to mash dist output of pairs of sketches
+    temp_dir : str (optional)
+        directory to hold the matrices as memory-mapped .npy files, instead
+        of in memory
+
+    Returns
+    -------
+    list of str
+        sorted sketch IDs (file names only)
+    numpy.array of float
+        symmetric matrix of distances
+    numpy.array of float
+        symmetric matrix of p-values
+    """
+    if os.path.getsize(dist_fp) == 0:
+        pairs = pd.DataFrame(columns=MASH_COLUMNS[:4])
+    else:
+        pairs = pd.read_csv(dist_fp, sep='\t', header=None, usecols=range(4),
+                            names=MASH_COLUMNS[:4],
+                            dtype={'reference': str, 'query': str,
+                                   'distance': np.float64,
+                                   'p': np.float64},
+                            quoting=csv.QUOTE_NONE)
+    samples = np.union1d(pairs['reference'].unique(),
+                         pairs['query'].unique())
+    ref = pd.Categorical(pairs['reference'], categories=samples).codes
+    query = pd.Categorical(pairs['query'], categories=samples).codes
+
+    matrices = []
+    for name in ('distance', 'p'):
+        shape = (len(samples), len(samples))
+        if temp_dir is None:
+            matrix = np.zeros(shape)
+        else:
+            matrix = np.lib.format.open_memmap(
+                os.path.join(temp_dir, '%s.npy' % name), mode='w+',
+                dtype=np.float64, shape=shape)
+        values = pairs[name].values.astype(np.float64)
+        matrix[ref, query] = values
+        matrix[query, ref] = values
+        matrices.append(matrix)
+
+    ids = [os.path.basename(x) for x in samples]
+    return ids, matrices[0], matrices[1]
+
+
+def write_matrices_hdf5(h5_fp, ids, matrices, rows=1024):
+    """Writes square matrices of the same IDs into an HDF5 file.
+
+    Parameters
+    ----------
+    h5_fp : str
+        path to the HDF5 file
+    ids : list of str
+        IDs of the rows (and columns) of the matrices
+    matrices : dict of str: numpy.array
+        matrices by dataset name
+    rows : int (optional)
+        number of rows written at once, and of the chunks of the datasets
+    """
+    n = len(ids)
+    with h5py.File(h5_fp, 'w') as h5:
+        h5.create_dataset('ids', data=np.array(ids, dtype=object),
+                          dtype=h5py.special_dtype(vlen=str))
+        for name, matrix in matrices.items():
+            chunks = (min(rows, n), min(rows, n)) if n else None
+            dset = h5.create_dataset(name, shape=(n, n), dtype=matrix.dtype,
+                                     chunks=chunks)
+            for start in range(0, n, rows):
+                dset[start:start + rows] = matrix[start:start + rows]
@@ -0,0 +1,233 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+from oecophylla.distance.store import (read_store, iter_store,
+                                       store_diagonal, CHUNK)
+
+
+# number of signatures per block of comparisons
+TILE = 256
+
+# hashes of all signatures, shared with the processes comparing blocks
+_HASHES = None
+
+
+def read_signature(fp):
+    """Reads the name and hashes of a sourmash signature file.
+
+    Parameters
+    ----------
+    fp : str
+        path to a signature file (JSON), as written by sourmash compute with
+        a single k-mer size
+
+    Returns
+    -------
+    str
+        name of the signature, or the name of the file it was computed from
+    numpy.array of uint64
+        sorted hashes of the MinHash sketch
+    """
+    with open(fp) as f:
+        signatures = json.load(f)
+    if isinstance(signatures, dict):
+        signatures = [signatures]
+    signature = signatures[0]
+    minhash = signature['signatures'][0]
+    name = signature.get('name') or signature.get('filename') or \
+        minhash['md5sum']
+    hashes = np.array(minhash['mins'], dtype=np.uint64)
+    hashes.sort()
+    return name, hashes
+
+
+def shared_hashes(rows, cols):
+    """Counts the hashes shared by signatures.
+
+    Parameters
+    ----------
+    rows : list of numpy.array of uint64
+        sorted hashes of signatures
+    cols : list of numpy.array of uint64
+        sorted hashes of signatures
+
+    Returns
+    -------
+    numpy.array of int64
+        number of hashes of every signature of rows (rows) shared with every
+        signature of cols (columns)
+    """
+    shared = np.zeros((len(rows), len(cols)), dtype=np.int64)
+    if not cols:
+        return shared
+    # the hashes of all columns are looked up at once in each row
+    hashes = np.concatenate(cols)
+    labels = np.repeat(np.arange(len(cols)), [len(c) for c in cols])
+    for i, row in enumerate(rows):
+        if not len(row):
+            continue
+        found = row[np.minimum(np.searchsorted(row, hashes),
+                               len(row) - 1)] == hashes
+        shared[i] = np.bincount(labels[found], minlength=len(cols))
+    return shared
+
+
+def similarity(shared, row_sizes, col_sizes, containment=False):
+    """Computes similarities of signatures from their shared hashes.
+
+    Parameters
+    ----------
+    shared : numpy.array of int
+        number of hashes shared by signatures of rows and columns
+    row_sizes : numpy.array of int
+        number of hashes of the signatures of rows
+    col_sizes : numpy.array of int
+        number of hashes of the signatures of columns
+    containment : bool (optional)
+        compute the fraction of the hashes of rows found in columns, instead
+        of the Jaccard similarity
+
+    Returns
+    -------
+    numpy.array of float
+        similarities of the signatures of rows and columns
+    """
+    if containment:
+        total = np.broadcast_to(row_sizes[:, None], shared.shape)
+    else:
+        total = row_sizes[:, None] + col_sizes[None, :] - shared
+    result = np.zeros(shared.shape)
+    np.divide(shared, total, out=result, where=total > 0)
+    return result
+
+
+def _init_worker(hashes):
+    global _HASHES
+    _HASHES = hashes
+
+
+def _compare_block(bounds):
+    (r_start, r_stop), (c_start, c_stop) = bounds
+    return shared_hashes(_HASHES[r_start:r_stop], _HASHES[c_start:c_stop])
+
+
+def sourmash_compare(old, new, threads=1, tile=TILE, temp_dir=None):
+    """Counts hashes shared by new signatures with old and new ones.
+
+    Parameters
+    ----------
+    old : list of str
+        paths to signatures already compared to each other
+    new : list of str
+        paths to signatures to compare to all signatures
+    threads : int (optional)
+        number of processes comparing blocks of signatures
+    tile : int (optional)
+        number of signatures per block of comparisons
+    temp_dir : str (optional)
+        directory to hold the counts as a memory-mapped .npy file, instead of
+        in memory
+
+    Returns
+    -------
+    list of str
+        names of the new signatures
+    dict of str: numpy.array
+        hashes shared by every new signature (rows) with every old, then new,
+        signature (columns), as expected by
+        oecophylla.distance.store.update_store. The number of hashes of each
+        signature is its count with itself.
+    """
+    signatures = [read_signature(fp) for fp in list(old) + list(new)]
+    hashes = [h for _, h in signatures]
+    shape = (len(new), len(signatures))
+    if temp_dir is None:
+        shared = np.zeros(shape, dtype=np.int64)
+    else:
+        shared = np.lib.format.open_memmap(
+            os.path.join(temp_dir, 'shared.npy'), mode='w+',
+            dtype=np.int64, shape=shape)
+
+    # blocks of new signatures to old ones, and to new ones of later blocks
+    rows = [(len(old) + start, min(len(old) + start + tile,
+                                   len(signatures)))
+            for start in range(0, len(new), tile)]
+    cols = [(start, min(start + tile, len(old)))
+            for start in range(0, len(old), tile)]
+    blocks = [(r, c) for i, r in enumerate(rows) for c in cols + rows[i:]]
+
+    executor = ProcessPoolExecutor(threads, initializer=_init_worker,
+                                   initargs=(hashes,)) \
+        if threads > 1 else None
+    try:
+        if executor is None:
+            _init_worker(hashes)
+            results = map(_compare_block, blocks)
+        else:
+            results = executor.map(_compare_block, blocks)
+        for ((r_start, r_stop), (c_start, c_stop)), block in \
+                zip(blocks, results):
+            shared[r_start - len(old):r_stop - len(old),
+                   c_start:c_stop] = block
+            if c_start >= len(old) and c_start != r_start:
+                shared[c_start - len(old):c_stop - len(old),
+                       r_start:r_stop] = block.T
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        _init_worker(None)
+    return [name for name, _ in signatures[len(old):]], {'shared': shared}
+
+
+def write_sourmash_distances(store_fp, positions, dm_fp, h5_fp,
+                             containment=False, rows=CHUNK):
+    """Writes distances between signatures from a store of shared hashes.
+
+    Parameters
+    ----------
+    store_fp : str
+        path to the HDF5 store of hashes shared by signatures
+    positions : numpy.array of int
+        positions of the signatures in the store, as returned by
+        oecophylla.distance.store.update_store
+    dm_fp : str
+        path to write the distance matrix to, in the lsmat format of
+        scikit-bio
+    h5_fp : str
+        path to write the IDs and distance matrix to, as HDF5
+    containment : bool (optional)
+        use the fraction of hashes of the signature of each row not found in
+        the signature of each column, instead of the Jaccard distance
+    rows : int (optional)
+        number of rows read and written at once
+
+    Notes
+    -----
+    The distances are computed and written in blocks of rows, so that the
+    full matrix is never held in memory.
+    """
+    names, _ = read_store(store_fp, positions, fields=[])
+    ids = [os.path.basename(x) for x in names]
+    sizes = store_diagonal(store_fp, positions, 'shared')
+    n = len(ids)
+    with open(dm_fp, 'w') as dm, h5py.File(h5_fp, 'w') as h5:
+        h5.create_dataset('ids', data=np.array(ids, dtype=object),
+                          dtype=h5py.special_dtype(vlen=str))
+        dset = h5.create_dataset('distance', shape=(n, n), dtype=np.float64,
+                                 chunks=(min(rows, n), min(rows, n))
+                                 if n else None)
+        dm.write('\t' + '\t'.join(ids) + '\n')
+        for start, shared in iter_store(store_fp, positions, 'shared', rows):
+            stop = start + len(shared)
+            dist = 1 - similarity(shared, sizes[start:stop], sizes,
+                                  containment)
+            # because numerical overflow, set diagonal to zero explicitly
+            dist[np.arange(len(dist)), np.arange(start, stop)] = 0
+            dset[start:stop] = dist
+            dm.write(''.join('%s\t%s\n' % (id_, '\t'.join(values))
+                             for id_, values in
+                             zip(ids[start:stop], dist.astype(str))))
@@ -0,0 +1,254 @@
+import hashlib
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+
+# rows (and columns) of the chunks of stored matrices
+CHUNK = 512
+
+# bytes of chunk cache per matrix
+CACHE = 2**26
+
+
+def sketch_checksum(fp, blocksize=2**20):
+    """Computes the md5 checksum of a sketch file."""
+    md5 = hashlib.md5()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _open(store_fp, mode):
+    return h5py.File(store_fp, mode, rdcc_nbytes=CACHE, rdcc_nslots=10007)
+
+
+def _selection(positions):
+    """Selects sorted unique positions as a slice if they are contiguous."""
+    if len(positions) and positions[-1] - positions[0] == len(positions) - 1:
+        return slice(int(positions[0]), int(positions[-1]) + 1)
+    return positions
+
+
+def _runs(positions):
+    """Splits sorted positions into runs of consecutive positions."""
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    return np.split(np.arange(len(positions)), breaks)
+
+
+def _read_rows(dset, rows, cols):
+    """Reads the values of rows and columns at positions of a dataset."""
+    unique_rows, row_inverse = np.unique(rows, return_inverse=True)
+    unique_cols, col_inverse = np.unique(cols, return_inverse=True)
+    if not len(unique_rows) or not len(unique_cols):
+        return np.empty((len(rows), len(cols)), dtype=dset.dtype)
+    # at most one axis of a dataset can be selected by a list
+    first = int(unique_cols[0])
+    sub = dset[_selection(unique_rows), first:int(unique_cols[-1]) + 1]
+    return sub[row_inverse][:, unique_cols[col_inverse] - first]
+
+
+def _read_square(dset, positions, rows=CHUNK):
+    """Reads the rows and columns of positions of a square dataset."""
+    sub = np.empty((len(positions), len(positions)), dtype=dset.dtype)
+    for start in range(0, len(positions), rows):
+        block = positions[start:start + rows]
+        sub[start:start + len(block)] = _read_rows(dset, block, positions)
+    return sub
+
+
+def _stale(missing):
+    """Selects few sketches to compare again to cover all missing pairs."""
+    missing = missing.copy()
+    counts = missing.sum(axis=1)
+    stale = np.zeros(len(missing), dtype=bool)
+    while counts.any():
+        # greedily, the sketch missing the most pairs
+        k = np.argmax(counts)
+        stale[k] = True
+        counts -= missing[:, k]
+        counts[k] = 0
+        missing[:, k] = False
+        missing[k, :] = False
+    return stale
+
+
+def update_store(store_fp, sketches, compare):
+    """Adds the pairwise values of new sketches to a store.
+
+    Parameters
+    ----------
+    store_fp : str
+        path to the HDF5 store, created if missing
+    sketches : list of str
+        paths to sketches
+    compare : callable
+        compare(old, new) is called with the paths of sketches already in
+        the store and of sketches to add, and returns the names of the new
+        sketches and a dict of each stored field to a (possibly
+        memory-mapped) matrix of values of every new sketch (rows) to every
+        old, then new, sketch (columns)
+
+    Returns
+    -------
+    numpy.array of int
+        position of each sketch in the store
+
+    Notes
+    -----
+    Sketches are keyed by the checksum of their file, so that only pairs
+    involving new (or changed) sketches are compared. Pairs of stored
+    sketches can be missing, if one was absent when the other was added, in
+    which case a few of them are compared again to all sketches.
+
+    Checksums are written last, so that an interrupted update leaves the
+    values of the known sketches intact.
+    """
+    checksums = [sketch_checksum(fp) for fp in sketches]
+    paths = OrderedDict()
+    for fp, checksum in zip(sketches, checksums):
+        paths.setdefault(checksum, fp)
+
+    with _open(store_fp, 'a') as h5:
+        if 'checksums' not in h5:
+            for name in ('checksums', 'names'):
+                h5.create_dataset(name, shape=(0,), maxshape=(None,),
+                                  dtype=h5py.string_dtype())
+            h5.create_dataset('computed', shape=(0, 0), maxshape=(None, None),
+                              dtype=np.uint8, chunks=(CHUNK, CHUNK),
+                              fillvalue=0)
+        n = len(h5['checksums'])
+        known = {c: i for i, c in enumerate(h5['checksums'].asstr()[:])}
+
+        old = np.array([known[c] for c in paths if c in known],
+                       dtype=np.int64)
+        old.sort()
+        stale = _stale(_read_square(h5['computed'], old) == 0)
+        added = [c for c in paths if c not in known]
+        if not added and not stale.any():
+            return np.array([known[c] for c in checksums], dtype=np.int64)
+
+        # new sketches are appended to the store
+        for i, c in enumerate(added):
+            known[c] = n + i
+        by_position = {i: c for c, i in known.items()}
+        rest = old[~stale]
+        process = np.concatenate([old[stale],
+                                  np.arange(n, n + len(added))])
+        names, values = compare([paths[by_position[i]] for i in rest],
+                                [paths[by_position[i]] for i in process])
+        values['computed'] = None
+
+        size = n + len(added)
+        cols = np.concatenate([rest, process])
+        order = np.argsort(cols, kind='mergesort')
+        col_sel = _selection(cols[order])
+        for field, matrix in values.items():
+            dtype = np.uint8 if matrix is None else matrix.dtype
+            if field not in h5:
+                fill = np.nan if dtype.kind == 'f' else 0
+                h5.create_dataset(field, shape=(0, 0), maxshape=(None, None),
+                                  dtype=dtype, chunks=(CHUNK, CHUNK),
+                                  fillvalue=fill)
+            dset = h5[field]
+            dset.resize((size, size))
+            if field == 'computed':
+                # forget pairs written by an interrupted update
+                dset[n:size, :] = 0
+                dset[:, n:size] = 0
+            # rows are written in blocks, as matrices can be memory-mapped
+            for run in _runs(process):
+                for start in range(0, len(run), CHUNK):
+                    part = run[start:start + CHUNK]
+                    if matrix is None:
+                        block = np.ones((len(part), len(cols)), dtype=dtype)
+                    else:
+                        block = matrix[part][:, order]
+                    rows = slice(int(process[part[0]]),
+                                 int(process[part[-1]]) + 1)
+                    dset[rows, col_sel] = block
+                    dset[col_sel, rows] = block.T
+
+        names = np.array(names, dtype=object)
+        n_stale = len(process) - len(added)
+        h5['names'].resize((size,))
+        for i, name in zip(process[:n_stale], names[:n_stale]):
+            h5['names'][i] = name
+        h5['names'][n:size] = names[n_stale:]
+        h5['checksums'].resize((size,))
+        h5['checksums'][n:size] = np.array(added, dtype=object)
+
+    return np.array([known[c] for c in checksums], dtype=np.int64)
+
+
+def read_store(store_fp, positions, fields=None):
+    """Reads the pairwise values of sketches from a store.
+
+    Parameters
+    ----------
+    store_fp : str
+        path to the HDF5 store
+    positions : numpy.array of int
+        positions of the sketches in the store, as returned by update_store
+    fields : list of str (optional)
+        fields to read, all by default
+
+    Returns
+    -------
+    list of str
+        names of the sketches
+    dict of str: numpy.array
+        square matrix of each field, in the order of positions
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    with _open(store_fp, 'r') as h5:
+        all_names = h5['names'].asstr()[:]
+        names = [all_names[i] for i in positions]
+        if fields is None:
+            fields = [f for f in h5 if f not in ('checksums', 'names',
+                                                 'computed')]
+        values = {f: _read_square(h5[f], positions) for f in fields}
+    return names, values
+
+
+def iter_store(store_fp, positions, field, rows=CHUNK):
+    """Reads the pairwise values of sketches from a store in blocks of rows.
+
+    Parameters
+    ----------
+    store_fp : str
+        path to the HDF5 store
+    positions : numpy.array of int
+        positions of the sketches in the store, as returned by update_store
+    field : str
+        field to read
+    rows : int (optional)
+        number of rows per block
+
+    Yields
+    ------
+    int
+        index of the first row of the block
+    numpy.array
+        values of the sketches of the block (rows) to all sketches (columns),
+        in the order of positions
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    with _open(store_fp, 'r') as h5:
+        for start in range(0, len(positions), rows):
+            yield start, _read_rows(h5[field], positions[start:start + rows],
+                                    positions)
+
+
+def store_diagonal(store_fp, positions, field, rows=CHUNK):
+    """Reads the values of sketches to themselves from a store."""
+    positions = np.asarray(positions, dtype=np.int64)
+    with _open(store_fp, 'r') as h5:
+        dset = h5[field]
+        diagonal = [np.zeros(0, dtype=dset.dtype)]
+        for start in range(0, len(positions), rows):
+            block = positions[start:start + rows]
+            diagonal.append(np.diagonal(_read_rows(dset, block, block)))
+    return np.concatenate(diagonal)
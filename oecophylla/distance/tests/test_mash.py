@@ -0,0 +1,172 @@
+import os
+import csv
+import tempfile
+from unittest import TestCase, main, mock
+from itertools import combinations
+
+import h5py
+import numpy as np
+import pandas as pd
+import numpy.testing as npt
+
+from oecophylla.distance.mash import (tiles, mash_compare,
+                                      mash_matrices, write_mash_dist,
+                                      write_matrices_hdf5, MASH_COLUMNS)
+
+
+def _fake_dist(names_ref, names_query):
+    # rows as written by mash dist, every reference for each query
+    rows = []
+    for q in names_query:
+        for r in names_ref:
+            i, j = sorted([int(r[1:]), int(q[1:])])
+            rows.append([r, q, '0.0%d%d' % (i, j), '1e-%d' % (i + j),
+                         '%d/1000' % (i * j)])
+    return pd.DataFrame(rows, columns=MASH_COLUMNS)
+
+
+class _FakeMash(object):
+    # records pasted sketches, and writes _fake_dist for mash dist
+    def __init__(self):
+        self.pasted = {}
+        self.dists = []
+
+    def __call__(self, cmd, env=''):
+        args = cmd.split()
+        if args[1] == 'paste':
+            self.pasted[args[2] + '.msh'] = args[3:]
+        else:
+            ref, query, file = args[4], args[5], args[7]
+            self.dists.append((ref, query))
+            _fake_dist(self.pasted[ref], self.pasted[query]).to_csv(
+                file, sep='\t', header=False, index=False,
+                quoting=csv.QUOTE_NONE)
+
+
+class MashTests(TestCase):
+    def setUp(self):
+        self.names = ['s%d' % i for i in range(7)]
+        # output of mash dist i j for every pair, in order
+        self.exp = pd.concat([_fake_dist([i], [j]) for i, j in
+                              combinations(self.names, 2)],
+                             ignore_index=True)
+
+    def test_tiles(self):
+        self.assertEqual(tiles(7), [(0, 7)])
+        self.assertEqual(tiles(7, 10), [(0, 7)])
+        self.assertEqual(tiles(7, 3), [(0, 3), (3, 6), (6, 7)])
+
+    def _check_compare(self, old, new, tile):
+        fake = _FakeMash()
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch('oecophylla.distance.mash._run', fake):
+            names, values = mash_compare(old, new, temp_dir, tile=tile)
+            self.assertEqual(os.listdir(temp_dir), [])
+        self.assertEqual(names, new)
+        cols = old + new
+        for k, q in enumerate(new):
+            for c, r in enumerate(cols):
+                i, j = sorted([int(r[1:]), int(q[1:])])
+                self.assertEqual(values['distance'][k, c],
+                                 float('0.0%d%d' % (i, j)))
+                self.assertEqual(values['p'][k, c], float('1e-%d' % (i + j)))
+                self.assertEqual(values['shared'][k, c], i * j)
+                self.assertEqual(values['hashes'][k, c], 1000)
+        # the values of new sketches to each other are symmetric
+        for field, matrix in values.items():
+            self.assertEqual(matrix.shape, (len(new), len(cols)))
+            npt.assert_array_equal(matrix[:, len(old):],
+                                   matrix[:, len(old):].T)
+        return fake
+
+    def test_mash_compare(self):
+        # old and new sketches, with one tile each
+        fake = self._check_compare(self.names[:3], self.names[3:], 0)
+        self.assertEqual(sorted(fake.pasted.values()),
+                         [self.names[:3], self.names[3:]])
+        self.assertEqual(len(fake.dists), 2)
+
+    def test_mash_compare_new(self):
+        fake = self._check_compare([], self.names, 0)
+        self.assertEqual(len(fake.dists), 1)
+        fake = self._check_compare([], self.names[:1], 0)
+        self.assertEqual(len(fake.dists), 1)
+
+    def test_mash_compare_tiles(self):
+        for tile in (1, 2, 3):
+            for n_old in (0, 2, 5):
+                old, new = self.names[:n_old], self.names[n_old:]
+                fake = self._check_compare(old, new, tile)
+                # every new tile to each old tile and to new tiles up to it
+                n_old_tiles = len(tiles(len(old), tile)) if old else 0
+                n_new_tiles = len(tiles(len(new), tile))
+                self.assertEqual(len(fake.dists),
+                                 n_new_tiles * n_old_tiles +
+                                 n_new_tiles * (n_new_tiles + 1) // 2)
+                for ref, query in fake.dists:
+                    self.assertTrue(set(fake.pasted[query]) <= set(new))
+
+    def test_write_mash_dist(self):
+        values = {'distance': np.zeros((7, 7)), 'p': np.zeros((7, 7)),
+                  'shared': np.zeros((7, 7), dtype=int),
+                  'hashes': np.zeros((7, 7), dtype=int)}
+        for (i, j), row in zip(combinations(range(7), 2),
+                               self.exp.itertuples(index=False)):
+            shared, hashes = row.shared.split('/')
+            for x, y in ((i, j), (j, i)):
+                values['distance'][x, y] = float(row.distance)
+                values['p'][x, y] = float(row.p)
+                values['shared'][x, y] = int(shared)
+                values['hashes'][x, y] = int(hashes)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dist_fp = os.path.join(temp_dir, 'mash.dist.txt')
+            write_mash_dist(self.names, values, dist_fp)
+            with open(dist_fp) as f:
+                obs = f.read()
+            write_mash_dist(self.names[:1], values, dist_fp)
+            self.assertEqual(os.path.getsize(dist_fp), 0)
+        # values as written by mash, with 6 significant digits
+        exp = ''.join('%s\t%s\t%g\t%g\t%s\n' % (r, q, float(d), float(p), s)
+                      for r, q, d, p, s in self.exp.values)
+        self.assertEqual(obs, exp)
+
+    def test_mash_matrices(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dist_fp = os.path.join(temp_dir, 'mash.dist.txt')
+            dist = self.exp.copy()
+            dist['reference'] = 'sketches/' + dist['reference'] + '.msh'
+            dist['query'] = 'sketches/' + dist['query'] + '.msh'
+            dist.to_csv(dist_fp, sep='\t', header=False, index=False,
+                        quoting=csv.QUOTE_NONE)
+
+            exp_dm = np.zeros((7, 7))
+            exp_pm = np.zeros((7, 7))
+            for i, j in combinations(range(7), 2):
+                exp_dm[i, j] = exp_dm[j, i] = float('0.0%d%d' % (i, j))
+                exp_pm[i, j] = exp_pm[j, i] = float('1e-%d' % (i + j))
+
+            for mmap_dir in (None, temp_dir):
+                ids, dm, pm = mash_matrices(dist_fp, temp_dir=mmap_dir)
+                self.assertEqual(ids, [n + '.msh' for n in self.names])
+                npt.assert_array_equal(dm, exp_dm)
+                npt.assert_array_equal(pm, exp_pm)
+            self.assertIsInstance(dm, np.memmap)
+
+            h5_fp = os.path.join(temp_dir, 'mash.dist.h5')
+            write_matrices_hdf5(h5_fp, ids, {'distance': dm, 'p': pm},
+                                rows=3)
+            with h5py.File(h5_fp, 'r') as h5:
+                self.assertEqual([x.decode() for x in h5['ids'][:]], ids)
+                npt.assert_array_equal(h5['distance'][:], exp_dm)
+                npt.assert_array_equal(h5['p'][:], exp_pm)
+
+    def test_mash_matrices_empty(self):
+        with tempfile.NamedTemporaryFile() as f:
+            ids, dm, pm = mash_matrices(f.name)
+        self.assertEqual(ids, [])
+        self.assertEqual(dm.shape, (0, 0))
+        self.assertEqual(pm.shape, (0, 0))
+
+
+if __name__ == '__main__':
+    main()
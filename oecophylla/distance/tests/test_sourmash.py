@@ -0,0 +1,123 @@
+import os
+import json
+import tempfile
+from io import StringIO
+from unittest import TestCase, main
+
+import numpy as np
+import numpy.testing as npt
+
+import h5py
+from skbio.stats.distance import DistanceMatrix, DissimilarityMatrix
+
+from oecophylla.distance.sourmash import (read_signature, shared_hashes,
+                                          similarity, sourmash_compare,
+                                          write_sourmash_distances)
+from oecophylla.distance.store import update_store
+
+
+def _write_signature(fp, mins, name=None):
+    signature = {'class': 'sourmash_signature', 'email': '',
+                 'filename': '/tmp/scratch/%s' % os.path.basename(fp),
+                 'hash_function': '0.murmur64', 'license': 'CC0',
+                 'signatures': [{'ksize': 31, 'max_hash': 2**63,
+                                 'md5sum': 'abc', 'mins': mins, 'num': 0,
+                                 'seed': 42, 'molecule': 'DNA'}],
+                 'version': 0.4}
+    if name is not None:
+        signature['name'] = name
+    with open(fp, 'w') as f:
+        json.dump([signature], f)
+
+
+class SourmashTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.mins = [[2**63 + 5, 1, 3, 7], [3, 1, 8], [9]]
+        self.sigs = []
+        for i, mins in enumerate(self.mins):
+            fp = os.path.join(self.temp_dir.name, 's%d.sig' % i)
+            _write_signature(fp, mins)
+            self.sigs.append(fp)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_read_signature(self):
+        name, hashes = read_signature(self.sigs[0])
+        self.assertEqual(name, '/tmp/scratch/s0.sig')
+        self.assertEqual(hashes.dtype, np.uint64)
+        self.assertEqual(hashes.tolist(), [1, 3, 7, 2**63 + 5])
+
+        _write_signature(self.sigs[0], [1], name='S0')
+        self.assertEqual(read_signature(self.sigs[0])[0], 'S0')
+
+    def test_shared_hashes(self):
+        a = np.array([1, 3, 7], dtype=np.uint64)
+        b = np.array([1, 3, 8, 9], dtype=np.uint64)
+        empty = np.array([], dtype=np.uint64)
+        npt.assert_array_equal(shared_hashes([a, b, empty], [b, a, empty]),
+                               [[2, 3, 0], [4, 2, 0], [0, 0, 0]])
+        self.assertEqual(shared_hashes([a], []).shape, (1, 0))
+
+    def test_similarity(self):
+        shared = np.array([[3, 2], [2, 4]])
+        sizes = np.array([3, 4])
+        npt.assert_array_equal(similarity(shared, sizes, sizes),
+                               [[1, 2 / 5], [2 / 5, 1]])
+        npt.assert_array_equal(similarity(shared, sizes, sizes,
+                                          containment=True),
+                               [[1, 2 / 3], [2 / 4, 1]])
+        npt.assert_array_equal(similarity(np.zeros((1, 1), dtype=int),
+                                          np.zeros(1), np.zeros(1)), [[0]])
+
+    def test_sourmash_compare(self):
+        names, values = sourmash_compare(self.sigs[:1], self.sigs[1:])
+        self.assertEqual(names, ['/tmp/scratch/s1.sig',
+                                 '/tmp/scratch/s2.sig'])
+        npt.assert_array_equal(values['shared'], [[2, 3, 0], [0, 0, 1]])
+
+    def test_sourmash_compare_blocks(self):
+        rng = np.random.RandomState(0)
+        sigs = []
+        for i in range(11):
+            fp = os.path.join(self.temp_dir.name, 'r%d.sig' % i)
+            _write_signature(fp, rng.choice(50, 20, replace=False).tolist())
+            sigs.append(fp)
+        hashes = [read_signature(fp)[1] for fp in sigs]
+        exp = shared_hashes(hashes[4:], hashes)
+        for threads, tile, temp_dir in ((1, 3, None), (2, 2, None),
+                                        (1, 4, self.temp_dir.name)):
+            _, values = sourmash_compare(sigs[:4], sigs[4:], threads=threads,
+                                         tile=tile, temp_dir=temp_dir)
+            npt.assert_array_equal(values['shared'], exp)
+
+    def test_write_sourmash_distances(self):
+        store = os.path.join(self.temp_dir.name, 'store.h5')
+        dm_fp = os.path.join(self.temp_dir.name, 'sourmash.dist.dm')
+        h5_fp = os.path.join(self.temp_dir.name, 'sourmash.dist.h5')
+        positions = update_store(store, self.sigs, sourmash_compare)
+        ids = ['s0.sig', 's1.sig', 's2.sig']
+
+        for containment, exp in ((False, [[0, 3 / 5, 1],
+                                          [3 / 5, 0, 1],
+                                          [1, 1, 0]]),
+                                 (True, [[0, 1 / 2, 1],
+                                         [1 / 3, 0, 1],
+                                         [1, 1, 0]])):
+            write_sourmash_distances(store, positions, dm_fp, h5_fp,
+                                     containment=containment, rows=2)
+            obs = DissimilarityMatrix.read(dm_fp)
+            self.assertEqual(list(obs.ids), ids)
+            npt.assert_allclose(obs.data, exp)
+            with h5py.File(h5_fp, 'r') as h5:
+                self.assertEqual([x.decode() for x in h5['ids'][:]], ids)
+                npt.assert_array_equal(h5['distance'][:], obs.data)
+            # as written by scikit-bio
+            with open(dm_fp) as f:
+                self.assertEqual(f.read(), obs.write(StringIO()).getvalue())
+            if not containment:
+                DistanceMatrix.read(dm_fp)
+
+if __name__ == '__main__':
+    main()
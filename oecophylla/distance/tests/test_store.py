@@ -0,0 +1,117 @@
+import os
+import tempfile
+from unittest import TestCase, main
+
+import numpy as np
+import numpy.testing as npt
+
+from oecophylla.distance.store import (sketch_checksum, update_store,
+                                       read_store, iter_store,
+                                       store_diagonal)
+
+
+def _value(fp):
+    with open(fp) as f:
+        return float(f.read())
+
+
+class StoreTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.temp_dir.name, 'store.h5')
+        self.compared = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _sketch(self, name, value):
+        fp = os.path.join(self.temp_dir.name, name)
+        with open(fp, 'w') as f:
+            f.write(str(value))
+        return fp
+
+    def _compare(self, old, new):
+        # the difference of the values of sketches, and their product
+        self.compared.append((list(old), list(new)))
+        cols = np.array([_value(fp) for fp in list(old) + list(new)])
+        rows = np.array([_value(fp) for fp in new])
+        return ([os.path.basename(fp) for fp in new],
+                {'difference': np.abs(rows[:, None] - cols[None, :]),
+                 'product': (rows[:, None] * cols[None, :]).astype(int)})
+
+    def _check(self, sketches):
+        positions = update_store(self.store, sketches, self._compare)
+        names, values = read_store(self.store, positions)
+        self.assertEqual(names, [os.path.basename(fp) for fp in sketches])
+        x = np.array([_value(fp) for fp in sketches])
+        npt.assert_array_equal(values['difference'],
+                               np.abs(x[:, None] - x[None, :]))
+        npt.assert_array_equal(values['product'],
+                               (x[:, None] * x[None, :]).astype(int))
+        return positions
+
+    def test_sketch_checksum(self):
+        a = self._sketch('a', 1)
+        self.assertEqual(sketch_checksum(a), sketch_checksum(a, 1))
+        self.assertNotEqual(sketch_checksum(a),
+                            sketch_checksum(self._sketch('b', 2)))
+
+    def test_update_store(self):
+        sketches = [self._sketch('s%d' % i, i + 1) for i in range(5)]
+        npt.assert_array_equal(self._check(sketches[:3]), [0, 1, 2])
+        self.assertEqual(self.compared, [([], sketches[:3])])
+
+        # only new sketches are compared, in any order
+        order = [sketches[4], sketches[0], sketches[3], sketches[2]]
+        npt.assert_array_equal(self._check(order), [3, 0, 4, 2])
+        self.assertEqual(self.compared[1], ([sketches[0], sketches[2]],
+                                            [sketches[4], sketches[3]]))
+
+        # nothing is compared again
+        self._check([sketches[0]] + sketches[2:][::-1])
+        self.assertEqual(len(self.compared), 2)
+
+        # s1 was absent when s3 and s4 were added
+        self._check(sketches[1:])
+        self.assertEqual(self.compared[2], ([sketches[2], sketches[4],
+                                             sketches[3]], [sketches[1]]))
+        self._check(sketches[::-1])
+        self.assertEqual(len(self.compared), 3)
+
+    def test_update_store_changed(self):
+        a, b = self._sketch('a', 1), self._sketch('b', 2)
+        self._check([a, b])
+        self._sketch('b', 5)
+        npt.assert_array_equal(self._check([a, b]), [0, 2])
+        self.assertEqual(self.compared[1], ([a], [b]))
+
+    def test_update_store_duplicates(self):
+        a, b = self._sketch('a', 1), self._sketch('b', 1)
+        positions = update_store(self.store, [a, b, a], self._compare)
+        npt.assert_array_equal(positions, [0, 0, 0])
+        self.assertEqual(self.compared, [([], [a])])
+
+    def test_iter_store(self):
+        sketches = [self._sketch('s%d' % i, i + 1) for i in range(5)]
+        update_store(self.store, sketches[3:], self._compare)
+        positions = update_store(self.store, sketches, self._compare)
+        _, values = read_store(self.store, positions)
+        blocks = list(iter_store(self.store, positions, 'product', rows=2))
+        self.assertEqual([start for start, _ in blocks], [0, 2, 4])
+        npt.assert_array_equal(np.concatenate([b for _, b in blocks]),
+                               values['product'])
+        npt.assert_array_equal(store_diagonal(self.store, positions,
+                                              'product', rows=2),
+                               [1, 4, 9, 16, 25])
+        self.assertEqual(len(store_diagonal(self.store, [], 'product')), 0)
+
+    def test_update_store_empty(self):
+        positions = update_store(self.store, [], self._compare)
+        self.assertEqual(len(positions), 0)
+        names, values = read_store(self.store, positions)
+        self.assertEqual(names, [])
+        self.assertEqual(values, {})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from oecophylla.taxonomy.parser import write_sidecar
+from oecophylla.taxonomy.tree import jump
+
+
+# columns of a Bracken output file
+BRACKEN_COLUMNS = ['name', 'taxonomy_id', 'taxonomy_lvl',
+                   'kraken_assigned_reads', 'added_reads', 'new_est_reads',
+                   'fraction_total_reads']
+
+
+def read_kmer_distribution(filename):
+    """Reads a Bracken kmer distribution file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a kmer distribution file as made by Bracken's
+        generate_kmer_distribution.py (format: mapped TaxID<tab>genome
+        TaxID:kmers mapped:total genome kmers, space separated per genome).
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        fraction of the kmers of each genome (column) that Kraken classifies
+        at each TaxID (row)
+    """
+    mapped, counts, genomes = [], [], []
+    with open(filename, 'r') as f:
+        # skip header line
+        next(f, None)
+        for line in f:
+            taxid, _, entries = line.partition('\t')
+            entries = entries.split()
+            mapped.append(int(taxid))
+            counts.append(len(entries))
+            genomes.extend(entries)
+    if not genomes:
+        return csr_matrix((0, 0))
+
+    values = np.array(':'.join(genomes).split(':'),
+                      dtype=np.int64).reshape(-1, 3)
+    rows = np.repeat(np.array(mapped, dtype=np.int64), counts)
+    size = max(rows.max(), values[:, 0].max()) + 1
+    return csr_matrix((values[:, 1] / values[:, 2], (rows, values[:, 0])),
+                      shape=(size, size))
+
+
+def _read_report_tree(file):
+    """Reads a Kraken report and the position of each row's parent row."""
+    report = pd.read_csv(file, sep='\t', header=None, usecols=[1, 2, 3, 4, 5],
+                         names=['reads', 'direct', 'code', 'taxid', 'name'],
+                         dtype={'reads': np.int64, 'direct': np.int64,
+                                'code': str, 'taxid': np.int64, 'name': str},
+                         quoting=3, keep_default_na=False)
+    # names are indented by two spaces per level
+    names = report['name'].values.astype(str)
+    depth = (np.char.str_len(names) -
+             np.char.str_len(np.char.lstrip(names, ' '))) // 2
+    report['name'] = np.char.strip(names)
+
+    # rows are in depth-first order, hence the parent of a row is the last
+    # row above it that is one level higher
+    parent = np.arange(len(report))
+    last = {}
+    for i, d in enumerate(depth.tolist()):
+        if d > 0:
+            parent[i] = last.get(d - 1, i)
+        last[d] = i
+    return report, parent
+
+
+def estimate_abundance(report, parent, distr, level, threshold=10):
+    """Re-estimates read counts at one level, as Bracken does.
+
+    Reads which Kraken classified above the level are distributed among the
+    level's TaxIDs in the sample, proportional to the probability that a read
+    of their genomes is classified where the read was.
+
+    Parameters
+    ----------
+    report : Pandas.DataFrame
+        Kraken report, as read by _read_report_tree
+    parent : numpy.array of int
+        position of the parent row of each row of `report`
+    distr : scipy.sparse.csr_matrix
+        kmer distribution, as read by read_kmer_distribution
+    level : str
+        level code, e.g. "S" for species
+    threshold : int (optional)
+        minimum number of reads for a TaxID at the level to be kept
+
+    Returns
+    -------
+    Pandas.DataFrame
+        in the format of Bracken's output (see BRACKEN_COLUMNS)
+    """
+    codes = report['code'].values
+    reads = report['reads'].values
+    direct = report['direct'].values
+    taxids = report['taxid'].values
+    rows = np.arange(len(report))
+
+    # closest row at the level above (or at) each row, -1 if there is none
+    up = jump(np.where(codes == level, rows, parent))
+    lvl = np.where(codes[up] == level, up, -1)
+    kept = (lvl >= 0) & (reads[np.maximum(lvl, 0)] >= threshold)
+
+    # genomes in the sample: rows at or below kept rows at the level, and
+    # estimates of their reads from those that Kraken classified uniquely
+    genomes = np.flatnonzero(kept & (taxids < distr.shape[1]))
+    g_taxids = taxids[genomes]
+    unique = np.asarray(distr[g_taxids, g_taxids]).ravel() \
+        if len(genomes) else np.zeros(0)
+    est = direct[genomes] / np.where(unique > 0, unique, 1.0)
+
+    # rows above the level with reads to distribute
+    sources = np.flatnonzero((lvl < 0) & (direct > 0) & (taxids > 0) &
+                             (taxids < distr.shape[0]))
+    added = np.zeros(len(report))
+    if len(genomes) and len(sources):
+        weights = csr_matrix(distr[taxids[sources]][:, g_taxids].multiply(
+            est[np.newaxis, :]))
+        totals = np.asarray(weights.sum(axis=1)).ravel()
+        scale = np.divide(direct[sources], totals,
+                          out=np.zeros(len(sources)), where=totals > 0)
+        added_genomes = weights.T.dot(scale)
+        added += np.bincount(lvl[genomes], weights=added_genomes,
+                             minlength=len(report))
+
+    at_level = np.flatnonzero((codes == level) & kept)
+    new_est = reads[at_level] + added[at_level]
+    total = new_est.sum()
+    return pd.DataFrame({
+        'name': report['name'].values[at_level],
+        'taxonomy_id': taxids[at_level],
+        'taxonomy_lvl': level,
+        'kraken_assigned_reads': reads[at_level],
+        'added_reads': added[at_level].astype(np.int64),
+        'new_est_reads': new_est.astype(np.int64),
+        'fraction_total_reads': new_est / total if total else 0.0},
+        columns=BRACKEN_COLUMNS)
+
+
+def redistribute(file_report, distr, levels, stem, threshold=10):
+    """Re-estimates read counts of a Kraken report at several levels.
+
+    Replaces running Bracken's est_abundance.py once per level, each of which
+    reads the report and kmer distribution again.
+
+    Parameters
+    ----------
+    file_report : str
+        Path to a Kraken report.
+    distr : scipy.sparse.csr_matrix
+        kmer distribution, as read by read_kmer_distribution
+    levels : list of str
+        levels to re-estimate counts at, e.g. ['phylum', 'species']
+    stem : str
+        Path prefix of the output files, which are named
+        {stem}.redist.{level}.txt, each with a binary sidecar.
+    threshold : int (optional)
+        minimum number of reads for a TaxID at a level to be kept
+
+    Returns
+    -------
+    list of str
+        paths to the output files
+    """
+    report, parent = _read_report_tree(file_report)
+    files = []
+    for level in levels:
+        table = estimate_abundance(report, parent, distr, level[0].upper(),
+                                   threshold)
+        file = '%s.redist.%s.txt' % (stem, level)
+        table.to_csv(file, sep='\t', index=False, float_format='%.5f')
+        write_sidecar(file, 'bracken')
+        files.append(file)
+    return files
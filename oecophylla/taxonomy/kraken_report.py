@@ -0,0 +1,197 @@
+import os
+import gzip
+import warnings
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from oecophylla.taxonomy.tree import load_taxonomy
+from oecophylla.util.seqio import read_blocks
+
+
+# rank codes of the hierarchical report, as written by kraken-report
+RANK_CODES = {'superkingdom': 'D', 'kingdom': 'K', 'phylum': 'P',
+              'class': 'C', 'order': 'O', 'family': 'F', 'genus': 'G',
+              'species': 'S'}
+
+
+def count_kraken(stream, file_map=None, blocksize=2**24):
+    """Counts reads per TaxID of a Kraken per-read output in one pass.
+
+    Parameters
+    ----------
+    stream : binary file-like object
+        Kraken per-read output (format: C/U<tab>read<tab>TaxID<tab>...), e.g.
+        the stdout of a running Kraken process.
+    file_map : str (optional)
+        Path to a gzip file to keep the per-read output in, while it is read.
+    blocksize : int (optional)
+        Number of bytes to read and parse at once.
+
+    Returns
+    -------
+    numpy.array of int
+        number of reads per TaxID, unclassified reads counted for TaxID 0
+    """
+    counts = np.zeros(0, dtype=np.int64)
+    out = None if file_map is None else gzip.open(file_map, 'wb',
+                                                  compresslevel=6)
+    try:
+        for block in read_blocks(stream, blocksize):
+            if out is not None:
+                out.write(block)
+            taxids = pd.read_csv(BytesIO(block), sep='\t', header=None,
+                                 usecols=[2], dtype=np.int64,
+                                 quoting=3).iloc[:, 0].values
+            block_counts = np.bincount(taxids)
+            if len(block_counts) > len(counts):
+                counts = np.concatenate(
+                    [counts, np.zeros(len(block_counts) - len(counts),
+                                      dtype=np.int64)])
+            counts[:len(block_counts)] += block_counts
+    finally:
+        if out is not None:
+            out.close()
+    return counts
+
+
+def _clade_counts(taxonomy, counts):
+    """Sums up read counts per TaxID over all descendants.
+
+    Reads of TaxIDs missing from the taxonomy are counted apart (and
+    returned last), with a warning.
+    """
+    taxids = np.flatnonzero(counts[1:]) + 1
+    current = taxonomy.current(taxids)
+    missing = current == 0
+    unknown = int(counts[taxids[missing]].sum())
+    if missing.any():
+        shown = ', '.join(str(x) for x in taxids[missing][:10])
+        if missing.sum() > 10:
+            shown += ', ...'
+        warnings.warn('%d read(s) of %d TaxID(s) missing from the taxonomy '
+                      'are counted as unclassified: %s'
+                      % (unknown, missing.sum(), shown))
+    direct = {}
+    for node, count in zip(current[~missing].tolist(),
+                           counts[taxids[~missing]].tolist()):
+        direct[node] = direct.get(node, 0) + count
+
+    # collect all ancestors of the counted TaxIDs
+    parent = taxonomy.parent
+    nodes = np.array(sorted(direct), dtype=np.int64)
+    keep = set(nodes.tolist())
+    frontier = nodes
+    while len(frontier) > 0:
+        frontier = np.unique(parent[frontier])
+        frontier = np.array([x for x in frontier.tolist()
+                             if x != 0 and x not in keep], dtype=np.int64)
+        keep.update(frontier.tolist())
+
+    # add counts to parents, starting from the deepest TaxIDs
+    clade = dict.fromkeys(keep, 0)
+    clade.update(direct)
+    for node in sorted(keep, key=lambda x: -taxonomy.depth[x]):
+        up = int(parent[node])
+        if up != node and up != 0:
+            clade[up] += clade[node]
+    return direct, clade, unknown
+
+
+def _walk(taxonomy, clade):
+    """Yields (TaxID, depth) of counted TaxIDs in depth-first order."""
+    children = {}
+    for node in clade:
+        up = int(taxonomy.parent[node])
+        if up != node and up != 0:
+            children.setdefault(up, []).append(node)
+    roots = [node for node in clade if int(taxonomy.parent[node]) in
+             (node, 0)]
+
+    stack = [(node, 0) for node in
+             sorted(roots, key=lambda x: (clade[x], -x))]
+    while stack:
+        node, depth = stack.pop()
+        yield node, depth
+        # children with most reads first, hence pushed last
+        stack.extend((child, depth + 1) for child in
+                     sorted(children.get(node, []),
+                            key=lambda x: (clade[x], -x)))
+
+
+def summarize_kraken(stream, taxonomy, file_report, file_mpa, file_map=None):
+    """Writes the Kraken report and MPA style profile in one pass.
+
+    Replaces running kraken-report and kraken-mpa-report (and gzip) on the
+    per-read output of Kraken, each of which reads it again. As with these,
+    reads of TaxIDs missing from the taxonomy (e.g. of a database slightly
+    out of sync with its taxonomy) do not fail the sample. They are counted
+    as unclassified, with a warning.
+
+    Parameters
+    ----------
+    stream : binary file-like object
+        Kraken per-read output.
+    taxonomy : Taxonomy
+        NCBI taxonomy of the Kraken database.
+    file_report : str
+        Path to write the hierarchical report to (as kraken-report).
+    file_mpa : str
+        Path to write the lineage to count table to (as kraken-mpa-report).
+    file_map : str (optional)
+        Path to keep the gzip compressed per-read output in.
+
+    Returns
+    -------
+    int
+        number of reads
+    """
+    counts = count_kraken(stream, file_map)
+    total = int(counts.sum())
+    direct, clade, unknown = _clade_counts(taxonomy, counts)
+    unclassified = (int(counts[0]) if len(counts) else 0) + unknown
+
+    nodes = list(clade)
+    names = dict(zip(nodes, taxonomy.names(nodes) if nodes else []))
+    ranks = {node: taxonomy.ranks[taxonomy.rank[node]] for node in nodes}
+
+    with open(file_report, 'w') as report, open(file_mpa, 'w') as mpa:
+        report.write('%6.2f\t%d\t%d\t%s\t%d\t%s%s\n' % (
+            unclassified * 100 / total if total else 0, unclassified,
+            unclassified, 'U', 0, '', 'unclassified'))
+        lineage = []
+        for node, depth in _walk(taxonomy, clade):
+            name = names[node] or ''
+            code = RANK_CODES.get(ranks[node], '-')
+            report.write('%6.2f\t%d\t%d\t%s\t%d\t%s%s\n' % (
+                clade[node] * 100 / total, clade[node],
+                direct.get(node, 0), code, node, '  ' * depth, name))
+
+            # lineage of major ranks above this TaxID
+            lineage = [x for x in lineage if x[0] < depth]
+            if code != '-':
+                lineage.append((depth, '%s__%s' % (code.lower(),
+                                                   name.replace(' ', '_'))))
+                mpa.write('%s\t%d\n' % ('|'.join(x[1] for x in lineage),
+                                        clade[node]))
+    return total
+
+
+def load_kraken_taxonomy(db, cache_dir=None):
+    """Loads the NCBI taxonomy of a Kraken database.
+
+    Parameters
+    ----------
+    db : str
+        Path to the Kraken database.
+    cache_dir : str (optional)
+        Directory to cache the parsed taxonomy in.
+
+    Returns
+    -------
+    Taxonomy
+    """
+    return load_taxonomy(os.path.join(db, 'taxonomy', 'nodes.dmp'),
+                         os.path.join(db, 'taxonomy', 'names.dmp'),
+                         cache_dir=cache_dir)
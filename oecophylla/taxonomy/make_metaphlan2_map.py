@@ -1,10 +1,20 @@
+import os
 import os.path
+import re
 import sys
+import bz2
+import json
+import hashlib
 import urllib.request
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
 import pandas as pd
 
 
-def read_taxid_list(filename, _dict=None):
+def read_taxid_list(filename, _dict=None, index_dir=None):
     """ Read a taxID list file.
 
     A taxID list file consists of three tab separated columns: 1. ID type,
@@ -18,18 +28,26 @@ def read_taxid_list(filename, _dict=None):
     _dict : dict
         Optional. Provide an existing dictionary into which parsed results
         should be added. Useful if the taxID list consists of several files.
+    index_dir : str
+        Optional. Instead of parsing the file into dicts, load it from a
+        compact index in this directory, which is built on first use. See
+        load_taxid_index.
 
     Returns
     -------
     A dict of dict. First dict's keys are the sequence types, e.g. "gi",
     "GeneID", "NC". Second level keys are the sequence IDs and their values are
     the according NCBI taxonomy IDs, or taxIDs for short.
+    (a read-only TaxidIndex if index_dir is given)
 
     Raises
     ------
     ValueError
         If a line does not contain of exactly three tab delimited fields.
     """
+    if index_dir is not None:
+        return load_taxid_index(filename, index_dir)
+
     if _dict is None:
         _dict = dict()
     f = open(filename, 'r')
@@ -49,7 +67,218 @@ def read_taxid_list(filename, _dict=None):
     return _dict
 
 
-def read_metaphlan_markers_info(filename):
+class TaxidMap(Mapping):
+    """Read-only map of sequence IDs to taxIDs of one sequence type.
+
+    Backed by a sorted array of sequence IDs (as bytes) and an array of
+    taxIDs in the same order, both possibly memory-mapped. Single sequence
+    IDs are looked up by binary search and their taxIDs returned as str,
+    like the values of the dicts built by read_taxid_list.
+    """
+
+    def __init__(self, keys, taxids):
+        self._keys = keys
+        self._taxids = taxids
+
+    def _find(self, accessions):
+        accessions = np.asarray(accessions, dtype=bytes)
+        if len(self._keys) == 0:
+            return (np.zeros(accessions.shape, dtype=np.int64),
+                    np.zeros(accessions.shape, dtype=bool))
+        idx = np.searchsorted(self._keys, accessions)
+        idx[idx == len(self._keys)] = 0
+        return idx, self._keys[idx] == accessions
+
+    def lookup(self, accessions):
+        """Looks up the taxIDs of many sequence IDs at once.
+
+        Parameters
+        ----------
+        accessions : iterable of str
+            sequence IDs
+
+        Returns
+        -------
+        tuple of (numpy.array of int, numpy.array of bool)
+            taxIDs and whether each sequence ID was found. TaxIDs of
+            sequence IDs not found are undefined.
+        """
+        idx, found = self._find([x.encode() for x in accessions])
+        return np.asarray(self._taxids[idx]), found
+
+    def __getitem__(self, accession):
+        idx, found = self._find([accession.encode()])
+        if not found[0]:
+            raise KeyError(accession)
+        return str(self._taxids[idx[0]])
+
+    def __iter__(self):
+        return (x.decode() for x in self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class TaxidIndex(Mapping):
+    """Read-only map of sequence types to TaxidMaps."""
+
+    def __init__(self, maps):
+        self.maps = maps
+
+    def __getitem__(self, _type):
+        return self.maps[_type]
+
+    def __iter__(self):
+        return iter(self.maps)
+
+    def __len__(self):
+        return len(self.maps)
+
+
+def _file_stats(filenames):
+    stats = []
+    for filename in filenames:
+        st = os.stat(filename)
+        stats.append([os.path.abspath(filename), st.st_size, st.st_mtime_ns])
+    return stats
+
+
+def build_taxid_index(filenames, index_dir):
+    """ Builds a compact index of one or several taxID list files.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Paths to the files containing the taxID list, see read_taxid_list.
+        For sequence IDs listed more than once, the last taxID is used.
+    index_dir : str
+        Path to the directory to store the index into.
+
+    Raises
+    ------
+    ValueError
+        If a line does not contain of exactly three tab delimited fields,
+        or a taxID is not an integer.
+
+    Notes
+    -----
+    For every sequence type, the index holds two NumPy arrays: the sorted
+    sequence IDs as fixed width bytes, and the taxIDs as int64.
+    """
+    tables = []
+    for filename in filenames:
+        try:
+            table = pd.read_csv(filename, sep='\t', header=None, skiprows=1,
+                                names=['type', 'accession', 'taxid'],
+                                dtype=str, keep_default_na=False,
+                                na_values=[''])
+        except pd.errors.ParserError:
+            raise ValueError("Error parsing file '%s'" % filename)
+        if table.isnull().values.any():
+            raise ValueError("Error parsing line '%s' of file '%s'" % (
+                '\t'.join(table[table.isnull().any(axis=1)].iloc[0]
+                          .fillna('').values), filename))
+        tables.append(table)
+    table = pd.concat(tables, ignore_index=True).drop_duplicates(
+        ['type', 'accession'], keep='last')
+    try:
+        table['taxid'] = table['taxid'].astype(np.int64)
+    except ValueError:
+        raise ValueError('TaxIDs must be integers')
+
+    # files are replaced atomically, and the meta file last, as other jobs
+    # may have the index memory-mapped, or load it at the same time
+    os.makedirs(index_dir, exist_ok=True)
+    types = []
+    for i, (_type, group) in enumerate(table.groupby('type', sort=True)):
+        keys = np.array([x.encode() for x in group['accession']])
+        order = np.argsort(keys, kind='stable')
+        for name, array in (('keys', keys[order]),
+                            ('taxids', group['taxid'].values[order])):
+            fp_array = os.path.join(index_dir, '%d.%s.npy' % (i, name))
+            with open(fp_array + '.%d.tmp' % os.getpid(), 'wb') as f:
+                np.save(f, array)
+            os.replace(f.name, fp_array)
+        types.append(_type)
+
+    fp_meta = os.path.join(index_dir, 'index.json')
+    with open(fp_meta + '.%d.tmp' % os.getpid(), 'w') as f:
+        json.dump({'sources': _file_stats(filenames), 'types': types}, f)
+    os.replace(f.name, fp_meta)
+
+
+def load_taxid_index(filenames, index_dir):
+    """ Loads the taxID index of taxID list files, building it if needed.
+
+    Parameters
+    ----------
+    filenames : str or list of str
+        Paths to the files containing the taxID list, see read_taxid_list.
+    index_dir : str
+        Path to the directory holding the index. It is (re-)built if missing
+        or if any of the files changed since.
+
+    Returns
+    -------
+    TaxidIndex
+        with memory-mapped arrays, behaving like the dict of dict returned by
+        read_taxid_list.
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    fp_meta = os.path.join(index_dir, 'index.json')
+    meta = None
+    if os.path.exists(fp_meta):
+        with open(fp_meta, 'r') as f:
+            meta = json.load(f)
+    if meta is None or meta['sources'] != _file_stats(filenames):
+        build_taxid_index(filenames, index_dir)
+        with open(fp_meta, 'r') as f:
+            meta = json.load(f)
+
+    maps = {}
+    for i, _type in enumerate(meta['types']):
+        maps[_type] = TaxidMap(*[np.load(os.path.join(
+            index_dir, '%d.%s.npy' % (i, x)), mmap_mode='r')
+            for x in ('keys', 'taxids')])
+    return TaxidIndex(maps)
+
+
+# marker IDs of the three sequence sources, and the clade of a marker
+_MARKER_ID = re.compile(r"gi\|([^|\t\n]*)|GeneID:([^:\t\n]*)|(NC_[^\t\n]*)")
+_MARKER_CLADE = re.compile(r"'clade': '([^']*)'")
+
+
+def _parse_markers_info(lines):
+    """Parses lines of the MetaPhlAn markers_info.txt file into a dict of
+    clade: {type: set of accessions}."""
+    clades = {}
+    for line in lines:
+        match = _MARKER_ID.match(line)
+        if match is None:
+            continue
+        gi, geneid, nc = match.groups()
+        if gi is not None:
+            type_ids, accession = 'gi', gi
+        elif geneid is not None:
+            type_ids, accession = 'GeneID', geneid
+        else:
+            type_ids, accession = 'NC', nc
+        clade = _MARKER_CLADE.search(line).group(1)
+        clades.setdefault(clade, {}).setdefault(type_ids, set()).add(
+            accession)
+    return clades
+
+
+def _chunks(lines, size):
+    while True:
+        chunk = list(islice(lines, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_metaphlan_markers_info(filename, threads=1, chunksize=100000):
     """ Reads the MetaPhlAn markers_info.txt file.
 
     MetaPhlAn's OTU analogous are 'clades'. Currently, they have around 8900.
@@ -60,7 +289,12 @@ def read_metaphlan_markers_info(filename):
     Parameters
     ----------
     filename : str
-        Path to the filename 'markers_info' of MetaPhlAn.
+        Path to the filename 'markers_info' of MetaPhlAn. A file ending in
+        '.bz2' is decompressed while being read.
+    threads : int
+        Optional. Number of processes parsing chunks of lines in parallel.
+    chunksize : int
+        Optional. Number of lines per chunk.
 
     Returns
     -------
@@ -70,34 +304,30 @@ def read_metaphlan_markers_info(filename):
     's__Escherichia_phage_vB_EcoP_G7C': {'GeneID': {'11117645', '11117646'}}
     """
     clades = {}
-    file = open(filename, 'r')
-    for line in file:
-        if line.startswith('gi|'):
-            type_ids = 'gi'
-            accession = line.split('\t')[0].split('|')[1]
-        elif line.startswith('GeneID:'):
-            type_ids = 'GeneID'
-            accession = line.split('\t')[0].split(':')[1]
-        elif line.startswith('NC_'):
-            type_ids = 'NC'
-            accession = line.split('\t')[0]
-        else:
-            type_ids = None
-            accession = None
-
-        if (type_ids is not None) and (accession is not None):
-            clade = line.split("clade': '")[1].split("'")[0]
-            if clade not in clades:
-                clades[clade] = {}
-            if type_ids not in clades[clade]:
-                clades[clade][type_ids] = {}
-            clades[clade][type_ids][accession] = True
 
-    for clade in clades:
-        for type_id in clades[clade]:
-            clades[clade][type_id] = set(clades[clade][type_id].keys())
-
-    file.close()
+    def merge(part):
+        for clade, types in part.items():
+            for type_ids, accessions in types.items():
+                clades.setdefault(clade, {}).setdefault(
+                    type_ids, set()).update(accessions)
+
+    _open = bz2.open if filename.endswith('.bz2') else open
+    with _open(filename, 'rt') as file:
+        chunks = _chunks(file, chunksize)
+        if threads <= 1:
+            for chunk in chunks:
+                merge(_parse_markers_info(chunk))
+            return clades
+
+        # keep a few chunks per process in flight while streaming the file
+        with ProcessPoolExecutor(max_workers=threads) as pool:
+            futures = deque()
+            for chunk in chunks:
+                futures.append(pool.submit(_parse_markers_info, chunk))
+                if len(futures) > 2 * threads:
+                    merge(futures.popleft().result())
+            for future in futures:
+                merge(future.result())
     return clades
 
 
@@ -149,6 +379,47 @@ def read_ncbi_merged(filename):
     return _read_ncbitaxonomy_file(filename)
 
 
+def resolve_merged(updatedTaxids):
+    """ Resolves chains of merged taxIDs, e.g. A -> B -> C into A -> C.
+
+    Parameters
+    ----------
+    updatedTaxids : dict
+        Content of merged.dmp in form of a dict where key is current taxID and
+        value the new taxID
+
+    Returns
+    -------
+    A dict of the same keys, where values are the final taxIDs, which are not
+    merged any further.
+
+    Raises
+    ------
+    ValueError
+        If merges are cyclic.
+
+    Notes
+    -----
+    All chains are resolved at once by pointer jumping over sorted arrays,
+    which halves the length of every remaining chain in each step.
+    """
+    old = np.array(list(updatedTaxids.keys()), dtype=np.int64)
+    new = np.array(list(updatedTaxids.values()), dtype=np.int64)
+    order = np.argsort(old)
+    old, new = old[order], new[order]
+    if len(old):
+        for _ in range(64):
+            idx = np.searchsorted(old, new)
+            idx[idx == len(old)] = 0
+            hit = old[idx] == new
+            if not hit.any():
+                break
+            new = np.where(hit, new[idx], new)
+        else:
+            raise ValueError('Cyclic merges of taxIDs')
+    return dict(zip(map(str, old), map(str, new)))
+
+
 def update_taxids(input, updatedTaxids):
     """ Updates a map of sequenceIDs to taxIDs with information from merged.dmp
 
@@ -170,7 +441,29 @@ def update_taxids(input, updatedTaxids):
     Returns
     -------
     The original map, but some taxIDs might have been updated.
+    (a new TaxidIndex if input is a TaxidIndex)
+
+    Notes
+    -----
+    Chains of merges are followed to the final taxID, see resolve_merged.
     """
+    updatedTaxids = resolve_merged(updatedTaxids)
+    if isinstance(input, TaxidIndex):
+        old = np.array(list(updatedTaxids.keys()), dtype=np.int64)
+        new = np.array(list(updatedTaxids.values()), dtype=np.int64)
+        order = np.argsort(old)
+        old, new = old[order], new[order]
+        maps = {}
+        for seqType, taxidmap in input.items():
+            taxids = np.array(taxidmap._taxids)
+            if len(old):
+                idx = np.searchsorted(old, taxids)
+                idx[idx == len(old)] = 0
+                hit = old[idx] == taxids
+                taxids[hit] = new[idx[hit]]
+            maps[seqType] = TaxidMap(taxidmap._keys, taxids)
+        return TaxidIndex(maps)
+
     for seqType in input:
         for seqID in input[seqType]:
             cur_taxid = input[seqType][seqID]
@@ -179,7 +472,21 @@ def update_taxids(input, updatedTaxids):
     return input
 
 
-def generate_map_metaphlan2_ncbitaxids(filename_map, latest_mergeddump=None):
+def _inputs_hash(filenames):
+    """Computes one MD5 checksum over the contents of several files."""
+    md5 = hashlib.md5()
+    for filename in filenames:
+        md5.update(os.path.basename(filename).encode())
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+
+def generate_map_metaphlan2_ncbitaxids(filename_map, latest_mergeddump=None,
+                                       filename_markers=None,
+                                       filename_taxids='metaphlan2_taxids.txt',
+                                       threads=1):
     """Creates an ID map from metaphlan2 to NCBI taxonomy IDs.
 
     For every metaphlan2 database, we once need to create a map from their
@@ -208,50 +515,90 @@ def generate_map_metaphlan2_ncbitaxids(filename_map, latest_mergeddump=None):
         Filepath to "merged.dmp" file of a NCBI taxonomy dump. TaxIDs might
         have changed between this dump and the generation of the file
         "metaphlan2_taxids.txt", thus these IDs need to be updated.
+    filename_markers : str
+        Filepath to metaphlan2's "markers_info.txt", which may still be
+        compressed as '.bz2'. Default: "markers_info.txt.bz2" if it exists,
+        otherwise "markers_info.txt".
+    filename_taxids : str
+        Filepath to "metaphlan2_taxids.txt", downloaded if missing.
+    threads : int
+        Number of processes parsing the "markers_info.txt" file.
+
+    Returns
+    -------
+    bool
+        False if the map was up to date, i.e. it had been generated from
+        input files of the same contents, True otherwise.
     """
 
-    filename_metaphlan2_marker = "markers_info.txt"
+    filename_metaphlan2_marker = filename_markers
+    if filename_metaphlan2_marker is None:
+        filename_metaphlan2_marker = "markers_info.txt"
+        if os.path.exists(filename_metaphlan2_marker + '.bz2'):
+            filename_metaphlan2_marker += '.bz2'
     if not os.path.exists(filename_metaphlan2_marker):
         sys.stderr.write(
             ('The "markers_info.txt" file from metaphlan2 is missing. Please '
              'browse to https://bitbucket.org/biobakery/metaphlan2/raw/f19f7c'
              'fdc990aa9f2d9837a89bcc5188912c8a82/utils/markers_info.txt.bz2 d'
-             'ownload and extract the file and try again.'))
+             'ownload the file and try again.'))
 
-    filename_taxids = 'metaphlan2_taxids.txt'
     if not os.path.exists(filename_taxids):
         urllib.request.urlretrieve(
             ("https://raw.githubusercontent.com/sjanssen2/ggmap/master/"
              "Cache/taxids_metaphlan.txt"),
             filename_taxids)
 
+    # skip if the map was generated from the very same inputs
+    inputs = [filename_metaphlan2_marker, filename_taxids]
+    if latest_mergeddump is not None:
+        inputs.append(latest_mergeddump)
+    inputs_hash = _inputs_hash(inputs)
+    filename_hash = filename_map + '.md5'
+    if os.path.exists(filename_map) and os.path.exists(filename_hash):
+        with open(filename_hash, 'r') as f:
+            if f.read().strip() == inputs_hash:
+                return False
+
     # reads a precompiled map of taxIDs for every sequence used in creating
     # metaphlans database
-    taxids_metaphlan = read_taxid_list(filename_taxids)
+    taxids_metaphlan = read_taxid_list(filename_taxids,
+                                       index_dir=filename_taxids + '.index')
 
     # reads the markers_info.txt file shipped with metaphlan which defines of
     # which sequences a metahplan clade is composed
-    clades_metaphlan = read_metaphlan_markers_info(filename_metaphlan2_marker)
+    clades_metaphlan = read_metaphlan_markers_info(filename_metaphlan2_marker,
+                                                   threads=threads)
 
     if latest_mergeddump is not None:
         merged = read_ncbi_merged(latest_mergeddump)
         # update taxonomy IDs for metaphlan sequences
         taxids_metaphlan = update_taxids(taxids_metaphlan, merged)
 
-    # iterates over all metaphlan clades and translates the sequence IDs of the
-    # clade into NCBI taxonomy IDs
-    _map = []
-    for clade in sorted(clades_metaphlan.keys()):
-        taxids = set()
-        for _type in clades_metaphlan[clade].keys():
-            for _id in clades_metaphlan[clade][_type]:
-                taxids |= set([taxids_metaphlan[_type][_id]])
-        _map.append({'metaphlan2_clade': clade,
-                     'NCBI_taxids': ",".join(map(str, sorted(taxids)))})
+    # translates the sequence IDs of all metaphlan clades into NCBI taxonomy
+    # IDs, looking up all sequence IDs of one type at once
+    clade_taxids = {clade: set() for clade in clades_metaphlan}
+    types = set(_type for clade in clades_metaphlan.values()
+                for _type in clade)
+    for _type in sorted(types):
+        pairs = [(clade, _id) for clade, ids in clades_metaphlan.items()
+                 for _id in ids.get(_type, ())]
+        taxids, found = taxids_metaphlan[_type].lookup(
+            [_id for _, _id in pairs])
+        if not found.all():
+            raise KeyError(pairs[np.argmin(found)][1])
+        for (clade, _), taxid in zip(pairs, taxids):
+            clade_taxids[clade].add(str(taxid))
+    _map = [{'metaphlan2_clade': clade,
+             'NCBI_taxids': ",".join(sorted(clade_taxids[clade]))}
+            for clade in sorted(clade_taxids)]
     _map = pd.DataFrame(_map)[['metaphlan2_clade', 'NCBI_taxids']]
 
     # write the resulting map into a tab separated file
     _map.to_csv(filename_map, sep="\t", index=False)
+    with open(filename_hash, 'w') as f:
+        f.write(inputs_hash + '\n')
+    return True
 
 
 if __name__ == '__main__':
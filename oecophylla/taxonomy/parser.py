@@ -1,9 +1,296 @@
+import os
+import json
+import hashlib
+import resource
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import BytesIO
+from zipfile import BadZipFile
+
+import numpy as np
 import pandas as pd
 import biom
+import h5py
 from biom.util import biom_open
+from pandas.api.types import union_categoricals
+from scipy.sparse import coo_matrix, csr_matrix, hstack, issparse
 
 
-def combine_profiles(profiles):
+def _read_profile(file, name):
+    """Reads a profile (format: feature<tab>count) into a Pandas.Series."""
+    return pd.read_table(file, index_col=0, names=[name],
+                         comment='#').iloc[:, 0]
+
+
+def _read_centrifuge(file, name):
+    """Reads TaxIDs and read counts of a Centrifuge output file."""
+    return pd.read_table(file, index_col=0, header=0, usecols=[1, 4],
+                         names=[None, name]).iloc[:, 0]
+
+
+def _read_bracken(file, name):
+    """Reads TaxIDs and re-estimated read counts of a Bracken output file."""
+    sample_abund = pd.read_csv(file, sep='\t', index_col=1)
+
+    # we are collecting the bracken estimated kraken assigned read numbers
+    sample_counts = sample_abund['new_est_reads']
+
+    # infer sample name from filename and remove file extension if present
+    sample_counts.name = name
+    return sample_counts
+
+
+def _read_kraken_report(file, name):
+    """Reads read counts and level codes per TaxID of a Kraken report."""
+    # a Kraken report file is a table of six columns, the 2nd, 4th and 5th of
+    # which are number of reads covered, level code, and TaxID
+    report = pd.read_table(file, usecols=[1, 3, 4],
+                           names=[name, 'lv', 'tid'], index_col='tid',
+                           dtype={name: np.int64, 'lv': 'category',
+                                  'tid': np.int64})
+    report.index.name = None
+    return report
+
+
+_READERS = {'profile': _read_profile,
+            'centrifuge': _read_centrifuge,
+            'bracken': _read_bracken,
+            'kraken': _read_kraken_report}
+
+_FORMATS = {reader: fmt for fmt, reader in _READERS.items()}
+
+SIDECAR_EXT = '.npz'
+
+
+def write_sidecar(file, fmt='profile'):
+    """Writes a binary copy of a per-sample output next to it.
+
+    Parameters
+    ----------
+    file : str
+        path to a per-sample output file
+    fmt : str (optional)
+        format of the file: "profile" (feature<tab>count), "centrifuge",
+        "bracken" or "kraken" (Kraken-style report) (default: "profile")
+
+    Returns
+    -------
+    str
+        path to the sidecar file
+
+    Notes
+    -----
+    The sidecar is an uncompressed NumPy .npz archive named after the file
+    (file + ".npz"), which holds the feature IDs and the counts as arrays
+    (plus the level codes of a Kraken-style report) and the format it was
+    parsed as. Loading it takes a fraction of the time needed to parse the
+    text file again. It is only used while it is newer than the text file,
+    and by a reader of the same format.
+    """
+    parsed = _READERS[fmt](file, 'counts')
+    counts, arrays = parsed, {'fmt': np.array([fmt])}
+    if isinstance(parsed, pd.DataFrame):
+        counts = parsed.iloc[:, 0]
+        arrays['lv'] = np.asarray(parsed['lv'], dtype=str)
+    index = counts.index
+    arrays['index'] = index.values.astype(str) if index.dtype == object \
+        else index.values
+    if index.name is not None:
+        arrays['index_name'] = np.array([index.name])
+    arrays['values'] = counts.values
+
+    sidecar = file + SIDECAR_EXT
+    with open(sidecar + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(sidecar + '.tmp', sidecar)
+    return sidecar
+
+
+def _read_sidecar(file, name, fmt=None):
+    """Reads a sidecar written by write_sidecar as parsed by its reader.
+
+    Returns None if the sidecar is unreadable, or was not written for fmt.
+    """
+    try:
+        with np.load(file, allow_pickle=False) as npz:
+            if fmt is not None and \
+                    ('fmt' not in npz or str(npz['fmt'][0]) != fmt):
+                return None
+            index = npz['index']
+            if index.dtype.kind == 'U':
+                index = index.astype(object)
+            index = pd.Index(index, name=str(npz['index_name'][0])
+                             if 'index_name' in npz else None)
+            counts = pd.Series(npz['values'], index=index, name=name)
+            if 'lv' not in npz:
+                return counts
+            lv = pd.Series(pd.Categorical(npz['lv'].astype(object)),
+                           index=index, name='lv')
+    except (OSError, ValueError, KeyError, BadZipFile):
+        return None
+    return pd.concat([counts, lv], axis=1)
+
+
+def _sidecar_fresh(file):
+    """Checks that the sidecar of a file is not older than the file."""
+    try:
+        return os.stat(file + SIDECAR_EXT).st_mtime_ns >= \
+            os.stat(file).st_mtime_ns
+    except OSError:
+        return False
+
+
+def _read_bytes(file):
+    with open(file, 'rb') as f:
+        return f.read()
+
+
+def _fetch(file, fmt):
+    """Reads the bytes of the up-to-date sidecar of fmt of a file, if there
+    is one, or else of the file, and whether they are the sidecar's."""
+    if fmt is not None and _sidecar_fresh(file):
+        try:
+            data = _read_bytes(file + SIDECAR_EXT)
+            with np.load(BytesIO(data), allow_pickle=False) as npz:
+                if 'fmt' in npz and str(npz['fmt'][0]) == fmt:
+                    return data, True
+        except (OSError, ValueError, BadZipFile):
+            pass
+    return _read_bytes(file), False
+
+
+def _parse_bytes(reader, data, name):
+    return reader(BytesIO(data), name)
+
+
+def load_profiles(profiles, reader=_read_profile, threads=1, processes=1):
+    """Loads per-sample files, overlapping file I/O and parsing.
+
+    Parameters
+    ----------
+    profiles : iterable((str, str))
+        An iterable of tuples, where the second component is the filepath
+        pointing to a per-sample file, while the first component defines a
+        sample name for the file.
+    reader : callable (optional)
+        function parsing one file, called as reader(file, name)
+        (default: read a feature<tab>count profile)
+    threads : int (optional)
+        number of threads prefetching file contents (default: 1)
+    processes : int (optional)
+        number of processes parsing prefetched contents (default: 1)
+
+    Yields
+    ------
+    tuple of (str, object)
+        sample name and the parsed file, in the order of `profiles`
+
+    Notes
+    -----
+    With one thread and one process, files are read and parsed one after
+    the other. Otherwise, a thread pool reads the raw bytes of upcoming
+    files while they are being parsed, which hides per-file latency of
+    network storage, and a process pool parses them. At most a few files
+    per worker are held in memory at any time. The parsed results are
+    identical to the serial ones.
+
+    A file with an up-to-date binary sidecar (see write_sidecar), written
+    for the format of `reader`, is loaded from the sidecar instead of being
+    parsed. Sidecars are probed by the threads prefetching files, and their
+    format is checked on the bytes read to load them.
+    """
+    fmt = _FORMATS.get(reader)
+
+    # prefer up-to-date binary sidecars over text files
+    if threads <= 1 and processes <= 1:
+        for name, file in profiles:
+            parsed = None
+            if fmt is not None and _sidecar_fresh(file):
+                parsed = _read_sidecar(file + SIDECAR_EXT, name, fmt)
+            yield name, reader(file, name) if parsed is None else parsed
+        return
+
+    # sidecars are probed by the prefetching threads, not up front
+    window = 2 * max(threads, processes)
+    items = iter(profiles)
+    fetched, parsed = deque(), deque()
+    io_pool = ThreadPoolExecutor(max_workers=max(threads, 1))
+    cpu_pool = ProcessPoolExecutor(max_workers=processes) \
+        if processes > 1 else None
+    try:
+        while True:
+            # keep the prefetch window full
+            while len(fetched) + len(parsed) < window:
+                item = next(items, None)
+                if item is None:
+                    break
+                name, file = item
+                fetched.append((name, io_pool.submit(_fetch, file, fmt)))
+
+            # hand the next prefetched file over for parsing
+            if fetched:
+                name, future = fetched.popleft()
+                data, is_sidecar = future.result()
+                parse = _read_sidecar if is_sidecar else reader
+                if cpu_pool is None:
+                    yield name, _parse_bytes(parse, data, name)
+                    continue
+                parsed.append((name, cpu_pool.submit(_parse_bytes, parse,
+                                                     data, name)))
+
+            if not parsed:
+                break
+            if len(parsed) >= processes or not fetched:
+                name, future = parsed.popleft()
+                yield name, future.result()
+    finally:
+        io_pool.shutdown(wait=True)
+        if cpu_pool is not None:
+            cpu_pool.shutdown(wait=True)
+
+
+def combine_sparse(samples):
+    """Combines per-sample feature counts into one sparse table.
+
+    Parameters
+    ----------
+    samples : iterable((str, Pandas.Series))
+        An iterable of tuples, where the second component holds the counts
+        of one sample indexed by feature, while the first component defines
+        the sample name.
+
+    Returns
+    -------
+    biom.Table with rows for features, columns for samples.
+
+    Notes
+    -----
+    Samples are consumed one at a time and only their non-zero counts are
+    kept, as COO triplets. Feature IDs are interned in a single dictionary
+    shared by all samples, which also defines the row order (order of
+    first appearance). Counts of features listed more than once in a sample
+    are summed. Memory is proportional to the number of non-zero cells.
+    """
+    fids = {}
+    names, rows, cols, data = [], [], [], []
+    for j, (name, counts) in enumerate(samples):
+        counts = counts[counts.notnull() & (counts != 0)]
+        rows.append(np.fromiter(
+            (fids.setdefault(f, len(fids)) for f in map(str, counts.index)),
+            dtype=np.int64, count=len(counts)))
+        cols.append(np.full(len(counts), j, dtype=np.int64))
+        data.append(counts.values.astype(float))
+        names.append(name)
+
+    if names:
+        rows, cols, data = (np.concatenate(x) for x in (rows, cols, data))
+    mat = coo_matrix((data, (rows, cols)),
+                     shape=(len(fids), len(names))).tocsr()
+    return biom.Table(mat, observation_ids=list(fids), sample_ids=names)
+
+
+def combine_profiles(profiles, sparse=False, threads=1, processes=1):
     """Combines profiles for several samples into one table.
 
     Parameters
@@ -12,26 +299,36 @@ def combine_profiles(profiles):
         An iterable of tuples, where the second component is the filepath
         pointing to a profile (format: feature<tab>count), while the first
         component defines a sample name for the profile.
+    sparse : bool (optional)
+        stream the profiles into a sparse biom.Table instead of a dense
+        Pandas.DataFrame (default: False)
+    threads : int (optional)
+        number of threads prefetching files (default: 1)
+    processes : int (optional)
+        number of processes parsing files (default: 1)
 
     Returns
     -------
     Pandas.DataFrame with rows for features, columns for samples.
+    (biom.Table if sparse is True)
     """
-    samples = [pd.read_table(file, index_col=0, names=[name], comment='#')
-               for name, file in profiles]
+    samples = load_profiles(profiles, _read_profile, threads, processes)
+    if sparse:
+        return combine_sparse(samples)
+    samples = [sample for name, sample in samples]
     return pd.concat(samples, axis=1).fillna(0).astype(float)
 
 
-def extract_level(table, code, delim=';', dic=None):
-    """Extract features at certain level from a table.
+def extract_levels(table, codes, delim=';', dic=None):
+    """Extract features at several levels from a table in one pass.
 
     Parameters
     ----------
-    table : Pandas.DataFrame
+    table : Pandas.DataFrame or biom.Table
         with rows for features, columns for samples
         fearures are Greengenes-style lineage strings
-    code : str
-        single-letter abbreviation of level
+    codes : iterable of str
+        single-letter abbreviations of levels
     delim : str (optional)
         delimiter for levels in lineage string (default: ";")
     dic : dict (optional)
@@ -39,45 +336,104 @@ def extract_level(table, code, delim=';', dic=None):
 
     Returns
     -------
-    Pandas.DataFrame
-        with features replaced by individual ranks
+    dict of str : Pandas.DataFrame (biom.Table if table is a biom.Table)
+        level code : table with features replaced by individual ranks
 
     Raises
     ------
     ValueError
-        if there are duplicated rank names at current level
+        if there are duplicated rank names at any requested level
 
     Notes
     -----
+    The last (right-most) rank of every lineage is split off only once and
+    shared by all levels, and only the rows of each level are copied.
     Rank names not found in the dictionary will be dropped.
     Duplicated TaxIDs are allowed. They will be merged and their cell values
-    will be summed.
+    will be summed. The rows of a biom.Table are merged on its sparse
+    matrix, so that it is never densified.
     """
-    df = table.copy()
+    is_biom = isinstance(table, biom.Table)
+    ids = table.ids(axis='observation') if is_biom else table.index
+
+    # get last (right-most) rank of lineage and its level code
+    ranks = pd.Series(ids, dtype=object).str.rsplit(delim, n=1).str.get(-1)
+    lvs = ranks.str[:1]
+
+    # only keep ranks with explicit name
+    named = ((ranks.str.len() > 3) & (ranks.str[1:3] == '__')
+             & ~ranks.str.endswith('_noname')).values
+
+    res = {}
+    for code in codes:
+        mask = named & (lvs == code).values
+        index = pd.Index(ranks.values[mask])
+
+        # check for duplicated rank names
+        if index.duplicated().any():
+            raise ValueError('Duplicated taxa detected')
+        if is_biom:
+            res[code] = _extract_rows(table, mask, index, dic)
+            continue
+        df = table[mask]
+        df.index = index
+
+        # translate rank names into TaxIDs
+        if dic is not None:
+            df = df.groupby(index.map(dic)).sum()
+        df.index.name = None
+        res[code] = df
+    return res
+
+
+def _extract_rows(table, mask, index, dic=None):
+    """Selects rows of a biom.Table, renamed (and merged) by rank."""
+    data = table.matrix_data.tocsr()[np.flatnonzero(mask)]
+    if dic is not None:
+        # sum rows of the same TaxID, as groupby would (sorted, without NaN)
+        tids = index.map(dic)
+        known = np.flatnonzero(tids.notnull())
+        codes, index = pd.factorize(tids[known], sort=True)
+        merge = csr_matrix((np.ones(len(known)), (codes, known)),
+                           shape=(len(index), data.shape[0]))
+        data = merge @ data
+    return biom.Table(data, observation_ids=list(index),
+                      sample_ids=table.ids())
 
-    # get last (right-most) rank of lineage get index of new column
-    i = len(df.columns)
-    df[i] = df.index.str.split(delim).str.get(-1)
 
-    # only keep given level with explicit name
-    df = df[(df[i].str.len() > 3)
-            & df[i].str.startswith('%s__' % code)
-            & ~df[i].str.endswith('_noname')]
+def extract_level(table, code, delim=';', dic=None):
+    """Extract features at certain level from a table.
 
-    # check for duplicated rank names
-    if df[i].duplicated().any():
-        raise ValueError('Duplicated taxa detected')
-    df.set_index(i, inplace=True)
+    Parameters
+    ----------
+    table : Pandas.DataFrame
+        with rows for features, columns for samples
+        fearures are Greengenes-style lineage strings
+    code : str
+        single-letter abbreviation of level
+    delim : str (optional)
+        delimiter for levels in lineage string (default: ";")
+    dic : dict (optional)
+        translate rank names into TaxIDs using this dictionary
 
-    # translate rank names into TaxIDs
-    if dic is not None:
-        df[i] = df.index.to_series().map(dic)
-        df = df.groupby(2).sum()
-    df.index.name = None
-    return df
+    Returns
+    -------
+    Pandas.DataFrame
+        with features replaced by individual ranks
 
+    Raises
+    ------
+    ValueError
+        if there are duplicated rank names at current level
+
+    See Also
+    --------
+    extract_levels
+    """
+    return extract_levels(table, [code], delim=delim, dic=dic)[code]
 
-def combine_kraken(kraken_reports):
+
+def combine_kraken(kraken_reports, sparse=False, threads=1, processes=1):
     """Combines Kraken-style reports for several samples into one table.
 
     Parameters
@@ -86,12 +442,20 @@ def combine_kraken(kraken_reports):
         An iterable of tuples, where the second component is the filepath
         pointing to a Kraken report file, the first component defines a
         sample name for the Kraken report.
+    sparse : bool (optional)
+        stream the reports into a sparse biom.Table instead of a dense
+        Pandas.DataFrame (default: False)
+    threads : int (optional)
+        number of threads prefetching files (default: 1)
+    processes : int (optional)
+        number of processes parsing files (default: 1)
 
     Returns
     -------
     tuple of (
         Pandas.DataFrame
             with rows for features, columns for samples
+            (biom.Table if sparse is True)
         dict of set of str
             level code : set of TaxIDs
     )
@@ -100,38 +464,48 @@ def combine_kraken(kraken_reports):
     -----
     A "Kraken-style report" is generated by Kraken and Centrifuge, and
     potentially other programs.
-    """
-    # a Kraken report file is a table of six columns, the 2nd, 4th and 5th of
-    # which are number of reads covered, level code, and TaxID
-    samples = [pd.read_table(file, usecols=[1, 3, 4], names=[name, 'lv', None],
-               index_col=2) for name, file in kraken_reports]
 
-    # for extended compatibility, convert TaxIDs to strings
-    for sample in samples:
-        sample.index = sample.index.map(str)
+    The level code of each TaxID is taken from the first sample reporting
+    it, as the reports are read, so that only one level code per TaxID is
+    kept.
+    """
+    seen = pd.Index([], dtype=np.int64)
+    lvs = []
+
+    def _counts():
+        nonlocal seen
+        for name, sample in load_profiles(kraken_reports, _read_kraken_report,
+                                          threads, processes):
+            new = ~sample.index.isin(seen)
+            seen = seen.append(sample.index[new])
+            lvs.append(sample['lv'].values[new])
+            yield name, sample.iloc[:, 0]
 
     # combine number of reads covered by each TaxID across samples
-    combined = pd.concat([x.iloc[:, 0] for x in samples],
-                         axis=1).fillna(0).astype(float)
+    if sparse:
+        combined = combine_sparse(_counts())
+    else:
+        combined = pd.concat([sample for name, sample in _counts()],
+                             axis=1).fillna(0).astype(float)
 
-    # get TaxID to level code map
-    tid2lv = pd.concat([x['lv'] for x in samples])
+        # for extended compatibility, convert TaxIDs to strings
+        combined.index = combined.index.map(str)
 
-    # replace D(omain) with K(ingdom)
-    tid2lv.replace('D', 'K', inplace=True)
+    # get TaxID to level code map
+    tid2lv = pd.Series(union_categoricals(lvs) if lvs else
+                       pd.Categorical([]), index=seen.map(str))
 
-    # summarize TaxIDs belonging to each level
+    # summarize TaxIDs belonging to each level, with D(omain) as K(ingdom)
     lv2tids = {}
-    for tid, code in tid2lv.iteritems():
-        if not code in lv2tids:
-            lv2tids[code] = set()
-        lv2tids[code].add(tid)
+    for lv, tids in tid2lv.groupby(tid2lv, observed=True).groups.items():
+        lv2tids.setdefault('K' if lv == 'D' else lv, set()).update(tids)
 
-    # return the combined DataFrame and the level to TaxIDs map
+    # return the combined table and the level to TaxIDs map
     return (combined, lv2tids)
 
 
-def combine_centrifuge(centrifuge_outputs):
+def combine_centrifuge(centrifuge_outputs, sparse=False, threads=1,
+                       processes=1):
     """Combines Centrifuge counts for several samples into one table.
 
     Parameters
@@ -140,22 +514,33 @@ def combine_centrifuge(centrifuge_outputs):
         An iterable of tuples, where the second component is the filepath
         pointing to a Centrifuge output file, the first component defines a
         sample name for the Centrifuge output.
+    sparse : bool (optional)
+        stream the outputs into a sparse biom.Table instead of a dense
+        Pandas.DataFrame (default: False)
+    threads : int (optional)
+        number of threads prefetching files (default: 1)
+    processes : int (optional)
+        number of processes parsing files (default: 1)
 
     Returns
     -------
     Pandas.DataFrame with rows for features, columns for samples.
+    (biom.Table if sparse is True)
 
     Notes
     -----
     A Centrifuge output file is a table of 7 columns, the 2nd and 5th of which
     are TaxID and number of reads assigned to it.
     """
-    samples = [pd.read_table(file, index_col=0, header=0, usecols=[1, 4],
-               names=[None, name]) for name, file in centrifuge_outputs]
+    samples = load_profiles(centrifuge_outputs, _read_centrifuge, threads,
+                            processes)
+    if sparse:
+        return combine_sparse(samples)
+    samples = [sample for name, sample in samples]
     return pd.concat(samples, axis=1).fillna(0).astype(float)
 
 
-def combine_bracken(bracken_outputs):
+def combine_bracken(bracken_outputs, sparse=False, threads=1, processes=1):
     """Combines bracken counts for several samples into one table.
 
     Parameters
@@ -164,54 +549,461 @@ def combine_bracken(bracken_outputs):
         An iterable of tuples, where the second component is the filepath
         pointing to a Bracken output file, the first component defines a
         sample name for the Bracken output.
+    sparse : bool (optional)
+        stream the outputs into a sparse biom.Table instead of a dense
+        Pandas.DataFrame (default: False)
+    threads : int (optional)
+        number of threads prefetching files (default: 1)
+    processes : int (optional)
+        number of processes parsing files (default: 1)
 
     Returns
     -------
     Pandas.DataFrame with rows for features, columns for samples.
     Feature labels are NCBI taxonomy IDs. Sample labels are obtained from first
     components of passed iterable.
+    (biom.Table if sparse is True)
 
     Notes
     -----
     More information about the bracken file format:
     https://ccb.jhu.edu/software/bracken/index.shtml?t=manual
     """
-    samples = []
     # walking over the given directory.
     # We don't know which files are actual bracken abundance estimation files.
-    for (samplename, _file) in bracken_outputs:
-        sample_abund = pd.read_csv(_file, sep='\t', index_col=1)
+    samples = load_profiles(bracken_outputs, _read_bracken, threads,
+                            processes)
+    if sparse:
+        return combine_sparse(samples)
+    samples = [sample for samplename, sample in samples]
 
-        # we are collecting the bracken estimated kraken assigned read numbers
-        sample_counts = sample_abund['new_est_reads']
+    # return a merged pd.DataFrame of all absolute estimated assigned reads
+    return pd.concat(samples, axis=1).fillna(0).astype(int)
 
-        # infer sample name from filename and remove file extension if present
-        sample_counts.name = samplename
 
-        # add resulting pd.Series to our collection of samples
-        samples.append(sample_counts)
+def _checksum(file):
+    """Computes the MD5 checksum of a file."""
+    md5 = hashlib.md5()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
 
-    # return a merged pd.DataFrame of all absolute estimated assigned reads
-    return pd.concat(samples, axis=1).fillna(0).astype(int)
 
+def _merge_samples(table, other):
+    """Appends the samples of a biom.Table to another one."""
+    fids = {x: i for i, x in enumerate(table.ids(axis='observation'))}
+    ofids = other.ids(axis='observation')
+    rows = np.fromiter((fids.setdefault(x, len(fids)) for x in ofids),
+                       dtype=np.int64, count=len(ofids))
+    a, b = table.matrix_data.tocoo(), other.matrix_data.tocoo()
+    n = len(table.ids())
+    mat = coo_matrix((np.concatenate([a.data, b.data]),
+                      (np.concatenate([a.row, rows[b.row]]),
+                       np.concatenate([a.col, b.col + n]))),
+                     shape=(len(fids), n + len(other.ids()))).tocsr()
+    return biom.Table(mat, observation_ids=list(fids),
+                      sample_ids=list(table.ids()) + list(other.ids()))
+
+
+def combine_incremental(profiles, state_dir, combine=combine_profiles,
+                        **kwargs):
+    """Combines per-sample files into a table, re-using a previous result.
+
+    Parameters
+    ----------
+    profiles : iterable((str, str))
+        An iterable of tuples, where the second component is the filepath
+        pointing to a per-sample file, while the first component defines a
+        sample name for the file.
+    state_dir : str or None
+        directory keeping the combined table and a manifest of the files it
+        was made of between runs, or None to combine all files from scratch
+    combine : callable (optional)
+        function combining per-sample files into a biom.Table, called as
+        combine(profiles, sparse=True, **kwargs) (default: combine_profiles)
+    kwargs : dict
+        further arguments passed to `combine`
+
+    Returns
+    -------
+    biom.Table with rows for features, columns for samples.
+
+    Notes
+    -----
+    A file whose size and modification time match the manifest is taken as
+    unchanged. Otherwise its checksum decides. Only new and changed files
+    are parsed and merged into the previous table, and samples which are
+    no longer given are removed from it. Samples are ordered as given.
+    Features are those of a table combined from scratch, though possibly
+    in a different order.
+
+    The state directory must not be a declared output of a Snakemake rule,
+    since Snakemake removes those before re-running a rule.
+    """
+    profiles = list(profiles)
+    if state_dir is None:
+        return combine(profiles, sparse=True, **kwargs)
+
+    fp_manifest = os.path.join(state_dir, 'manifest.json')
+    fp_table = os.path.join(state_dir, 'combined.biom')
+    manifest, table = {}, None
+    if os.path.isfile(fp_manifest) and os.path.isfile(fp_table):
+        try:
+            with open(fp_manifest, 'r') as f:
+                manifest = json.load(f)
+            table = biom.load_table(fp_table)
+        except (OSError, ValueError):
+            manifest, table = {}, None
+        # a table not matching its manifest is not trusted
+        if table is None or set(table.ids()) != set(manifest):
+            manifest, table = {}, None
+
+    entries, todo = {}, []
+    for name, file in profiles:
+        st = os.stat(file)
+        entry = manifest.get(name)
+        if entry is not None and entry[:3] == [file, st.st_size,
+                                               st.st_mtime_ns]:
+            entries[name] = entry
+            continue
+        checksum = _checksum(file)
+        entries[name] = [file, st.st_size, st.st_mtime_ns, checksum]
+        if entry is None or entry[3] != checksum:
+            todo.append((name, file))
+
+    # drop removed and changed samples from the previous table
+    done = set(entries).difference(name for name, _ in todo)
+    keep = [x for x in table.ids() if x in done] if table is not None else []
+    if keep:
+        table = table.filter(keep, axis='sample', inplace=False)
+        table = table.remove_empty(axis='observation', inplace=False)
+
+    # add new and changed samples
+    if todo:
+        new = combine(todo, sparse=True, **kwargs)
+        table = _merge_samples(table, new) if keep else new
+    elif not keep:
+        table = combine([], sparse=True, **kwargs)
+    table = table.sort_order([name for name, _ in profiles])
+
+    os.makedirs(state_dir, exist_ok=True)
+    pandas2biom(fp_table + '.tmp', table)
+    os.replace(fp_table + '.tmp', fp_table)
+    with open(fp_manifest + '.tmp', 'w') as f:
+        json.dump(entries, f)
+    os.replace(fp_manifest + '.tmp', fp_manifest)
+    return table
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process and its children.
+
+    Returns
+    -------
+    int
+        peak resident set size in bytes
+    """
+    # Linux reports kilobytes
+    return 1024 * max(resource.getrusage(x).ru_maxrss for x in (
+        resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def _blocks(samples, fids, max_nnz):
+    """Groups samples into sparse blocks of about max_nnz non-zero cells."""
+    names, rows, cols, data, nnz = [], [], [], [], 0
+    for name, counts in samples:
+        counts = counts[counts.notnull() & (counts != 0)]
+        rows.append(np.full(len(counts), len(names), dtype=np.int64))
+        cols.append(np.fromiter(
+            (fids.setdefault(f, len(fids)) for f in map(str, counts.index)),
+            dtype=np.int64, count=len(counts)))
+        data.append(counts.values.astype(float))
+        names.append(name)
+        nnz += len(counts)
+        if nnz >= max_nnz:
+            yield names, rows, cols, data
+            names, rows, cols, data, nnz = [], [], [], [], 0
+    if names:
+        yield names, rows, cols, data
+
+
+def _create_matrix(h5grp, axis, ids=None):
+    """Creates the resizable matrix datasets of one axis of a BIOM file."""
+    grp = h5grp.create_group(axis)
+    grp.create_group('metadata')
+    grp.create_group('group-metadata')
+    mat = grp.create_group('matrix')
+    for key, dtype in (('data', np.float64), ('indices', np.int32),
+                       ('indptr', np.int64)):
+        mat.create_dataset(key, shape=(0,), maxshape=(None,), dtype=dtype,
+                           chunks=(1 << 16,), compression='gzip')
+    _append(mat['indptr'], [0])
+    return mat
+
+
+def _append(dset, values):
+    n = dset.shape[0]
+    dset.resize((n + len(values),))
+    dset[n:] = values
+
+
+def _append_csr(mat, csr):
+    """Appends the rows of a CSR matrix to the matrix datasets of a BIOM
+    file."""
+    offset = mat['indptr'][-1]
+    _append(mat['data'], csr.data)
+    _append(mat['indices'], csr.indices)
+    _append(mat['indptr'], csr.indptr[1:] + offset)
+
+
+def _load(fp):
+    # memory-map spilled arrays, which np.load cannot do for empty ones
+    try:
+        return np.load(fp, mmap_mode='r')
+    except ValueError:
+        return np.load(fp)
+
+
+def _load_rows(prefix, n, m, a, b):
+    """Loads rows a to b of a spilled CSR block of n rows and m columns."""
+    lo, hi = min(a, n), min(b, n)
+    indptr = np.array(_load(prefix + '.indptr.npy')[lo:hi + 1])
+    start, end = indptr[0], indptr[-1]
+    data = np.array(_load(prefix + '.data.npy')[start:end])
+    indices = np.array(_load(prefix + '.indices.npy')[start:end])
+    # rows beyond the block (features first seen later) are empty
+    indptr = np.concatenate([indptr - start,
+                             np.full(b - a - (hi - lo), end - start)])
+    return csr_matrix((data, indices, indptr), shape=(b - a, m))
+
+
+def combine_out_of_core(profiles, file_biom, memory, fmt='profile',
+                        temp_dir=None, threads=1, processes=1):
+    """Combines per-sample files into a BIOM file within a memory budget.
+
+    Parameters
+    ----------
+    profiles : iterable((str, str))
+        An iterable of tuples, where the second component is the filepath
+        pointing to a per-sample file, while the first component defines a
+        sample name for the file.
+    file_biom : str
+        The filename of the BIOM file to be created.
+    memory : int
+        memory budget in bytes for the non-zero cells held at once
+    fmt : str (optional)
+        format of the per-sample files, see write_sidecar
+        (default: "profile")
+    temp_dir : str (optional)
+        directory to spill blocks to (default: system temporary directory)
+    threads : int (optional)
+        number of threads prefetching files (default: 1)
+    processes : int (optional)
+        number of processes parsing files (default: 1)
+
+    Returns
+    -------
+    tuple of int
+        shape of the combined table (features, samples)
+
+    Notes
+    -----
+    Samples are read in blocks of non-zero cells fitting the budget. Each
+    block is appended to the sample-major matrix of the BIOM file right
+    away, and spilled to disk in feature-major order. The feature-major
+    matrix is then written in ranges of features, each read back from all
+    spilled blocks through memory maps. Besides the blocks, only the
+    feature IDs and one counter per feature are held in memory.
+
+    The result is the same table as combine_sparse builds, written in the
+    BIOM 2.1 HDF5 format with chunked, compressed datasets.
+    """
+    max_nnz = max(memory // 64, 1)
+    samples = load_profiles(profiles, _READERS[fmt], threads, processes)
+    fids, names, blocks = {}, [], []
+    with tempfile.TemporaryDirectory(dir=temp_dir) as spill_dir, \
+            h5py.File(file_biom, 'w') as h5:
+        # sample-major matrix, written block by block
+        smat = _create_matrix(h5, 'sample')
+        for i, (bnames, rows, cols, data) in enumerate(
+                _blocks(samples, fids, max_nnz)):
+            block = coo_matrix(
+                (np.concatenate(data),
+                 (np.concatenate(rows), np.concatenate(cols))),
+                shape=(len(bnames), len(fids))).tocsr()
+            block.sort_indices()
+            _append_csr(smat, block)
+
+            # spill the block in feature-major order
+            block = block.T.tocsr()
+            block.sort_indices()
+            prefix = os.path.join(spill_dir, 'block%d' % i)
+            for key in ('data', 'indices', 'indptr'):
+                np.save('%s.%s.npy' % (prefix, key), getattr(block, key))
+            blocks.append((prefix, block.shape[0], len(bnames)))
+            names.extend(bnames)
+            del block
+
+        # count non-zero cells per feature, to split features into ranges
+        cum = np.zeros(len(fids) + 1, dtype=np.int64)
+        for prefix, n, _ in blocks:
+            cum[1:n + 1] += np.diff(_load(prefix + '.indptr.npy'))
+        cum = np.cumsum(cum)
+
+        # feature-major matrix, written range by range
+        omat = _create_matrix(h5, 'observation')
+        a = 0
+        while a < len(fids):
+            b = max(int(np.searchsorted(cum, cum[a] + max_nnz,
+                                        side='right')) - 1, a + 1)
+            part = hstack([_load_rows(prefix, n, m, a, b)
+                           for prefix, n, m in blocks], format='csr')
+            _append_csr(omat, part)
+            a = b
+
+        for axis, ids in (('observation', list(fids)), ('sample', names)):
+            h5[axis].create_dataset(
+                'ids', data=np.array(ids, dtype=object),
+                dtype=h5py.special_dtype(vlen=str))
+
+        h5.attrs['id'] = 'No Table ID'
+        h5.attrs['type'] = ''
+        h5.attrs['format-url'] = 'http://biom-format.org'
+        h5.attrs['format-version'] = (2, 1)
+        h5.attrs['generated-by'] = 'example'
+        h5.attrs['creation-date'] = pd.Timestamp.now().isoformat()
+        h5.attrs['shape'] = (len(fids), len(names))
+        h5.attrs['nnz'] = int(cum[-1])
+    return len(fids), len(names)
+
+
+def write_combined(file_biom, profiles, fmt='profile', state_dir=None,
+                   memory=None, temp_dir=None, threads=1, processes=1):
+    """Combines per-sample files into a BIOM file.
 
-def pandas2biom(file_biom, table):
+    Parameters
+    ----------
+    file_biom : str
+        The filename of the BIOM file to be created.
+    profiles : iterable((str, str))
+        An iterable of tuples, where the second component is the filepath
+        pointing to a per-sample file, while the first component defines a
+        sample name for the file.
+    fmt : str (optional)
+        format of the per-sample files: "profile", "centrifuge" or
+        "bracken" (default: "profile")
+    state_dir : str (optional)
+        combine incrementally, keeping state in this directory, see
+        combine_incremental
+    memory : int (optional)
+        combine out of core within this memory budget in bytes, see
+        combine_out_of_core; takes precedence over `state_dir`
+    temp_dir : str (optional)
+        directory to spill blocks to when combining out of core
+    threads : int (optional)
+        number of threads prefetching files (default: 1)
+    processes : int (optional)
+        number of processes parsing files (default: 1)
+
+    Returns
+    -------
+    Nothing
+    """
+    if memory:
+        combine_out_of_core(profiles, file_biom, memory, fmt=fmt,
+                            temp_dir=temp_dir, threads=threads,
+                            processes=processes)
+        return
+    combine = {'profile': combine_profiles,
+               'centrifuge': combine_centrifuge,
+               'bracken': combine_bracken}[fmt]
+    pandas2biom(file_biom, combine_incremental(
+        profiles, state_dir, combine, threads=threads, processes=processes))
+
+
+def _to_biom(table, observation_ids=None, sample_ids=None):
+    """Wraps a table into a biom.Table without densifying sparse data."""
+    if isinstance(table, biom.Table):
+        return table
+
+    if isinstance(table, pd.DataFrame):
+        if observation_ids is None:
+            observation_ids = list(map(str, table.index))
+        if sample_ids is None:
+            sample_ids = list(table.columns)
+        if len(table.columns) and all(isinstance(x, pd.SparseDtype)
+                                      for x in table.dtypes):
+            data = table.sparse.to_coo()
+        else:
+            data = table.values
+    elif issparse(table):
+        if observation_ids is None or sample_ids is None:
+            raise ValueError('Feature and sample IDs are required for a '
+                             'sparse matrix')
+        data = table
+    else:
+        raise TypeError('Unsupported table type: %s' % type(table).__name__)
+
+    return biom.Table(data, observation_ids=observation_ids,
+                      sample_ids=sample_ids)
+
+
+def pandas2biom(file_biom, table, observation_ids=None, sample_ids=None):
     """ Writes a Pandas.DataFrame into a biom file.
 
     Parameters
     ----------
     file_biom: str
         The filename of the BIOM file to be created.
-    table: a Pandas.DataFrame
-        The table that should be written as BIOM.
+    table: a Pandas.DataFrame, biom.Table or scipy.sparse matrix
+        The table that should be written as BIOM. Sparse matrices and
+        DataFrames with sparse columns are written without being densified.
+    observation_ids: list of str (optional)
+        Feature IDs, required for a scipy.sparse matrix (default: index of
+        the DataFrame)
+    sample_ids: list of str (optional)
+        Sample IDs, required for a scipy.sparse matrix (default: columns of
+        the DataFrame)
 
     Returns
     -------
     Nothing
-    """
-    bt = biom.Table(table.values,
-                    observation_ids=list(map(str, table.index)),
-                    sample_ids=table.columns)
 
+    Raises
+    ------
+    ValueError
+        if a scipy.sparse matrix is given without IDs
+
+    Notes
+    -----
+    The matrix is stored in compressed, chunked HDF5 datasets.
+    """
+    bt = _to_biom(table, observation_ids, sample_ids)
     with biom_open(file_biom, 'w') as f:
-        bt.to_hdf5(f, "example")
+        bt.to_hdf5(f, "example", compress=True)
+
+
+def write_biom_tables(tables):
+    """ Writes several related tables into biom files.
+
+    Parameters
+    ----------
+    tables: dict of {str: table} or iterable((str, table))
+        BIOM filenames and the tables to write into them, of any type
+        accepted by pandas2biom
+
+    Returns
+    -------
+    Nothing
+
+    Notes
+    -----
+    Tables are written one after another in the given order. Passing a
+    generator builds every table only right before it is written, so that
+    only one of them is held in memory at a time.
+    """
+    if isinstance(tables, dict):
+        tables = tables.items()
+    for file_biom, table in tables:
+        pandas2biom(file_biom, table)
@@ -0,0 +1,136 @@
+from unittest import TestCase, main, skipUnless
+from tempfile import TemporaryDirectory
+from os.path import join, exists
+from shutil import which
+from subprocess import check_call
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+from skbio.util import get_data_path
+
+from oecophylla.taxonomy.bracken import (read_kmer_distribution,
+                                         _read_report_tree,
+                                         estimate_abundance, redistribute,
+                                         BRACKEN_COLUMNS)
+from oecophylla.taxonomy.parser import _read_bracken
+
+
+class BrackenTests(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.file_report = get_data_path(
+            'bracken/est_abundance/sample.report.txt')
+        self.file_distr = get_data_path('bracken/est_abundance/kmer_distr.txt')
+        self.distr = read_kmer_distribution(self.file_distr)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_kmer_distribution(self):
+        self.assertEqual(self.distr.shape, (83334, 83334))
+        self.assertEqual(self.distr.nnz, 7)
+        self.assertAlmostEqual(self.distr[561, 562], 0.3)
+        self.assertAlmostEqual(self.distr[543, 622], 0.2)
+        self.assertAlmostEqual(self.distr[83333, 83333], 0.4)
+        self.assertEqual(self.distr[562, 561], 0)
+
+    def test_read_report_tree(self):
+        report, parent = _read_report_tree(self.file_report)
+        self.assertEqual(report['name'].tolist()[:3],
+                         ['unclassified', 'root', 'Bacteria'])
+        np.testing.assert_array_equal(parent, [0, 1, 1, 2, 3, 4, 5, 3, 7])
+
+    def test_estimate_abundance(self):
+        report, parent = _read_report_tree(self.file_report)
+        obs = estimate_abundance(report, parent, self.distr, 'S')
+        exp = pd.DataFrame(
+            [['Escherichia coli', 562, 'S', 50, 17, 67, 0.5625],
+             ['Shigella dysenteriae', 622, 'S', 40, 12, 52, 0.4375]],
+            columns=['name', 'taxonomy_id', 'taxonomy_lvl',
+                     'kraken_assigned_reads', 'added_reads',
+                     'new_est_reads', 'fraction_total_reads'])
+        assert_frame_equal(obs, exp)
+
+        obs = estimate_abundance(report, parent, self.distr, 'G')
+        self.assertEqual(obs['taxonomy_id'].tolist(), [561, 620])
+        np.testing.assert_array_almost_equal(obs['fraction_total_reads'],
+                                             [0.5625, 0.4375])
+
+        # Shigella dysenteriae is below the threshold, all reads go to E. coli
+        obs = estimate_abundance(report, parent, self.distr, 'S', 45)
+        self.assertEqual(obs['taxonomy_id'].tolist(), [562])
+        self.assertEqual(obs['new_est_reads'].tolist(), [80])
+
+        obs = estimate_abundance(report, parent, self.distr, 'P')
+        self.assertEqual(len(obs), 0)
+
+    def test_redistribute(self):
+        stem = join(self.tmp.name, 'sample')
+        obs = redistribute(self.file_report, self.distr,
+                           ['genus', 'species'], stem)
+        self.assertEqual(obs, [stem + '.redist.genus.txt',
+                               stem + '.redist.species.txt'])
+        for file in obs:
+            self.assertTrue(exists(file + '.npz'))
+        with open(obs[1], 'r') as f:
+            self.assertEqual(f.read().splitlines(), [
+                'name\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\t'
+                'added_reads\tnew_est_reads\tfraction_total_reads',
+                'Escherichia coli\t562\tS\t50\t17\t67\t0.56250',
+                'Shigella dysenteriae\t622\tS\t40\t12\t52\t0.43750'])
+        self.assertEqual(_read_bracken(obs[0], 'sample').to_dict(),
+                         {561: 67, 620: 52})
+
+    def _check_bracken_output(self, table, threshold=10):
+        self.assertListEqual(list(table.columns), BRACKEN_COLUMNS)
+        for col in BRACKEN_COLUMNS[3:6]:
+            self.assertEqual(table[col].dtype, np.int64)
+        self.assertTrue((table['kraken_assigned_reads'] >= threshold).all())
+        self.assertTrue((table['kraken_assigned_reads'] +
+                         table['added_reads'] ==
+                         table['new_est_reads']).all())
+        # read counts are truncated estimates, of which the fractions (with
+        # five decimals) are taken: one total fits all rows
+        frac = table['fraction_total_reads']
+        rows = frac > 1e-4
+        reads = table['new_est_reads'][rows]
+        self.assertLessEqual((reads / (frac[rows] + 5e-6)).max(),
+                             ((reads + 1) / (frac[rows] - 5e-6)).min())
+        self.assertAlmostEqual(frac.sum(), 1, delta=5e-6 * len(frac))
+
+    def test_est_abundance_conventions(self):
+        # outputs of Bracken's est_abundance.py follow these conventions
+        for level, samples in (('species', 'ABC'), ('phylum', '123')):
+            for s in samples:
+                self._check_bracken_output(pd.read_csv(get_data_path(
+                    'bracken/%s/sample%s.tsv' % (level, s)), sep='\t'))
+
+        # and so do those of redistribute
+        stem = join(self.tmp.name, 'sample')
+        for file in redistribute(self.file_report, self.distr,
+                                 ['genus', 'species'], stem):
+            self._check_bracken_output(pd.read_csv(file, sep='\t'))
+
+    @skipUnless(which('est_abundance.py'), 'Bracken is not installed')
+    def test_redistribute_est_abundance(self):
+        # same output as Bracken's est_abundance.py, which it replaces
+        stem = join(self.tmp.name, 'sample')
+        levels = ['genus', 'species']
+        obs = redistribute(self.file_report, self.distr, levels, stem)
+        for level, file in zip(levels, obs):
+            file_exp = join(self.tmp.name, 'bracken.%s.txt' % level)
+            check_call(['est_abundance.py', '-i', self.file_report,
+                        '-k', self.file_distr, '-t', '10',
+                        '-l', level[0].upper(), '-o', file_exp],
+                       cwd=self.tmp.name)
+            exp = pd.read_csv(file_exp, sep='\t')
+            obs_level = pd.read_csv(file, sep='\t')
+            assert_frame_equal(
+                obs_level.sort_values('taxonomy_id').reset_index(drop=True),
+                exp.sort_values('taxonomy_id').reset_index(drop=True),
+                check_exact=False)
+
+
+if __name__ == '__main__':
+    main()
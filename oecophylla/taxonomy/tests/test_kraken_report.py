@@ -0,0 +1,95 @@
+from unittest import TestCase, main
+from tempfile import TemporaryDirectory
+from os.path import join
+from io import BytesIO
+import gzip
+
+import numpy as np
+from skbio.util import get_data_path
+
+from oecophylla.taxonomy.tree import load_taxonomy
+from oecophylla.taxonomy.kraken_report import count_kraken, summarize_kraken
+from oecophylla.taxonomy.parser import _read_kraken_report, _read_profile
+
+
+class KrakenReportTests(TestCase):
+    def setUp(self):
+        self.taxonomy = load_taxonomy(get_data_path('taxdump/nodes.dmp'),
+                                      get_data_path('taxdump/names.dmp'),
+                                      get_data_path('taxdump/merged.dmp'))
+        reads = [('C', 562), ('C', 562), ('C', 83333), ('C', 622),
+                 ('C', 1280), ('U', 0), ('C', 13), ('C', 12333)]
+        self.map = ''.join('%s\tread%d\t%d\t150\t%d:116\n' % (c, i, t, t)
+                           for i, (c, t) in enumerate(reads)).encode()
+
+    def test_count_kraken(self):
+        with TemporaryDirectory() as tmp:
+            file_map = join(tmp, 'map.txt.gz')
+            # blocks smaller than a line
+            obs = count_kraken(BytesIO(self.map), file_map, blocksize=7)
+            with gzip.open(file_map, 'rb') as f:
+                self.assertEqual(f.read(), self.map)
+        self.assertEqual(len(obs), 83334)
+        self.assertEqual(obs.sum(), 8)
+        self.assertEqual(dict((i, obs[i]) for i in np.flatnonzero(obs)),
+                         {0: 1, 13: 1, 562: 2, 622: 1, 1280: 1,
+                          12333: 1, 83333: 1})
+        self.assertEqual(len(count_kraken(BytesIO(b''))), 0)
+
+    def test_summarize_kraken(self):
+        with TemporaryDirectory() as tmp:
+            file_report = join(tmp, 'report.txt')
+            file_mpa = join(tmp, 'profile.txt')
+            obs = summarize_kraken(BytesIO(self.map), self.taxonomy,
+                                   file_report, file_mpa)
+            self.assertEqual(obs, 8)
+            with open(file_report, 'r') as f:
+                report = f.read().splitlines()
+            with open(file_mpa, 'r') as f:
+                mpa = f.read().splitlines()
+            report_counts = _read_kraken_report(file_report, 'sampleA')
+            profile = _read_profile(file_mpa, 'sampleA')
+
+        self.assertEqual(len(report), 21)
+        self.assertEqual(report[0], ' 12.50\t1\t1\tU\t0\tunclassified')
+        self.assertEqual(report[1], ' 87.50\t7\t0\t-\t1\troot')
+        # merged TaxID 13 counts for Escherichia
+        self.assertEqual(report[8],
+                         ' 50.00\t4\t1\tG\t561\t              Escherichia')
+        self.assertEqual(report[10], ' 12.50\t1\t1\t-\t83333\t'
+                         '                  Escherichia coli K-12')
+        # children with most reads first
+        self.assertEqual(report[13],
+                         ' 12.50\t1\t0\tP\t1239\t      Firmicutes')
+        self.assertEqual(report[19], ' 12.50\t1\t0\tD\t10239\t  Viruses')
+        self.assertEqual(report_counts.loc[562, 'sampleA'], 3)
+
+        self.assertEqual(len(mpa), 16)
+        self.assertEqual(mpa[0], 'd__Bacteria\t6')
+        self.assertEqual(mpa[6], 'd__Bacteria|p__Proteobacteria|'
+                         'c__Gammaproteobacteria|o__Enterobacterales|'
+                         'f__Enterobacteriaceae|g__Escherichia|'
+                         's__Escherichia_coli\t3')
+        self.assertEqual(mpa[-1], 'd__Viruses\t1')
+        self.assertEqual(profile['d__Bacteria|p__Firmicutes'], 1)
+
+    def test_summarize_kraken_unknown(self):
+        with TemporaryDirectory() as tmp:
+            report, mpa = join(tmp, 'report.txt'), join(tmp, 'profile.txt')
+            with self.assertWarnsRegex(UserWarning,
+                                       r'2 read\(s\) of 1 TaxID\(s\) '
+                                       r'.*: 99999'):
+                total = summarize_kraken(
+                    BytesIO(b'C\tread0\t99999\t150\t0:1\n'
+                            b'C\tread1\t562\t150\t0:1\n'
+                            b'C\tread2\t99999\t150\t0:1\n'
+                            b'U\tread3\t0\t150\t0:1\n'),
+                    self.taxonomy, report, mpa)
+            self.assertEqual(total, 4)
+            with open(report) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[0], ' 75.00\t3\t3\tU\t0\tunclassified')
+            self.assertNotIn('99999', ''.join(lines))
+
+if __name__ == '__main__':
+    main()
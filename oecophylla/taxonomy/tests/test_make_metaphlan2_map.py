@@ -1,11 +1,17 @@
 from unittest import TestCase, main
 from copy import deepcopy
+from tempfile import TemporaryDirectory
+from os.path import join
+from shutil import copy
+import bz2
+import os
 
 from skbio.util import get_data_path
 
 from oecophylla.taxonomy.make_metaphlan2_map import (
     read_taxid_list, read_metaphlan_markers_info, _read_ncbitaxonomy_file,
-    read_ncbi_merged, update_taxids)
+    read_ncbi_merged, update_taxids, load_taxid_index, TaxidIndex,
+    resolve_merged, generate_map_metaphlan2_ncbitaxids)
 
 
 class ReadWriteTests(TestCase):
@@ -87,6 +93,49 @@ class ReadWriteTests(TestCase):
         with self.assertRaises(ValueError):
             read_taxid_list(self.file_names)
 
+    def test_load_taxid_index(self):
+        with TemporaryDirectory() as temp_dir:
+            index_dir = join(temp_dir, 'index')
+            obs = read_taxid_list(self.file_mptaxids, index_dir=index_dir)
+            self.assertIsInstance(obs, TaxidIndex)
+            self.assertEqual(obs, self.true_mptaxids)
+            self.assertEqual(obs['NC']['NC_002560.1'], '134606')
+            self.assertNotIn('NC_000000.1', obs['NC'])
+            with self.assertRaises(KeyError):
+                obs['gi']['1']
+            taxids, found = obs['gi'].lookup(['225074862', '0', '512550081'])
+            self.assertListEqual(found.tolist(), [True, False, True])
+            self.assertListEqual(taxids[found].tolist(), [556267, 1303518])
+
+            # several files are indexed together
+            obs = load_taxid_index([self.file_mptaxids, self.file_gg_taxids],
+                                   index_dir)
+            exp = deepcopy(self.true_mptaxids)
+            exp.update(self.true_gg_taxids)
+            self.assertEqual(obs, exp)
+
+            # the index is rebuilt if a file changes
+            fp = join(temp_dir, 'taxids.txt')
+            copy(self.file_mptaxids, fp)
+            before = load_taxid_index(fp, index_dir)
+            self.assertEqual(before, self.true_mptaxids)
+            with open(fp, 'a') as f:
+                f.write('gi\t1\t2\n')
+            self.assertEqual(load_taxid_index(fp, index_dir)['gi']['1'], '2')
+            # files are replaced, not overwritten under mapped arrays
+            self.assertEqual(before, self.true_mptaxids)
+            self.assertFalse([x for x in os.listdir(index_dir)
+                              if x.endswith('.tmp')])
+
+            with self.assertRaises(ValueError):
+                load_taxid_index(self.file_names, join(temp_dir, 'names'))
+
+            # merged taxIDs are updated in a new index
+            obs = update_taxids(load_taxid_index(self.file_mptaxids,
+                                                 index_dir),
+                                read_ncbi_merged(self.file_merged))
+            self.assertEqual(obs, self.true_new_mptaxids)
+
     def test_read_metaphlan_markers_info(self):
         self.assertEqual(self.true_marker,
                          read_metaphlan_markers_info(self.file_mpmarkers))
@@ -96,6 +145,64 @@ class ReadWriteTests(TestCase):
 
         self.assertEqual({}, read_metaphlan_markers_info(self.file_nodes))
 
+    def test_read_metaphlan_markers_info_bz2(self):
+        with TemporaryDirectory() as temp_dir:
+            fp = join(temp_dir, 'markers_info.txt.bz2')
+            with open(self.file_mpmarkers, 'rb') as f:
+                with bz2.open(fp, 'wb') as out:
+                    out.write(f.read())
+            for threads, chunksize in ((1, 100000), (1, 3), (3, 2)):
+                self.assertEqual(self.true_marker, read_metaphlan_markers_info(
+                    fp, threads=threads, chunksize=chunksize))
+
+    def test_resolve_merged(self):
+        self.assertEqual(resolve_merged(self.true_merged), self.true_merged)
+        self.assertEqual(resolve_merged({}), {})
+        merged = {'1': '2', '2': '3', '3': '4', '4': '5', '10': '3', '7': '8'}
+        self.assertEqual(resolve_merged(merged),
+                         {'1': '5', '2': '5', '3': '5', '4': '5', '10': '5',
+                          '7': '8'})
+        with self.assertRaisesRegex(ValueError, 'Cyclic'):
+            resolve_merged({'1': '2', '2': '3', '3': '1'})
+
+        # chains are followed when updating taxIDs
+        obs = update_taxids({'NC': {'a': '1', 'b': '9'}}, merged)
+        self.assertEqual(obs, {'NC': {'a': '5', 'b': '9'}})
+
+    def test_generate_map_metaphlan2_ncbitaxids(self):
+        with TemporaryDirectory() as temp_dir:
+            fp_map = join(temp_dir, 'map.tsv')
+            fp_markers = join(temp_dir, 'markers_info.txt.bz2')
+            with open(self.file_mpmarkers, 'rb') as f:
+                with bz2.open(fp_markers, 'wb') as out:
+                    out.write(f.read())
+            fp_taxids = join(temp_dir, 'taxids.txt')
+            copy(self.file_mptaxids, fp_taxids)
+            kwargs = {'latest_mergeddump': self.file_merged,
+                      'filename_markers': fp_markers,
+                      'filename_taxids': fp_taxids}
+
+            self.assertTrue(generate_map_metaphlan2_ncbitaxids(fp_map,
+                                                               **kwargs))
+            with open(fp_map, 'r') as f:
+                obs = dict(line.rstrip('\n').split('\t') for line in f)
+            self.assertEqual(obs['s__Cypovirus_15'], '134606')
+            self.assertEqual(obs['s__Mycobacterium_phage_Omega'], '74313')
+            self.assertEqual(obs['s__Escherichia_phage_vB_EcoP_G7C'],
+                             '1054461')
+            self.assertEqual(len(obs), 11)
+
+            # unchanged inputs are not processed again
+            mtime = os.stat(fp_map).st_mtime_ns
+            self.assertFalse(generate_map_metaphlan2_ncbitaxids(fp_map,
+                                                                **kwargs))
+            self.assertEqual(os.stat(fp_map).st_mtime_ns, mtime)
+
+            with open(fp_taxids, 'a') as f:
+                f.write('gi\t1\t2\n')
+            self.assertTrue(generate_map_metaphlan2_ncbitaxids(fp_map,
+                                                               **kwargs))
+
     def test__read_ncbitaxonomy_file(self):
         self.assertEqual(self.true_nodes,
                          _read_ncbitaxonomy_file(self.file_nodes))
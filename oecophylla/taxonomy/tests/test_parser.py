@@ -1,17 +1,43 @@
-from unittest import TestCase, main
-from tempfile import mkstemp
+from unittest import TestCase, main, mock
+from threading import current_thread, main_thread
+from tempfile import mkstemp, TemporaryDirectory
+from os import utime, stat
+from os.path import join, basename
+from shutil import copy
 
+import numpy as np
 import pandas as pd
-from pandas.util.testing import assert_frame_equal
+from pandas.util.testing import assert_frame_equal, assert_series_equal
 from skbio.util import get_data_path
 import biom
+from scipy.sparse import csr_matrix, issparse
 
-from oecophylla.taxonomy.parser import (combine_profiles,
+from oecophylla.taxonomy.parser import (_read_profile,
+                                        _read_centrifuge,
+                                        _read_bracken,
+                                        _read_kraken_report,
+                                        load_profiles,
+                                        write_sidecar,
+                                        _fetch,
+                                        _sidecar_fresh,
+                                        combine_sparse,
+                                        combine_profiles,
+                                        combine_incremental,
+                                        combine_out_of_core,
                                         extract_level,
+                                        extract_levels,
                                         combine_centrifuge,
                                         combine_kraken,
                                         combine_bracken,
-                                        pandas2biom)
+                                        pandas2biom,
+                                        write_biom_tables,
+                                        write_combined)
+
+
+def biom2pandas(table):
+    return pd.DataFrame(table.matrix_data.toarray(),
+                        index=table.ids(axis='observation'),
+                        columns=table.ids())
 
 
 class TaxonomyParserTest(TestCase):
@@ -24,6 +50,248 @@ class TaxonomyParserTest(TestCase):
         assert_frame_equal(obs[sorted(obs.columns)].sort_index().astype(int),
                            exp[sorted(exp.columns)].sort_index().astype(int))
 
+        obs = combine_profiles(
+            [('sampleA', get_data_path('shogun/phylum/sampleA.txt')),
+             ('sampleB', get_data_path('shogun/phylum/sampleB.txt'))],
+            sparse=True)
+        self.assertIsInstance(obs, biom.Table)
+        self.assertListEqual(list(obs.ids()), ['sampleA', 'sampleB'])
+        obs = biom2pandas(obs)
+        assert_frame_equal(obs.sort_index().astype(int),
+                           exp[sorted(exp.columns)].sort_index().astype(int),
+                           check_names=False)
+
+    def test_load_profiles(self):
+        profiles = [('sample%s' % x, get_data_path('shogun/phylum/sample%s.txt'
+                                                   % x)) for x in 'AB'] * 5
+        exp = list(load_profiles(profiles))
+        self.assertEqual(len(exp), 10)
+        for threads, processes in ((3, 1), (2, 2), (1, 3)):
+            obs = list(load_profiles(profiles, threads=threads,
+                                     processes=processes))
+            self.assertListEqual([x[0] for x in obs], [x[0] for x in exp])
+            for (_, o), (_, e) in zip(obs, exp):
+                assert_series_equal(o, e)
+
+        # parallel combining gives the same table
+        exp = combine_centrifuge(
+            [('sampleA', get_data_path('centrifuge/sampleA.txt')),
+             ('sampleB', get_data_path('centrifuge/sampleB.txt'))])
+        obs = combine_centrifuge(
+            [('sampleA', get_data_path('centrifuge/sampleA.txt')),
+             ('sampleB', get_data_path('centrifuge/sampleB.txt'))],
+            threads=2, processes=2)
+        assert_frame_equal(obs, exp)
+
+        with self.assertRaises(IOError):
+            list(load_profiles([('x', '/not/a/file')], threads=2))
+
+    def test_write_sidecar(self):
+        readers = {'profile': _read_profile,
+                   'centrifuge': _read_centrifuge,
+                   'bracken': _read_bracken,
+                   'kraken': _read_kraken_report}
+        files = {'profile': 'shogun/phylum/sampleA.txt',
+                 'centrifuge': 'centrifuge/sampleA.txt',
+                 'bracken': 'bracken/species/sampleA.tsv',
+                 'kraken': 'kraken/sampleA.txt'}
+        with TemporaryDirectory() as temp_dir:
+            for fmt, fp in files.items():
+                file = join(temp_dir, basename(fp))
+                copy(get_data_path(fp), file)
+                exp = readers[fmt](file, 'sampleA')
+                self.assertEqual(write_sidecar(file, fmt), file + '.npz')
+
+                # the sidecar is loaded instead of the text file
+                copy(get_data_path(fp.replace('sampleA', 'sampleB')), file)
+                st = stat(file)
+                utime(file + '.npz', ns=(st.st_atime_ns, st.st_mtime_ns))
+                assert_equal = assert_frame_equal if fmt == 'kraken' \
+                    else assert_series_equal
+                for threads, processes in ((1, 1), (2, 2)):
+                    obs = list(load_profiles([('sampleA', file)],
+                                             readers[fmt], threads,
+                                             processes))
+                    self.assertEqual(obs[0][0], 'sampleA')
+                    assert_equal(obs[0][1], exp)
+
+                # sidecars are probed by the prefetching threads only
+                fetched = []
+
+                def fetch(*args):
+                    fetched.append(current_thread())
+                    return _fetch(*args)
+
+                with mock.patch('oecophylla.taxonomy.parser._fetch', fetch), \
+                        mock.patch('oecophylla.taxonomy.parser._sidecar_fresh',
+                                   side_effect=_sidecar_fresh) as fresh:
+                    obs = list(load_profiles([('sampleA', file)],
+                                             readers[fmt], threads=2))
+                assert_equal(obs[0][1], exp)
+                self.assertEqual(len(fetched), 1)
+                self.assertIsNot(fetched[0], main_thread())
+                self.assertEqual(fresh.call_count, 1)
+
+                # but not once the text file is newer
+                utime(file + '.npz', ns=(st.st_atime_ns,
+                                         st.st_mtime_ns - 10**9))
+                obs = list(load_profiles([('sampleA', file)], readers[fmt]))
+                assert_equal(obs[0][1], readers[fmt](file, 'sampleA'))
+
+    def test_write_sidecar_format(self):
+        with TemporaryDirectory() as temp_dir:
+            file = join(temp_dir, 'sampleA.txt')
+            copy(get_data_path('shogun/phylum/sampleA.txt'), file)
+            write_sidecar(file)
+            copy(get_data_path('shogun/phylum/sampleB.txt'), file)
+            st = stat(file)
+            exp = _read_profile(file, 'sampleA')
+
+            # a sidecar written for another format is not used
+            with np.load(file + '.npz') as npz:
+                arrays = dict(npz)
+            for fmt in ('bracken', None):
+                arrays.pop('fmt')
+                if fmt is not None:
+                    arrays['fmt'] = np.array([fmt])
+                np.savez(file + '.npz', **arrays)
+                utime(file + '.npz', ns=(st.st_atime_ns, st.st_mtime_ns))
+                for threads in (1, 2):
+                    obs = list(load_profiles([('sampleA', file)],
+                                             threads=threads))
+                    assert_series_equal(obs[0][1], exp)
+                arrays['fmt'] = np.array(['profile'])
+
+            # nor by readers of unknown formats
+            write_sidecar(file)
+            utime(file + '.npz', ns=(st.st_atime_ns, st.st_mtime_ns))
+            copy(get_data_path('shogun/phylum/sampleA.txt'), file)
+            utime(file, ns=(st.st_atime_ns, st.st_mtime_ns))
+            obs = list(load_profiles([('sampleA', file)],
+                                     lambda f, n: _read_profile(f, n)))
+            assert_series_equal(obs[0][1], _read_profile(file, 'sampleA'))
+
+    def test_combine_sparse(self):
+        obs = combine_sparse(
+            [('s1', pd.Series([1.0, 0.0, 2.0], index=['a', 'b', 'c'])),
+             ('s2', pd.Series([3.0, 4.0, 5.0], index=['c', 'd', 'c'])),
+             ('s3', pd.Series([], dtype=float))])
+        self.assertListEqual(list(obs.ids(axis='observation')),
+                             ['a', 'c', 'd'])
+        self.assertListEqual(list(obs.ids()), ['s1', 's2', 's3'])
+        self.assertEqual(obs.nnz, 4)
+        self.assertListEqual(obs.matrix_data.toarray().tolist(),
+                             [[1.0, 0.0, 0.0],
+                              [2.0, 8.0, 0.0],
+                              [0.0, 4.0, 0.0]])
+
+        obs = combine_sparse([])
+        self.assertTupleEqual(obs.shape, (0, 0))
+
+    def test_combine_incremental(self):
+        parsed = []
+
+        def combine(profiles, **kwargs):
+            parsed.extend(name for name, _ in profiles)
+            return combine_profiles(profiles, **kwargs)
+
+        def assert_table_equal(obs, profiles):
+            exp = biom2pandas(combine_profiles(profiles, sparse=True))
+            self.assertListEqual(list(obs.ids()), list(exp.columns))
+            assert_frame_equal(biom2pandas(obs).sort_index(),
+                               exp.sort_index())
+
+        with TemporaryDirectory() as temp_dir:
+            state = join(temp_dir, 'state')
+            fps = {}
+            for x in 'AB':
+                fps[x] = join(temp_dir, 'sample%s.txt' % x)
+                copy(get_data_path('shogun/phylum/sample%s.txt' % x), fps[x])
+            fps['C'] = join(temp_dir, 'sampleC.txt')
+            with open(fps['C'], 'w') as f:
+                f.write('p__Novel\t5\np__Firmicutes\t2\n')
+
+            profiles = [('sampleA', fps['A']), ('sampleB', fps['B'])]
+            obs = combine_incremental(profiles, state, combine)
+            assert_table_equal(obs, profiles)
+            self.assertListEqual(parsed, ['sampleA', 'sampleB'])
+
+            # only the new sample is parsed
+            del parsed[:]
+            profiles.insert(1, ('sampleC', fps['C']))
+            obs = combine_incremental(profiles, state, combine)
+            assert_table_equal(obs, profiles)
+            self.assertListEqual(parsed, ['sampleC'])
+
+            # only the changed sample is parsed, and a removed one dropped
+            del parsed[:]
+            with open(fps['C'], 'w') as f:
+                f.write('p__Novel\t7\n')
+            profiles = profiles[1:]
+            obs = combine_incremental(profiles, state, combine)
+            assert_table_equal(obs, profiles)
+            self.assertListEqual(parsed, ['sampleC'])
+
+            # nothing is parsed if nothing changed
+            del parsed[:]
+            obs = combine_incremental(profiles, state, combine)
+            assert_table_equal(obs, profiles)
+            self.assertListEqual(parsed, [])
+
+            # without a state directory everything is combined
+            obs = combine_incremental(profiles, None, combine)
+            assert_table_equal(obs, profiles)
+            self.assertListEqual(parsed, ['sampleC', 'sampleB'])
+
+    def test_combine_out_of_core(self):
+        profiles = [('sample%s%d' % (x, i),
+                     get_data_path('shogun/phylum/sample%s.txt' % x))
+                    for i in range(3) for x in 'AB']
+        exp = combine_profiles(profiles, sparse=True)
+        with TemporaryDirectory() as temp_dir:
+            fp = join(temp_dir, 'combined.biom')
+            # from one sample per block to all samples in one block
+            for memory in (64, 64 * 40, 2 ** 30):
+                self.assertTupleEqual(combine_out_of_core(
+                    profiles, fp, memory, temp_dir=temp_dir), (27, 6))
+                for axis in ('observation', 'sample'):
+                    with biom.util.biom_open(fp) as f:
+                        obs = biom.Table.from_hdf5(f, axis=axis)
+                    self.assertEqual(obs, exp)
+
+            self.assertTupleEqual(combine_out_of_core([], fp, 64), (0, 0))
+            self.assertTupleEqual(biom.load_table(fp).shape, (0, 0))
+
+    def test_write_combined_humann2(self):
+        # HUMAnN2 tables: a header comment, stratified features and RPKs
+        tables = {'S1': '# Gene Family\tS1_Abundance-RPKs\n'
+                        'UNMAPPED\t10.5\n'
+                        'UniRef90_A\t3.25\n'
+                        'UniRef90_A|g__Bacteroides.s__Bacteroides_fragilis'
+                        '\t3.25\n',
+                  'S2': '# Gene Family\tS2_Abundance-RPKs\n'
+                        'UNMAPPED\t2.0\n'
+                        'UniRef90_B\t1.5\n'}
+        exp = pd.DataFrame(
+            [[10.5, 2.0], [3.25, 0], [3.25, 0], [0, 1.5]],
+            index=['UNMAPPED', 'UniRef90_A',
+                   'UniRef90_A|g__Bacteroides.s__Bacteroides_fragilis',
+                   'UniRef90_B'],
+            columns=['S1', 'S2'])
+        with TemporaryDirectory() as temp_dir:
+            profiles = []
+            for sample, table in sorted(tables.items()):
+                fp = join(temp_dir, '%s_genefamilies.tsv' % sample)
+                with open(fp, 'w') as f:
+                    f.write(table)
+                profiles.append((sample, fp))
+            fp = join(temp_dir, 'genefamilies.biom')
+            for memory in (None, 64):
+                write_combined(fp, profiles, memory=memory,
+                               temp_dir=temp_dir)
+                assert_frame_equal(
+                    biom2pandas(biom.load_table(fp)).sort_index(), exp)
+
     def test_extract_level(self):
         # test extracting phyla and families from MetaPhlAn output
         table = pd.read_table(get_data_path('metaphlan2/combined.tsv'),
@@ -49,6 +317,36 @@ class TaxonomyParserTest(TestCase):
         with self.assertRaisesRegex(ValueError, 'Duplicated taxa detected'):
             extract_level(table, 'p', delim='|')
 
+    def test_extract_levels(self):
+        table = pd.read_table(get_data_path('metaphlan2/combined.tsv'),
+                              index_col=0)
+        with open(get_data_path('metaphlan2/dic.genus.txt'), 'r') as f:
+            dic = dict(x.split('\t') for x in f.read().splitlines())
+        for d in (None, dic):
+            obs = extract_levels(table, 'pfgs', delim='|', dic=d)
+            self.assertListEqual(sorted(obs), ['f', 'g', 'p', 's'])
+            for code, df in obs.items():
+                assert_frame_equal(df, extract_level(table, code, delim='|',
+                                                     dic=d))
+        self.assertDictEqual(extract_levels(table, [], delim='|'), {})
+
+        # levels of a biom.Table are extracted on its sparse matrix
+        bt = biom.Table(table.values, observation_ids=list(table.index),
+                        sample_ids=list(table.columns))
+        # two genera of the same TaxID, and one without TaxID
+        merged = dict(dic)
+        first, second, third = sorted(merged)[:3]
+        merged[second] = merged[first]
+        del merged[third]
+        for d in (None, dic, merged):
+            obs = extract_levels(bt, 'pfgs', delim='|', dic=d)
+            exp = extract_levels(table, 'pfgs', delim='|', dic=d)
+            for code, t in obs.items():
+                self.assertIsInstance(t, biom.Table)
+                self.assertTrue(issparse(t.matrix_data))
+                assert_frame_equal(biom2pandas(t), exp[code].astype(float),
+                                   check_names=False)
+
     def test_combine_kraken(self):
         exp0 = pd.read_table(get_data_path('kraken/combined.tsv'),
                              index_col=0)
@@ -65,6 +363,25 @@ class TaxonomyParserTest(TestCase):
                            exp0[sorted(exp0.columns)].sort_index().astype(int))
         self.assertDictEqual(obs1, exp1)
 
+        obs0, obs1 = combine_kraken(
+            [('sampleA', get_data_path('kraken/sampleA.txt')),
+             ('sampleB', get_data_path('kraken/sampleB.txt'))], sparse=True)
+        self.assertIsInstance(obs0, biom.Table)
+        obs0 = biom2pandas(obs0)
+        # TaxIDs without reads in any sample are not stored
+        exp0 = exp0[(exp0 != 0).any(axis=1)]
+        assert_frame_equal(obs0.sort_index().astype(int),
+                           exp0[sorted(exp0.columns)].sort_index().astype(int))
+        self.assertDictEqual(obs1, exp1)
+
+        # TaxIDs reported by many samples are mapped to their level once
+        obs0, obs1 = combine_kraken(
+            [('sample%d' % i, get_data_path('kraken/sample%s.txt' % x))
+             for i, x in enumerate('ABBA')])
+        self.assertListEqual(list(obs0.columns),
+                             ['sample0', 'sample1', 'sample2', 'sample3'])
+        self.assertDictEqual(obs1, exp1)
+
     def test_combine_centrifuge(self):
         exp = pd.read_table(get_data_path('centrifuge/combined.tsv'),
                             index_col=0)
@@ -74,6 +391,15 @@ class TaxonomyParserTest(TestCase):
         assert_frame_equal(obs[sorted(obs.columns)].sort_index().astype(int),
                            exp[sorted(exp.columns)].sort_index().astype(int))
 
+        obs = biom2pandas(combine_centrifuge(
+            [('sampleA', get_data_path('centrifuge/sampleA.txt')),
+             ('sampleB', get_data_path('centrifuge/sampleB.txt'))],
+            sparse=True))
+        exp.index = exp.index.map(str)
+        assert_frame_equal(obs.sort_index().astype(int),
+                           exp[sorted(exp.columns)].sort_index().astype(int),
+                           check_names=False)
+
     def test_combine_bracken(self):
         exp = pd.read_csv(get_data_path('bracken/combined.phylum.tsv'),
                           sep='\t', index_col=0, dtype=int)
@@ -93,6 +419,16 @@ class TaxonomyParserTest(TestCase):
         assert_frame_equal(obs[sorted(obs.columns)].sort_index(),
                            exp[sorted(exp.columns)].sort_index())
 
+        obs = biom2pandas(combine_bracken(
+            [('sampleA', get_data_path('bracken/species/sampleA.tsv')),
+             ('sampleB', get_data_path('bracken/species/sampleB.tsv')),
+             ('sampleC', get_data_path('bracken/species/sampleC.tsv'))],
+            sparse=True))
+        exp.index = exp.index.map(str)
+        assert_frame_equal(obs.sort_index().astype(int),
+                           exp[sorted(exp.columns)].sort_index(),
+                           check_names=False)
+
     def test_pandas2biom(self):
         fh, filename = mkstemp()
         p = pd.read_csv(get_data_path('float.tsv'), sep='\t', index_col=0)
@@ -103,6 +439,44 @@ class TaxonomyParserTest(TestCase):
         self.assertCountEqual(b.ids(), p.columns)
         self.assertCountEqual(b.ids(axis='observation'), p.index)
 
+    def test_pandas2biom_sparse(self):
+        fh, filename = mkstemp()
+        p = pd.read_csv(get_data_path('float.tsv'), sep='\t', index_col=0)
+        exp = p.values
+
+        # scipy sparse matrix with explicit IDs
+        mat = csr_matrix(exp)
+        with self.assertRaisesRegex(ValueError, 'IDs are required'):
+            pandas2biom(filename, mat)
+        pandas2biom(filename, mat, observation_ids=list(map(str, p.index)),
+                    sample_ids=list(p.columns))
+        b = biom.load_table(filename)
+        self.assertListEqual(list(b.ids()), list(p.columns))
+        self.assertListEqual(b.matrix_data.toarray().tolist(), exp.tolist())
+
+        # DataFrame with sparse columns
+        pandas2biom(filename, p.astype(pd.SparseDtype(float, 0)))
+        b = biom.load_table(filename)
+        self.assertListEqual(list(b.ids(axis='observation')),
+                             list(map(str, p.index)))
+        self.assertListEqual(b.matrix_data.toarray().tolist(), exp.tolist())
+
+        with self.assertRaisesRegex(TypeError, 'Unsupported'):
+            pandas2biom(filename, exp)
+
+    def test_write_biom_tables(self):
+        p = pd.read_csv(get_data_path('float.tsv'), sep='\t', index_col=0)
+        with TemporaryDirectory() as temp_dir:
+            fps = [join(temp_dir, '%s.biom' % x) for x in 'ab']
+            write_biom_tables((fp, p.iloc[:i + 1]) for i, fp
+                              in enumerate(fps))
+            for i, fp in enumerate(fps):
+                b = biom.load_table(fp)
+                self.assertCountEqual(b.ids(axis='observation'),
+                                      p.index[:i + 1])
+            write_biom_tables({fps[0]: p})
+            self.assertEqual(biom.load_table(fps[0]).shape, p.shape)
+
 
 if __name__ == '__main__':
     main()
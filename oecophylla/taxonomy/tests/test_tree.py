@@ -0,0 +1,123 @@
+from unittest import TestCase, main
+from tempfile import TemporaryDirectory
+from os.path import join
+from shutil import copy
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+from skbio.util import get_data_path
+
+from oecophylla.taxonomy.tree import jump, load_taxonomy
+
+
+class TaxonomyTests(TestCase):
+    def setUp(self):
+        self.file_nodes = get_data_path('taxdump/nodes.dmp')
+        self.file_names = get_data_path('taxdump/names.dmp')
+        self.file_merged = get_data_path('taxdump/merged.dmp')
+        self.tax = load_taxonomy(self.file_nodes, self.file_names,
+                                 self.file_merged)
+
+    def test_jump(self):
+        # two chains 4 -> 3 -> 1 -> 0 and 5 -> 2, and a loner 6
+        up = np.array([0, 0, 2, 1, 3, 2, 6])
+        self.assertEqual(jump(up).tolist(), [0, 0, 2, 0, 0, 2, 6])
+        self.assertEqual(jump(np.arange(0)).tolist(), [])
+
+    def test_current(self):
+        np.testing.assert_array_equal(
+            self.tax.current([562, '13', 12, 1806, 99999, 0, -5]),
+            [562, 561, 561, 1280, 0, 0, 0])
+
+    def test_rollup(self):
+        np.testing.assert_array_equal(
+            self.tax.rollup([83333, 562, 561, 13, 622, 12333, 99999],
+                            'genus'),
+            [561, 561, 561, 561, 620, 0, 0])
+        np.testing.assert_array_equal(
+            self.tax.rollup(['83333', '1280', '28890'], 'phylum'),
+            [1224, 1239, 28890])
+        self.assertRaises(ValueError, self.tax.rollup, [562], 'kingdom')
+
+    def test_lineage(self):
+        np.testing.assert_array_equal(
+            self.tax.lineage([83333, 12333]),
+            [[2, 1224, 1236, 91347, 543, 561, 562],
+             [10239, 0, 0, 0, 0, 0, 0]])
+        np.testing.assert_array_equal(
+            self.tax.lineage([1806], ranks=['genus', 'superkingdom']),
+            [[1279, 2]])
+
+    def test_path(self):
+        self.assertEqual(self.tax.path(562),
+                         [1, 131567, 2, 1224, 1236, 91347, 543, 561, 562])
+        self.assertEqual(self.tax.path(1), [1])
+        self.assertEqual(self.tax.path(99999), [])
+        self.assertEqual(self.tax.depth[562], 8)
+
+    def test_lca(self):
+        np.testing.assert_array_equal(
+            self.tax.lca([562, 562, 562, 12333, 83333, 562, 562],
+                         [622, 1280, 28890, 562, 561, 99999, 562]),
+            [543, 2, 131567, 1, 561, 0, 562])
+        np.testing.assert_array_equal(self.tax.lca(1806, [1280, 622]),
+                                      [1280, 2])
+
+    def test_lca_all(self):
+        self.assertEqual(self.tax.lca_all([83333, 622, 561]), 543)
+        self.assertEqual(self.tax.lca_all([83333, 622, 561, 1280, 28890]),
+                         131567)
+        self.assertEqual(self.tax.lca_all(['562']), 562)
+        self.assertEqual(self.tax.lca_all([562, 99999]), 0)
+        self.assertEqual(self.tax.lca_all([]), 0)
+
+    def test_names(self):
+        self.assertEqual(self.tax.names([562, 2, 13, 99999]),
+                         ['Escherichia coli', 'Bacteria', 'Escherichia',
+                          None])
+        tax = load_taxonomy(self.file_nodes)
+        self.assertRaises(ValueError, tax.names, [562])
+
+    def test_collapse(self):
+        table = pd.DataFrame([[1, 2], [3, 4], [5, 6], [7, 8], [9, 10]],
+                             index=['562', '83333', '622', '1806', '12333'],
+                             columns=['sampleA', 'sampleB'])
+        exp = pd.DataFrame([[4, 6], [5, 6], [7, 8]],
+                           index=['561', '620', '1279'],
+                           columns=['sampleA', 'sampleB'])
+        obs = self.tax.collapse(table, 'genus')
+        assert_frame_equal(obs.sort_index(), exp.sort_index())
+
+    def test_load_taxonomy_cache(self):
+        with TemporaryDirectory() as tmp:
+            file_nodes = join(tmp, 'nodes.dmp')
+            copy(self.file_nodes, file_nodes)
+            cache_dir = join(tmp, 'cache')
+
+            tax = load_taxonomy(file_nodes, self.file_names,
+                                self.file_merged, cache_dir=cache_dir)
+            self.assertNotIsInstance(tax.parent, np.memmap)
+
+            # second load maps the cached arrays
+            tax = load_taxonomy(file_nodes, self.file_names,
+                                self.file_merged, cache_dir=cache_dir)
+            self.assertIsInstance(tax.parent, np.memmap)
+            np.testing.assert_array_equal(tax.parent, self.tax.parent)
+            np.testing.assert_array_equal(
+                tax.lineage([83333, 13]), self.tax.lineage([83333, 13]))
+            self.assertEqual(tax.names([562]), ['Escherichia coli'])
+
+            # changed dump files invalidate the cache
+            with open(file_nodes, 'a') as f:
+                f.write('\t|\t'.join(['2158', '2157', 'phylum', ''] +
+                                       ['0'] * 9 + ['']) + '\t|\n')
+            tax = load_taxonomy(file_nodes, self.file_names,
+                                self.file_merged, cache_dir=cache_dir)
+            self.assertNotIsInstance(tax.parent, np.memmap)
+            np.testing.assert_array_equal(tax.rollup([2158], 'superkingdom'),
+                                          [2157])
+
+
+if __name__ == '__main__':
+    main()
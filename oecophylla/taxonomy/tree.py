@@ -0,0 +1,411 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+
+# major ranks of a lineage, from top to bottom
+RANKS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus',
+         'species']
+
+
+def _read_dmp(filename, columns, names, dtype):
+    """Reads columns of an NCBI taxonomy dump file (delimited by '\t|\t')."""
+    # fields are separated by "\t|\t", hence the actual values are found in
+    # every other tab delimited column
+    return pd.read_csv(filename, sep='\t', header=None, usecols=columns,
+                       names=names, dtype=dtype, quoting=3,
+                       keep_default_na=False)
+
+
+def jump(up):
+    """Follows pointers until every element points to a fixed point.
+
+    Parameters
+    ----------
+    up : numpy.array of int
+        position each element points to, e.g. the parent of each node of a
+        forest, whose roots point to themselves
+
+    Returns
+    -------
+    numpy.array of int
+        fixed point reached from each element, e.g. the root of its tree
+
+    Notes
+    -----
+    Pointers are doubled at each step (pointer jumping), so that the number
+    of steps grows with the logarithm of the longest path only.
+    """
+    while True:
+        nxt = up[up]
+        if np.array_equal(nxt, up):
+            return up
+        up = nxt
+
+
+def _depth(parent):
+    """Computes the distance of every node to the top of its tree."""
+    up = parent.copy()
+    dist = (up != np.arange(len(up))).astype(np.int32)
+    while True:
+        nxt = up[up]
+        if np.array_equal(nxt, up):
+            return dist
+        dist = dist + dist[up]
+        up = nxt
+
+
+class Taxonomy(object):
+    """NCBI taxonomy tree held in NumPy arrays indexed by TaxID.
+
+    Parameters
+    ----------
+    parent : numpy.array of int
+        TaxID of the parent of each TaxID. The root is its own parent, and
+        TaxIDs not in the taxonomy point to 0.
+    rank : numpy.array of int
+        rank of each TaxID, as index into `ranks`
+    ranks : list of str
+        rank names
+    alias : numpy.array of int
+        current TaxID of each current or merged TaxID, 0 for unknown TaxIDs
+    depth : numpy.array of int
+        distance of each TaxID to the root
+    names : tuple of (numpy.array of uint8, numpy.array of int) (optional)
+        scientific names as UTF-8 bytes of all TaxIDs concatenated, and the
+        offset of each TaxID's name in them
+
+    Notes
+    -----
+    Queries take any iterable of TaxIDs (int or str) and are answered for
+    all of them at once, by NumPy operations over the arrays.
+    """
+
+    def __init__(self, parent, rank, ranks, alias, depth, names=None):
+        self.parent = parent
+        self.rank = rank
+        self.ranks = ranks
+        self.alias = alias
+        self.depth = depth
+        self._names = names
+        self._ancestors = {}
+
+    def _index(self, taxids):
+        """Translates TaxIDs into current TaxIDs, 0 for unknown ones."""
+        taxids = np.atleast_1d(np.asarray(taxids)).astype(np.int64)
+        valid = (taxids > 0) & (taxids < len(self.alias))
+        res = np.zeros(taxids.shape, dtype=np.int64)
+        res[valid] = self.alias[taxids[valid]]
+        return res
+
+    def current(self, taxids):
+        """Returns the current TaxIDs of possibly merged ones.
+
+        Parameters
+        ----------
+        taxids : iterable of int or str
+            TaxIDs
+
+        Returns
+        -------
+        numpy.array of int
+            current TaxIDs, 0 for TaxIDs not in the taxonomy
+        """
+        return self._index(taxids)
+
+    def rollup(self, taxids, rank):
+        """Returns the ancestors of TaxIDs at a given rank.
+
+        Parameters
+        ----------
+        taxids : iterable of int or str
+            TaxIDs
+        rank : str
+            rank name, e.g. "genus"
+
+        Returns
+        -------
+        numpy.array of int
+            TaxIDs of the ancestor (or self) at the rank, 0 if there is none
+
+        Raises
+        ------
+        ValueError
+            if the rank is not in the taxonomy
+        """
+        anc = self._ancestors.get(rank)
+        if anc is None:
+            code = self.ranks.index(rank)
+            # nodes at the rank point to themselves, all others to their
+            # parents, so that jumping ends at the closest node at the rank
+            nodes = np.arange(len(self.parent))
+            up = jump(np.where(self.rank == code, nodes, self.parent))
+            anc = np.where(self.rank[up] == code, up, 0)
+            self._ancestors[rank] = anc
+        return anc[self._index(taxids)]
+
+    def lineage(self, taxids, ranks=None):
+        """Returns the ancestors of TaxIDs at several ranks.
+
+        Parameters
+        ----------
+        taxids : iterable of int or str
+            TaxIDs
+        ranks : list of str (optional)
+            rank names (default: RANKS)
+
+        Returns
+        -------
+        numpy.array of int
+            with rows for TaxIDs and columns for ranks, 0 where there is no
+            ancestor at the rank
+        """
+        if ranks is None:
+            ranks = RANKS
+        return np.column_stack([self.rollup(taxids, rank) for rank in ranks])
+
+    def path(self, taxid):
+        """Returns the path from the root to a TaxID.
+
+        Parameters
+        ----------
+        taxid : int or str
+            TaxID
+
+        Returns
+        -------
+        list of int
+            TaxIDs from the root down to (current) `taxid`, empty if the
+            TaxID is not in the taxonomy
+        """
+        node = int(self._index([taxid])[0])
+        if node == 0:
+            return []
+        path = [node]
+        while self.parent[node] != node and self.parent[node] != 0:
+            node = int(self.parent[node])
+            path.append(node)
+        return path[::-1]
+
+    def _lca(self, a, b):
+        a, b = (x.copy() for x in np.broadcast_arrays(a, b))
+        invalid = (a == 0) | (b == 0)
+        a[invalid], b[invalid] = 0, 0
+        da, db = self.depth[a], self.depth[b]
+
+        # lift the deeper node of each pair to the depth of the other
+        for x, dx, dy in ((a, da, db), (b, db, da)):
+            while True:
+                deeper = dx > dy
+                if not deeper.any():
+                    break
+                x[deeper] = self.parent[x[deeper]]
+                dx[deeper] -= 1
+
+        # lift both nodes until they meet, or reach the tops of their trees
+        while True:
+            todo = (a != b) & ~((self.parent[a] == a) & (self.parent[b] == b))
+            if not todo.any():
+                break
+            a[todo] = self.parent[a[todo]]
+            b[todo] = self.parent[b[todo]]
+        return np.where(a == b, a, 0)
+
+    def lca(self, taxids_a, taxids_b):
+        """Returns the lowest common ancestors of pairs of TaxIDs.
+
+        Parameters
+        ----------
+        taxids_a, taxids_b : iterable of int or str
+            TaxIDs, pairwise (or one of them a single TaxID)
+
+        Returns
+        -------
+        numpy.array of int
+            TaxIDs of the lowest common ancestors, 0 for pairs involving
+            TaxIDs not in the taxonomy
+        """
+        return self._lca(self._index(taxids_a), self._index(taxids_b))
+
+    def lca_all(self, taxids):
+        """Returns the lowest common ancestor of a set of TaxIDs.
+
+        Parameters
+        ----------
+        taxids : iterable of int or str
+            TaxIDs
+
+        Returns
+        -------
+        int
+            TaxID of the lowest common ancestor, 0 if there is none
+        """
+        nodes = self._index(list(taxids))
+        # combine pairs of halves until a single node is left
+        while len(nodes) > 1:
+            half = len(nodes) // 2
+            nodes = np.concatenate([
+                self._lca(nodes[:half], nodes[half:2 * half]),
+                nodes[2 * half:]])
+        return int(nodes[0]) if len(nodes) else 0
+
+    def names(self, taxids):
+        """Returns the scientific names of TaxIDs.
+
+        Parameters
+        ----------
+        taxids : iterable of int or str
+            TaxIDs
+
+        Returns
+        -------
+        list of str
+            names, None for TaxIDs without a name
+
+        Raises
+        ------
+        ValueError
+            if the taxonomy was loaded without names
+        """
+        if self._names is None:
+            raise ValueError('Taxonomy was loaded without names')
+        blob, offsets = self._names
+        res = []
+        for node in self._index(taxids):
+            start, end = offsets[node], offsets[node + 1]
+            res.append(bytes(blob[start:end]).decode() if end > start
+                       else None)
+        return res
+
+    def collapse(self, table, rank):
+        """Collapses a table to a given rank.
+
+        Parameters
+        ----------
+        table : Pandas.DataFrame
+            with rows for TaxIDs, columns for samples
+        rank : str
+            rank name, e.g. "genus"
+
+        Returns
+        -------
+        Pandas.DataFrame
+            with rows for TaxIDs at the rank, holding the sums of all rows
+            below them. Rows without ancestor at the rank are dropped. TaxIDs
+            are strings if they were strings in `table`.
+        """
+        ids = self.rollup(table.index, rank)
+        res = table.groupby(ids).sum()
+        res = res[res.index != 0]
+        if table.index.dtype == object:
+            res.index = res.index.map(str)
+        res.index.name = table.index.name
+        return res
+
+
+def _file_stats(filenames):
+    stats = []
+    for filename in filenames:
+        st = os.stat(filename)
+        stats.append([os.path.abspath(filename), st.st_size, st.st_mtime_ns])
+    return stats
+
+
+def _build(nodes, names, merged):
+    """Reads an NCBI taxonomy dump into the arrays of a Taxonomy."""
+    df = _read_dmp(nodes, [0, 2, 4], ['taxid', 'parent', 'rank'],
+                   {'taxid': np.int64, 'parent': np.int64, 'rank': str})
+    old, new = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if merged is not None:
+        dfm = _read_dmp(merged, [0, 2], ['old', 'new'], np.int64)
+        old, new = dfm['old'].values, dfm['new'].values
+
+    size = max(df['taxid'].max(), old.max() if len(old) else 0) + 1
+    parent = np.zeros(size, dtype=np.int32)
+    parent[df['taxid'].values] = df['parent'].values
+    rank_codes, ranks = pd.factorize(df['rank'], sort=True)
+    rank = np.full(size, -1, dtype=np.int16)
+    rank[df['taxid'].values] = rank_codes
+
+    # current TaxIDs point to themselves, merged ones (transitively) to the
+    # TaxIDs they were merged into
+    alias = np.zeros(size, dtype=np.int32)
+    alias[df['taxid'].values] = df['taxid'].values
+    alias[old] = new
+    alias = jump(alias)
+
+    arrays = {'parent': parent, 'rank': rank, 'alias': alias,
+              'depth': _depth(parent)}
+
+    if names is not None:
+        dfn = _read_dmp(names, [0, 2, 6], ['taxid', 'name', 'class'],
+                        {'taxid': np.int64, 'name': str, 'class': str})
+        dfn = dfn[dfn['class'] == 'scientific name'].drop_duplicates(
+            'taxid').sort_values('taxid')
+        encoded = [x.encode() for x in dfn['name']]
+        lengths = np.zeros(size, dtype=np.int64)
+        lengths[dfn['taxid'].values] = [len(x) for x in encoded]
+        arrays['names_offsets'] = np.concatenate([[0], np.cumsum(lengths)])
+        arrays['names_blob'] = np.frombuffer(b''.join(encoded),
+                                             dtype=np.uint8)
+    return arrays, list(ranks)
+
+
+def load_taxonomy(nodes, names=None, merged=None, cache_dir=None):
+    """Loads an NCBI taxonomy dump.
+
+    Parameters
+    ----------
+    nodes : str
+        Path to the "nodes.dmp" file of an NCBI taxonomy dump.
+    names : str (optional)
+        Path to the "names.dmp" file, to look up scientific names.
+    merged : str (optional)
+        Path to the "merged.dmp" file, to translate merged TaxIDs.
+    cache_dir : str (optional)
+        Directory to cache the parsed taxonomy in as binary arrays. These are
+        memory-mapped by later calls, as long as the dump files did not
+        change.
+
+    Returns
+    -------
+    Taxonomy
+    """
+    sources = _file_stats([x for x in (nodes, names, merged)
+                           if x is not None])
+    fp_meta = None if cache_dir is None else os.path.join(cache_dir,
+                                                          'taxonomy.json')
+    meta = None
+    if fp_meta is not None and os.path.exists(fp_meta):
+        with open(fp_meta, 'r') as f:
+            meta = json.load(f)
+        if meta['sources'] != sources:
+            meta = None
+
+    if meta is None:
+        arrays, ranks = _build(nodes, names, merged)
+        if cache_dir is not None:
+            # files are replaced atomically, and the meta file last, as
+            # several jobs may load the same taxonomy at once
+            os.makedirs(cache_dir, exist_ok=True)
+            for key, array in arrays.items():
+                fp_array = os.path.join(cache_dir, '%s.npy' % key)
+                with open(fp_array + '.%d.tmp' % os.getpid(), 'wb') as f:
+                    np.save(f, array)
+                os.replace(f.name, fp_array)
+            with open(fp_meta + '.%d.tmp' % os.getpid(), 'w') as f:
+                json.dump({'sources': sources, 'ranks': ranks,
+                           'arrays': sorted(arrays)}, f)
+            os.replace(f.name, fp_meta)
+    else:
+        arrays = {key: np.load(os.path.join(cache_dir, '%s.npy' % key),
+                               mmap_mode='r') for key in meta['arrays']}
+        ranks = meta['ranks']
+
+    names = None
+    if 'names_blob' in arrays:
+        names = (arrays['names_blob'], arrays['names_offsets'])
+    return Taxonomy(arrays['parent'], arrays['rank'], ranks, arrays['alias'],
+                    arrays['depth'], names)
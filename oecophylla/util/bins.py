@@ -0,0 +1,108 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from oecophylla.util.seqio import fasta_headers, open_output
+
+
+def bin_name(bin_fp):
+    """ Names a bin after the number in its MaxBin FASTA file name.
+
+    Parameters
+    ----------
+    bin_fp : str
+       Path to a bin FASTA file, e.g. "sample.001.fasta".
+
+    Returns
+    -------
+    str
+       Name of the bin, e.g. "Bin_001".
+    """
+    return 'Bin_' + str(os.path.basename(bin_fp).split('.')[-2])
+
+
+def _bin_contigs(bin_fp):
+    return list(fasta_headers(bin_fp))
+
+
+def summarize_bins(bin_fps, output_fp, index_fp=None, threads=1):
+    """ Writes the bin of every contig of a set of bin FASTA files.
+
+    Parameters
+    ----------
+    bin_fps : list of str
+       Paths to the bin FASTA files.
+    output_fp : str
+       Path to write the table of contigs and their bins to (format:
+       contig<tab>bin).
+    index_fp : str, optional
+       Path to write a binary index of contigs to bins to (see
+       `read_bin_index`).
+    threads : int, optional
+       Number of processes scanning bin files in parallel.
+
+    Returns
+    -------
+    int
+       Number of contigs.
+
+    Notes
+    -----
+    Only header lines are parsed.  Rows are written as soon as the headers of
+    a bin are read, in the order of `bin_fps`.
+    """
+    bin_fps = list(bin_fps)
+    names = [bin_name(fp) for fp in bin_fps]
+    contigs, codes, count = [], [], 0
+    executor = ProcessPoolExecutor(threads) if threads > 1 else None
+    try:
+        scanned = map(_bin_contigs, bin_fps) if executor is None else \
+            executor.map(_bin_contigs, bin_fps)
+        with open_output(output_fp) as out:
+            for code, (name, headers) in enumerate(zip(names, scanned)):
+                out.write(''.join('%s\t%s\n' % (contig, name)
+                                  for contig in headers).encode())
+                count += len(headers)
+                if index_fp is not None:
+                    contigs.extend(headers)
+                    codes.append(np.full(len(headers), code,
+                                         dtype=np.int32))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if index_fp is not None:
+        contigs = np.array([contig.encode() for contig in contigs],
+                           dtype=bytes)
+        codes = np.concatenate(codes) if codes else \
+            np.zeros(0, dtype=np.int32)
+        order = np.argsort(contigs, kind='mergesort')
+        with open(index_fp + '.tmp', 'wb') as f:
+            np.savez(f, contigs=contigs[order], codes=codes[order],
+                     bins=np.array([name.encode() for name in names],
+                                   dtype=bytes))
+        os.replace(index_fp + '.tmp', index_fp)
+    return count
+
+
+def read_bin_index(index_fp):
+    """ Reads a binary index of contigs to bins.
+
+    Parameters
+    ----------
+    index_fp : str
+       Path to an index written by `summarize_bins`.
+
+    Returns
+    -------
+    pd.Series
+       Bins (categorical) of contigs, indexed by sorted contig names.
+    """
+    with np.load(index_fp, allow_pickle=False) as npz:
+        contigs = np.char.decode(npz['contigs'])
+        bins = pd.Categorical.from_codes(npz['codes'],
+                                         np.char.decode(npz['bins']))
+    return pd.Series(bins, index=pd.Index(contigs, name='contig'),
+                     name='bin')
@@ -0,0 +1,162 @@
+import json
+import os
+import time
+
+
+MANIFEST_FN = 'input_manifest.json'
+
+# version of the manifest format, older manifests are discarded
+MANIFEST_VERSION = 2
+
+
+def read_manifest(manifest_fp):
+    """ Reads an input manifest.
+
+    Parameters
+    ----------
+    manifest_fp : str
+       Path to the manifest file.
+
+    Returns
+    -------
+    dict
+       The manifest, with a 'dirs' entry per scanned input directory and
+       an optional 'samples' entry holding the cached sample table.  An
+       empty manifest is returned if the file is missing, unreadable or of
+       an older version.
+    """
+    try:
+        with open(manifest_fp) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+    if not isinstance(manifest, dict) or 'dirs' not in manifest or \
+            manifest.get('version') != MANIFEST_VERSION:
+        manifest = {'version': MANIFEST_VERSION, 'dirs': {}}
+    return manifest
+
+
+def write_manifest(manifest_fp, manifest):
+    """ Writes an input manifest, replacing any previous one atomically.
+
+    Parameters
+    ----------
+    manifest_fp : str
+       Path to the manifest file.
+    manifest : dict
+       The manifest, as returned by `read_manifest`.
+    """
+    tmp_fp = '%s.tmp' % manifest_fp
+    with open(tmp_fp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_fp, manifest_fp)
+
+
+def scan_input_dir(seq_dir, manifest):
+    """ Lists a directory, reusing the manifest entry if it is unchanged.
+
+    Parameters
+    ----------
+    seq_dir : str
+       Input directory containing all of the sample files.
+    manifest : dict
+       The manifest, as returned by `read_manifest`.  Its entry for
+       `seq_dir` is updated in place.
+
+    Returns
+    -------
+    list of str
+       Sorted names of the files in `seq_dir`.
+    bool
+       Whether the listing differs from the one in the manifest.
+
+    Notes
+    -----
+    A directory is only re-read if its mtime or inode differ from the
+    ones recorded in the manifest.  The name, size, mtime, inode and
+    device of every file (or the file a link points to) are taken from the
+    `os.scandir` entries.  A directory
+    modified within the same second as the scan is recorded without a
+    stat, so that it is re-read on the next call.
+    """
+    seq_dir = os.path.abspath(seq_dir)
+    cached = manifest['dirs'].get(seq_dir)
+    st = os.stat(seq_dir)
+    dir_stat = [st.st_mtime_ns, st.st_ino]
+
+    if cached is not None and cached['stat'] == dir_stat:
+        return sorted(cached['files']), False
+
+    files = {}
+    with os.scandir(seq_dir) as it:
+        for entry in it:
+            if entry.is_file():
+                est = entry.stat()
+                files[entry.name] = [est.st_size, est.st_mtime_ns,
+                                     est.st_ino, est.st_dev]
+
+    if int(time.time()) <= st.st_mtime_ns // 10**9:
+        dir_stat = None
+
+    changed = cached is None or cached['files'] != files
+    manifest['dirs'][seq_dir] = {'stat': dir_stat, 'files': files}
+    return sorted(files), changed
+
+
+def _sample_table_key(manifest, seq_dirs, sample_sheet=None):
+    key = {'dirs': [[d, manifest['dirs'][d]['stat']] for d in seq_dirs]}
+    if sample_sheet is not None:
+        st = os.stat(sample_sheet)
+        key['sample_sheet'] = [os.path.abspath(sample_sheet),
+                               st.st_size, st.st_mtime_ns]
+    return key
+
+
+def get_sample_table(manifest, seq_dirs, sample_sheet=None):
+    """ Obtains the cached sample table, if its inputs are unchanged.
+
+    Parameters
+    ----------
+    manifest : dict
+       The manifest, after `scan_input_dir` was called on every directory
+       in `seq_dirs`.
+    seq_dirs : list of str
+       Input directories the sample table was built from.
+    sample_sheet : str, optional
+       Sample sheet the sample table was built from.
+
+    Returns
+    -------
+    dict of list of str or None
+       The cached sample table, or None if it needs to be rebuilt.
+    """
+    seq_dirs = [os.path.abspath(d) for d in seq_dirs]
+    cached = manifest.get('samples')
+    if cached is None:
+        return None
+    if any(manifest['dirs'][d]['stat'] is None for d in seq_dirs):
+        return None
+    if cached['key'] != _sample_table_key(manifest, seq_dirs, sample_sheet):
+        return None
+    return cached['table']
+
+
+def set_sample_table(manifest, seq_dirs, table, sample_sheet=None):
+    """ Stores a sample table in the manifest.
+
+    Parameters
+    ----------
+    manifest : dict
+       The manifest, after `scan_input_dir` was called on every directory
+       in `seq_dirs`.
+    seq_dirs : list of str
+       Input directories the sample table was built from.
+    table : dict of list of str
+       Samples with a list of their forward and reverse files.
+    sample_sheet : str, optional
+       Sample sheet the sample table was built from.
+    """
+    seq_dirs = [os.path.abspath(d) for d in seq_dirs]
+    manifest['samples'] = {
+        'key': _sample_table_key(manifest, seq_dirs, sample_sheet),
+        'table': table}
@@ -1,18 +1,20 @@
 import os
 import re
+import warnings
 import pandas as pd
-import copy
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+
+from oecophylla.util.manifest import scan_input_dir
 
 
 # Option 1 : parse samples from directory
-def illumina_filenames_to_df(filepaths, pattern = None, column_names = None):
-    """ Generates sample sheet from filenames using a regex pattern.
+def index_illumina_filenames(filepaths, pattern=None, column_names=None):
+    """ Indexes filenames against a regex pattern in a single pass.
 
     Parameters
     ----------
-    filepaths: list of str
-        List of file paths to parse
+    filepaths: iterable of str
+        File paths to parse
     pattern: str, optional
         Regex pattern to recognize the filenames, to load into the
         sample sheet.
@@ -22,31 +24,117 @@ def illumina_filenames_to_df(filepaths, pattern = None, column_names = None):
         is assumed to be in the same ordering as the regex pattern.
         default: ['File', 'Sample', 'Index', 'Lane',
                   'Read', 'Run', 'Extension']
+
     Returns
     -------
     df : pd.DataFrame
        Sample sheet dataframe with all of the sample information.
+    unmatched : list of str
+       File paths that did not match the pattern, in input order.
 
     Notes
     -----
-    This function is very illumina specific.
+    Every filename is matched exactly once and the table is built in one
+    step, so the cost is linear in the number of files.
     """
     if pattern is None:
         pattern = '^((.+?)_(S\d+)_(L\d+)_(R[12])_(\d+)\.(.+))$'
     if column_names is None:
         column_names = ['File', 'Sample', 'Index', 'Lane',
                         'Read', 'Run', 'Extension']
-    p = re.compile(pattern)
-    df = pd.DataFrame(columns = column_names)
+    match = re.compile(pattern).match
 
+    rows, unmatched = [], []
     for f in filepaths:
-        m = p.match(f)
+        m = match(f)
         if m:
-            df = df.append(dict(zip(column_names, m.groups())),
-                           ignore_index = True)
+            rows.append(m.groups())
+        else:
+            unmatched.append(f)
+
+    df = pd.DataFrame.from_records(rows, columns=column_names)
+    return df, unmatched
+
+
+def illumina_filenames_to_df(filepaths, pattern = None, column_names = None):
+    """ Generates sample sheet from filenames using a regex pattern.
+
+    Parameters
+    ----------
+    filepaths: list of str
+        List of file paths to parse
+    pattern: str, optional
+        Regex pattern to recognize the filenames, to load into the
+        sample sheet.
+        default: '^((.+?)_(S\d+)_(L\d+)_(R[12])_(\d+)\.(.+))$'
+    column_names: list, optional
+        Column names for the generated sample sheet.  Note that this
+        is assumed to be in the same ordering as the regex pattern.
+        default: ['File', 'Sample', 'Index', 'Lane',
+                  'Read', 'Run', 'Extension']
+    Returns
+    -------
+    df : pd.DataFrame
+       Sample sheet dataframe with all of the sample information.
+
+    Notes
+    -----
+    This function is very illumina specific.  Files that do not match the
+    pattern are reported with a warning; use `index_illumina_filenames`
+    to obtain them directly.
+    """
+    df, unmatched = index_illumina_filenames(filepaths, pattern=pattern,
+                                             column_names=column_names)
+    if unmatched:
+        shown = ', '.join(unmatched[:10])
+        if len(unmatched) > 10:
+            shown += ', ...'
+        warnings.warn('%d file(s) did not match the filename pattern and '
+                      'were skipped: %s' % (len(unmatched), shown))
     return df
 
 
+def index_sample_files(df, key_cols, file_col='File'):
+    """ Groups file names by the values of the key columns.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+       Sample sheet dataframe with all of the sample information.
+    key_cols : list of str
+       Column names whose values form the lookup key, e.g.
+       ['Sample', 'Lane', 'Read'].
+    file_col : str
+       Column name for the file name in the sample sheet.
+
+    Returns
+    -------
+    dict of list of str
+       Tuples of key column values with a sorted list of their files.
+
+    Notes
+    -----
+    The index is built in one pass over the table, so that every key can
+    afterwards be resolved in constant time.
+    """
+    index = {}
+    keys = zip(*[df[c].values for c in key_cols])
+    for key, f in zip(keys, df[file_col].values):
+        if key in index:
+            index[key].append(f)
+        else:
+            index[key] = [f]
+    for files in index.values():
+        files.sort()
+    return index
+
+
+def _join_paths(seq_dir, fps):
+    if seq_dir is None:
+        return list(fps)
+    return [os.path.join(seq_dir, x) for x in fps]
+
+
 def extract_sample_reads(df, seq_dir,
                          sample_col='Sample',
                          read_col='Read',
@@ -57,8 +145,9 @@ def extract_sample_reads(df, seq_dir,
     ----------
     df : pd.DataFrame
        Sample sheet dataframe with all of the sample information.
-    seq_dir : str
-       Input directory containing all of the sample files.
+    seq_dir : str or None
+       Input directory containing all of the sample files.  If None,
+       `file_col` is expected to hold the full file paths.
     sample_col : str
        Column name for the samples in the sample sheet.
     read_col : str
@@ -79,43 +168,200 @@ def extract_sample_reads(df, seq_dir,
     """
     sample_reads_dict = {}
 
-
     samples = list(df[sample_col].unique())
+    file_index = index_sample_files(df, [sample_col, read_col], file_col)
 
     for s in samples:
-        fwd = df.loc[(df[sample_col] == s) & (df[read_col] == 'R1'), file_col]
-        rev = df.loc[(df[sample_col] == s) & (df[read_col] == 'R2'), file_col]
-        f_fps = sorted(list(fwd.values))
-        r_fps = sorted(list(rev.values))
+        f_fps = file_index.get((s, 'R1'), [])
+        r_fps = file_index.get((s, 'R2'), [])
 
-        sample_reads_dict[s] = {'forward': [os.path.join(seq_dir, x) for x in f_fps],
-                                'reverse': [os.path.join(seq_dir, x) for x in r_fps]}
+        sample_reads_dict[s] = {'forward': _join_paths(seq_dir, f_fps),
+                                'reverse': _join_paths(seq_dir, r_fps)}
 
     return sample_reads_dict
 
 
-def extract_sample_paths(seq_dir):
+def scan_input_dirs(seq_dirs, manifest, threads=None):
+    """ Lists several input directories concurrently.
+
+    Parameters
+    ----------
+    seq_dirs : list of str
+       Input directories containing the sample files.
+    manifest : dict
+       Input manifest, as returned by `read_manifest`.  Unchanged
+       directories are not listed again, and the manifest is updated in
+       place.
+    threads : int, optional
+       Number of directories to list concurrently.
+       default: one per directory, up to 16
+
+    Returns
+    -------
+    seq_dirs : list of str
+       Input directories, without the ones given more than once, e.g. by
+       symbolic links.
+    listings : list of list of str
+       Sorted names of the files in each directory.
+
+    Notes
+    -----
+    Listing is bound by file system latency rather than CPU, so the
+    directories are scanned by a thread pool.  Only file metadata is read,
+    so that a cached sample table can be checked before any file name is
+    parsed.
+    """
+    if threads is None:
+        threads = min(16, len(seq_dirs))
+
+    # drop directories given more than once
+    unique_dirs = {}
+    for d in seq_dirs:
+        unique_dirs.setdefault(os.path.realpath(d), d)
+    seq_dirs = list(unique_dirs.values())
+
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        listings = list(executor.map(
+            lambda d: scan_input_dir(d, manifest)[0], seq_dirs))
+    return seq_dirs, listings
+
+
+def index_input_files(seq_dirs, listings, manifest):
+    """ Indexes the Illumina files of scanned input directories.
+
+    Parameters
+    ----------
+    seq_dirs : list of str
+       Input directories, as returned by `scan_input_dirs`.
+    listings : list of list of str
+       Names of the files in each directory, as returned by
+       `scan_input_dirs`.
+    manifest : dict
+       Input manifest the directories were scanned into.
+
+    Returns
+    -------
+    files_df : pd.DataFrame
+       Sample sheet dataframe as returned by `illumina_filenames_to_df`,
+       with an additional 'Path' column holding the file paths.
+
+    Notes
+    -----
+    A file reached through several directories, e.g. by symbolic links, is
+    only used once: files are told apart by the inode and device recorded
+    in the manifest, so that no path is resolved.
+    """
+    frames = []
+    for d, fps in zip(seq_dirs, listings):
+        files = manifest['dirs'][os.path.abspath(d)]['files']
+        df = illumina_filenames_to_df(fps)
+        df['Path'] = _join_paths(d, df['File'])
+        df['Inode'] = [files[f][2] for f in df['File']]
+        df['Device'] = [files[f][3] for f in df['File']]
+        frames.append(df)
+    files_df = pd.concat(frames, ignore_index=True)
+
+    files_df = files_df.drop_duplicates(['Inode', 'Device'])
+    files_df = files_df.drop(columns=['Inode', 'Device'])
+    return files_df.reset_index(drop=True)
+
+
+def index_input_dirs(seq_dirs, manifest=None, threads=None):
+    """ Indexes the Illumina files found in several input directories.
+
+    Parameters
+    ----------
+    seq_dirs : list of str
+       Input directories containing the sample files.
+    manifest : dict, optional
+       Input manifest, as returned by `read_manifest`.  If provided,
+       unchanged directories are not listed again, and the manifest is
+       updated in place.
+    threads : int, optional
+       Number of directories to list concurrently.
+       default: one per directory, up to 16
+
+    Returns
+    -------
+    files_df : pd.DataFrame
+       Sample sheet dataframe as returned by `illumina_filenames_to_df`,
+       with an additional 'Path' column holding the file paths.
+
+    See Also
+    --------
+    scan_input_dirs
+    index_input_files
+    """
+    if manifest is None:
+        manifest = {'dirs': {}}
+    seq_dirs, listings = scan_input_dirs(seq_dirs, manifest, threads)
+    return index_input_files(seq_dirs, listings, manifest)
+
+
+def extract_sample_paths(seq_dir, manifest=None, threads=None):
     """ Obtain the sample paths.
 
     Parameters
     ----------
-    seq_dir : str
-       Input directory containing all of the sample files.
+    seq_dir : str or list of str
+       Input directory, or directories, containing all of the sample files.
+    manifest : dict, optional
+       Input manifest, as returned by `read_manifest`.  If provided, the
+       directory listing is taken from the manifest unless the directory
+       changed, and the manifest is updated in place.
+    threads : int, optional
+       Number of directories to list concurrently.
 
     Returns
     -------
     dict of list of str
        Samples with a list of their forward and reverse files.
     """
-    fps = os.listdir(seq_dir)
+    if isinstance(seq_dir, str):
+        seq_dir = [seq_dir]
 
-    files_df = illumina_filenames_to_df(fps)
-    sample_reads_dict = extract_sample_reads(files_df, seq_dir)
+    files_df = index_input_dirs(seq_dir, manifest=manifest, threads=threads)
+    sample_reads_dict = extract_sample_reads(files_df, None, file_col='Path')
 
     return sample_reads_dict
 
 
 # Option 2: read samples from sample sheet
+class _SectionReader(object):
+    """ File-like view over the lines of a single sample sheet section.
+
+    Lets `pd.read_csv` consume the section directly from the open file,
+    without first copying it into a string.
+    """
+    def __init__(self, lines):
+        self._lines = lines
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(self._lines)
+        chunk, n = [], 0
+        for line in self._lines:
+            chunk.append(line)
+            n += len(line)
+            if n >= size:
+                break
+        return ''.join(chunk)
+
+    def __iter__(self):
+        return self._lines
+
+
+def _section_lines(fh, section):
+    # skip to the section header, then yield lines up to the next section
+    for line in fh:
+        if line.startswith(section):
+            break
+    for line in fh:
+        if line.startswith('[') or line.strip() == '':
+            return
+        yield line
+
+
 def read_sample_sheet(f, sep=',', comment='#'):
     """ Outputs a dataframe from a sample sheet
 
@@ -131,28 +377,37 @@ def read_sample_sheet(f, sep=',', comment='#'):
     data_df : pd.DataFrame
        DataFrame containing the sample sheet information.
 
+    Raises
+    ------
+    ValueError
+       If a (Sample_ID, Lane) combination occurs more than once, or a
+       sample has no lane.
+
+    Notes
+    -----
+    Only the [Data] section is read, and it is streamed into the parser.
+    Lanes are parsed as (nullable) integers and sample identifiers as
+    strings, so that numeric sample names keep matching the read file names.
     """
-    data = False
-    data_lines = ''
+    dtype = {'Lane': 'Int64',
+             'Sample_ID': str,
+             'Sample_Name': str,
+             'Description': str}
     with open(f) as fh:
-        for line in fh:
-            if data:
-                if line.startswith('[') or line.strip() == '':
-                    data = False
-                    continue
-                data_lines += line
-            elif line.startswith('[Data]'):
-                data = True
-                continue
-            else:
-                continue
-    data_df = pd.read_csv(StringIO(data_lines),
-                          sep=sep, comment=comment)
+        data_df = pd.read_csv(_SectionReader(_section_lines(fh, '[Data]')),
+                              sep=sep, comment=comment, dtype=dtype)
+
+    # Check that every sample has a lane, to match its read files against
+    missing = data_df['Lane'].isnull()
+    if missing.any():
+        raise ValueError('Not a valid sample sheet! Some samples have no '
+                         'lane.\nSamples without lane: %s' %
+                         ', '.join(data_df.loc[missing, 'Sample_ID']))
 
     # Check that no Sample_IDs are duplicated
-    counts = data_df.groupby(['Sample_ID','Lane']).count().iloc[:,1]
-    if counts.max() > 1:
-        dup_samples = counts.loc[counts > 1]
+    dups = data_df.duplicated(['Sample_ID', 'Lane'], keep=False)
+    if dups.any():
+        dup_samples = data_df.loc[dups, ['Sample_ID', 'Lane']]
         raise ValueError('Not a valid sample sheet! Some samples duplicated.\n'
                          'Duplicated samples:\n{}'.format(dup_samples))
     return(data_df)
@@ -163,7 +418,8 @@ def extract_samples_from_sample_sheet(sample_sheet_df, seq_dir,
                                       lane_col='Lane',
                                       file_col='File',
                                       read_col='Read',
-                                      prefix_col='Sample_ID'):
+                                      prefix_col='Sample_ID',
+                                      files_df=None):
 
     """ Obtains sample paths from a sample sheet.
 
@@ -171,8 +427,9 @@ def extract_samples_from_sample_sheet(sample_sheet_df, seq_dir,
     ----------
     sample_sheet_df : pd.DataFrame
        DataFrame containing the sample sheet information.
-    seq_dir : str
-       Input directory containing all of the sample files.
+    seq_dir : str or None
+       Input directory containing all of the sample files.  If None,
+       `file_col` is expected to hold the full file paths.
     sample_col : str
        Column name for the samples in the sample sheet.
     name_col : str
@@ -185,6 +442,9 @@ def extract_samples_from_sample_sheet(sample_sheet_df, seq_dir,
        Column name for the filename in the sample sheet.
     prefix_col : str
        Column name for the sample id in the sample sheet.
+    files_df : pd.DataFrame, optional
+       Files in `seq_dir` as returned by `illumina_filenames_to_df`.
+       If not provided, `seq_dir` is listed and parsed.
 
     Returns
     -------
@@ -192,37 +452,36 @@ def extract_samples_from_sample_sheet(sample_sheet_df, seq_dir,
        Samples with a list of their forward and reverse files.
 
     """
-    sample_reads_dict = {}
+    if files_df is None:
+        fps = os.listdir(seq_dir)
+        files_df = illumina_filenames_to_df(fps)
+
+    file_index = index_sample_files(files_df,
+                                    [sample_col, lane_col, read_col],
+                                    file_col)
+
+    # resolve every sample sheet row against the index
+    sample_files = {}
+    sheet = sample_sheet_df.dropna(subset=[name_col])
+    for s, prefix, lane in zip(sheet[name_col].values,
+                               sheet[prefix_col].values,
+                               sheet[lane_col].values):
+        lane = 'L{0:03d}'.format(lane)
+        if s not in sample_files:
+            sample_files[s] = ([], [])
+        f_fps, r_fps = sample_files[s]
+        f_fps.extend(file_index.get((prefix, lane, 'R1'), []))
+        r_fps.extend(file_index.get((prefix, lane, 'R2'), []))
 
-    samples = list(sample_sheet_df[name_col].unique())
-    fps = os.listdir(seq_dir)
-    files_df = illumina_filenames_to_df(fps)
-
-    # get the subset of sample sheet rows for that sample
-    for s, sample_rows in sample_sheet_df.groupby(name_col):
-
-        f_fps, r_fps = [], []
-
-        # iter across subset table and find file corresponding to each row
-        for idx, row in sample_rows.iterrows():
-            lane = 'L{0:03d}'.format(row[lane_col])
-            f_fps.extend(files_df.loc[(files_df[sample_col] == row[prefix_col]) &
-                                      (files_df[lane_col] == lane) &
-                                      (files_df[read_col] == 'R1'),
-                                      file_col].values)
-
-            r_fps.extend(files_df.loc[(files_df[sample_col] == row[prefix_col]) &
-                                      (files_df[lane_col] == lane) &
-                                      (files_df[read_col] == 'R2'),
-                                      file_col].values)
-
-        f_fps = sorted(f_fps)
-        r_fps = sorted(r_fps)
+    sample_reads_dict = {}
+    for s in sorted(sample_files):
+        f_fps = sorted(sample_files[s][0])
+        r_fps = sorted(sample_files[s][1])
 
         if f_fps != [] and r_fps != []:
           sample_reads_dict[s] = {
-              'forward': [os.path.join(seq_dir, x) for x in f_fps],
-              'reverse': [os.path.join(seq_dir, x) for x in r_fps]
+              'forward': _join_paths(seq_dir, f_fps),
+              'reverse': _join_paths(seq_dir, r_fps)
           }
 
     return(sample_reads_dict)
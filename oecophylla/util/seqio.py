@@ -0,0 +1,228 @@
+import re
+import sys
+import gzip
+import shutil
+import subprocess
+from contextlib import contextmanager
+
+
+BLOCK_SIZE = 2**22
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+_FASTA_HEADER = re.compile(rb'^>([^\n]*)', re.M)
+_SURROUNDING_SPACE = re.compile(rb'^[ \t\r\f\v]+|[ \t\r\f\v]+$', re.M)
+
+
+def _decompressor(threads=1):
+    """ Finds a command line tool to decompress gzip (and bgzip) files. """
+    pigz = shutil.which('pigz')
+    if pigz is not None:
+        return [pigz, '-dc', '-p', str(threads)]
+    gz = shutil.which('gzip')
+    if gz is not None:
+        return [gz, '-dc']
+    return None
+
+
+@contextmanager
+def open_input(fp, threads=1):
+    """ Opens a plain or gzip compressed file for reading in large blocks.
+
+    Parameters
+    ----------
+    fp : str
+       Path to the file.  gzip (and bgzip) files are recognized by their
+       magic bytes, not their extension.
+    threads : int, optional
+       Number of threads to decompress with, if pigz is available.
+
+    Yields
+    ------
+    binary file-like object
+       The (decompressed) content of the file.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+       If the decompressor fails.
+
+    Notes
+    -----
+    Compressed files are decompressed by a pigz (or gzip) subprocess, which
+    runs in parallel to the reading process, or by the gzip module if
+    neither is installed.
+    """
+    with open(fp, 'rb') as f:
+        magic = f.read(2)
+
+    if magic != GZIP_MAGIC:
+        with open(fp, 'rb', buffering=BLOCK_SIZE) as f:
+            yield f
+        return
+
+    cmd = _decompressor(threads)
+    if cmd is None:
+        with gzip.open(fp, 'rb') as f:
+            yield f
+        return
+
+    proc = subprocess.Popen(cmd + [fp], stdout=subprocess.PIPE,
+                            bufsize=BLOCK_SIZE)
+    try:
+        yield proc.stdout
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    # a decompressor cut short by a closed pipe is not an error
+    if returncode not in (0, -13):
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+@contextmanager
+def open_output(fp):
+    """ Opens a file for writing in large blocks.
+
+    Parameters
+    ----------
+    fp : str
+       Path to the file.
+
+    Yields
+    ------
+    binary file-like object
+       The file, buffered in blocks of `BLOCK_SIZE` bytes.
+    """
+    with open(fp, 'wb', buffering=BLOCK_SIZE) as f:
+        yield f
+
+
+def read_blocks(stream, size=BLOCK_SIZE):
+    """ Reads a binary stream in blocks of whole lines.
+
+    Parameters
+    ----------
+    stream : binary file-like object
+       Stream to read.
+    size : int, optional
+       Number of bytes to read at once.
+
+    Yields
+    ------
+    bytes
+       Blocks of about `size` bytes, ending with a line break (except for a
+       last line without line break).
+
+    Notes
+    -----
+    Reads of a line longer than `size` are collected, and joined once the
+    line break is found, so that long lines are not copied over and over.
+    """
+    parts = []
+    while True:
+        data = stream.read(size)
+        if not data:
+            break
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            parts.append(data)
+            continue
+        parts.append(data[:end])
+        yield b''.join(parts)
+        parts = [data[end:]]
+    rest = b''.join(parts)
+    if rest:
+        yield rest
+
+
+def fasta_headers(fp, threads=1):
+    """ Reads the headers of a (gzip compressed) FASTA file.
+
+    Parameters
+    ----------
+    fp : str
+       Path to the FASTA file.
+    threads : int, optional
+       Number of threads to decompress with.
+
+    Yields
+    ------
+    str
+       Headers without the leading '>' and surrounding whitespace.
+    """
+    with open_input(fp, threads) as f:
+        for block in read_blocks(f):
+            for header in _FASTA_HEADER.findall(block):
+                yield header.strip().decode()
+
+
+def simplify_headers(fasta_fp, prepend='sequence_', output_fp=None,
+                     header_fp=None, threads=1):
+    """ Replaces the headers of a FASTA file by numbered names.
+
+    Parameters
+    ----------
+    fasta_fp : str
+       Path to the (gzip compressed) input FASTA file.
+    prepend : str, optional
+       Text to prepend to the index of each sequence.
+    output_fp : str, optional
+       Path to write the simplified FASTA file to (default: stdout).
+    header_fp : str, optional
+       Path to write a table of new to old headers to.
+    threads : int, optional
+       Number of threads to decompress with.
+
+    Returns
+    -------
+    int
+       Number of sequences.
+
+    Notes
+    -----
+    The input is rewritten in blocks of lines, of which headers are replaced
+    and surrounding whitespace removed, and each written at once. Headers in
+    the table are only stripped of trailing whitespace, so that whitespace
+    following the '>' is kept.
+    """
+    prepend = prepend.encode()
+    count = [0]
+    headers = []
+
+    def _rename(match):
+        headers.append(b'%s%d\t%s\n' % (prepend, count[0],
+                                        match.group(1).rstrip()))
+        count[0] += 1
+        return b'>%s%d' % (prepend, count[0] - 1)
+
+    with open_input(fasta_fp, threads) as fa, \
+            _open_or_stdout(output_fp) as o_f, \
+            _open_or_none(header_fp) as h_f:
+        for block in read_blocks(fa):
+            block = _FASTA_HEADER.sub(_rename, block)
+            o_f.write(_SURROUNDING_SPACE.sub(b'', block))
+            if not block.endswith(b'\n'):
+                o_f.write(b'\n')
+            if h_f is not None:
+                h_f.write(b''.join(headers))
+            del headers[:]
+    return count[0]
+
+
+@contextmanager
+def _open_or_stdout(fp):
+    if fp is None:
+        yield sys.stdout.buffer
+        sys.stdout.flush()
+    else:
+        with open_output(fp) as f:
+            yield f
+
+
+@contextmanager
+def _open_or_none(fp):
+    if fp is None:
+        yield None
+    else:
+        with open_output(fp) as f:
+            yield f
@@ -0,0 +1,58 @@
+import os
+import unittest
+import tempfile
+
+from oecophylla.util.bins import bin_name, summarize_bins, read_bin_index
+
+
+class TestBins(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.bins = {'S1.001.fasta': ['contig_3', 'contig_1'],
+                     'S1.002.fasta': ['contig_2'],
+                     'S1.003.fasta': []}
+        self.bin_fps = []
+        for name, contigs in sorted(self.bins.items()):
+            fp = os.path.join(self.temp_dir.name, name)
+            with open(fp, 'w') as f:
+                for contig in contigs:
+                    f.write('>%s\nACGT\nACGT\n' % contig)
+            self.bin_fps.append(fp)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_bin_name(self):
+        self.assertEqual(bin_name('/some/dir/S1.001.fasta'), 'Bin_001')
+
+    def test_summarize_bins(self):
+        out = os.path.join(self.temp_dir.name, 'bins.txt')
+        index = os.path.join(self.temp_dir.name, 'bins.npz')
+        for threads in (1, 2):
+            obs = summarize_bins(self.bin_fps, out, index_fp=index,
+                                 threads=threads)
+            self.assertEqual(obs, 3)
+            with open(out, 'r') as f:
+                self.assertEqual(f.read(), 'contig_3\tBin_001\n'
+                                           'contig_1\tBin_001\n'
+                                           'contig_2\tBin_002\n')
+            bins = read_bin_index(index)
+            self.assertEqual(bins.to_dict(), {'contig_1': 'Bin_001',
+                                              'contig_2': 'Bin_002',
+                                              'contig_3': 'Bin_001'})
+            self.assertEqual(list(bins.index),
+                             ['contig_1', 'contig_2', 'contig_3'])
+            self.assertEqual(list(bins.cat.categories),
+                             ['Bin_001', 'Bin_002', 'Bin_003'])
+
+    def test_summarize_bins_empty(self):
+        out = os.path.join(self.temp_dir.name, 'bins.txt')
+        index = os.path.join(self.temp_dir.name, 'bins.npz')
+        self.assertEqual(summarize_bins([], out, index_fp=index), 0)
+        self.assertTrue(read_bin_index(index).empty)
+        self.assertEqual(os.path.getsize(out), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
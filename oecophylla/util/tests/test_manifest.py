@@ -0,0 +1,120 @@
+import os
+import unittest
+import tempfile
+from pathlib import Path
+
+from oecophylla.util.manifest import (MANIFEST_VERSION,
+                                      read_manifest,
+                                      write_manifest,
+                                      scan_input_dir,
+                                      get_sample_table,
+                                      set_sample_table)
+from oecophylla.util.parse import extract_sample_paths
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.seq_dir = os.path.join(self.temp_dir.name, 'reads')
+        os.mkdir(self.seq_dir)
+        self.fs = ['S22282_S102_L001_R1_001.fastq.gz',
+                   'S22282_S102_L001_R2_001.fastq.gz']
+        for f in self.fs:
+            Path(os.path.join(self.seq_dir, f)).touch()
+        self._age_dir()
+        self.manifest_fp = os.path.join(self.temp_dir.name, 'manifest.json')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _age_dir(self):
+        # pretend the directory was last modified a minute ago
+        st = os.stat(self.seq_dir)
+        os.utime(self.seq_dir, ns=(st.st_atime_ns,
+                                   st.st_mtime_ns - 60 * 10**9))
+
+    def test_read_manifest_missing(self):
+        empty = {'version': MANIFEST_VERSION, 'dirs': {}}
+        self.assertDictEqual(read_manifest(self.manifest_fp), empty)
+        with open(self.manifest_fp, 'w') as f:
+            f.write('not json')
+        self.assertDictEqual(read_manifest(self.manifest_fp), empty)
+
+        # a manifest of an older version is not used
+        write_manifest(self.manifest_fp,
+                       {'dirs': {self.seq_dir: {'stat': None, 'files': {}}}})
+        self.assertDictEqual(read_manifest(self.manifest_fp), empty)
+
+    def test_scan_input_dir(self):
+        manifest = read_manifest(self.manifest_fp)
+        fps, changed = scan_input_dir(self.seq_dir, manifest)
+        self.assertListEqual(fps, self.fs)
+        self.assertTrue(changed)
+
+        entry = manifest['dirs'][self.seq_dir]
+        st = os.stat(os.path.join(self.seq_dir, self.fs[0]))
+        self.assertListEqual(entry['files'][self.fs[0]],
+                             [st.st_size, st.st_mtime_ns, st.st_ino,
+                              st.st_dev])
+
+        write_manifest(self.manifest_fp, manifest)
+        manifest = read_manifest(self.manifest_fp)
+
+        # an unchanged directory is not listed again
+        entry['files']['cached_only.fastq.gz'] = [0, 0, 0, 0]
+        manifest['dirs'][self.seq_dir] = entry
+        fps, changed = scan_input_dir(self.seq_dir, manifest)
+        self.assertFalse(changed)
+        self.assertIn('cached_only.fastq.gz', fps)
+
+        # a new file changes the directory and refreshes the entry
+        Path(os.path.join(self.seq_dir,
+                          'S22205_S104_L001_R1_001.fastq.gz')).touch()
+        self._age_dir()
+        fps, changed = scan_input_dir(self.seq_dir, manifest)
+        self.assertTrue(changed)
+        self.assertListEqual(fps, ['S22205_S104_L001_R1_001.fastq.gz'] +
+                             self.fs)
+
+    def test_scan_input_dir_recent(self):
+        # a directory modified during the scan is re-read next time
+        Path(os.path.join(self.seq_dir, 'new.txt')).touch()
+        manifest = read_manifest(self.manifest_fp)
+        scan_input_dir(self.seq_dir, manifest)
+        self.assertIsNone(manifest['dirs'][self.seq_dir]['stat'])
+        set_sample_table(manifest, [self.seq_dir], {})
+        self.assertIsNone(get_sample_table(manifest, [self.seq_dir]))
+
+    def test_sample_table(self):
+        manifest = read_manifest(self.manifest_fp)
+        self.assertIsNone(get_sample_table(manifest, [self.seq_dir]))
+
+        table = extract_sample_paths(self.seq_dir, manifest)
+        self.assertDictEqual(table, {
+            'S22282': {
+                'forward': ['%s/%s' % (self.seq_dir, self.fs[0])],
+                'reverse': ['%s/%s' % (self.seq_dir, self.fs[1])]}})
+
+        set_sample_table(manifest, [self.seq_dir], table)
+        write_manifest(self.manifest_fp, manifest)
+
+        manifest = read_manifest(self.manifest_fp)
+        scan_input_dir(self.seq_dir, manifest)
+        self.assertDictEqual(get_sample_table(manifest, [self.seq_dir]),
+                             table)
+
+        # the cached table is tied to the sample sheet as well
+        sheet = os.path.join(self.temp_dir.name, 'sheet.csv')
+        Path(sheet).touch()
+        self.assertIsNone(get_sample_table(manifest, [self.seq_dir], sheet))
+
+        # and invalidated if the directory changes
+        os.remove(os.path.join(self.seq_dir, self.fs[1]))
+        self._age_dir()
+        scan_input_dir(self.seq_dir, manifest)
+        self.assertIsNone(get_sample_table(manifest, [self.seq_dir]))
+
+
+if __name__ == '__main__':
+    unittest.main()
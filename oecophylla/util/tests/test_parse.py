@@ -2,9 +2,12 @@ import os
 import unittest
 import pandas as pd
 import tempfile
+import shutil
 from pathlib import Path
 
-from oecophylla.util.parse import (illumina_filenames_to_df,
+from oecophylla.util.parse import (index_illumina_filenames,
+                                   illumina_filenames_to_df,
+                                   index_input_dirs,
                                    extract_sample_reads,
                                    extract_sample_paths,
                                    read_sample_sheet,
@@ -53,6 +56,37 @@ class TestParse(unittest.TestCase):
 
         pdt.assert_frame_equal(df, exp_df)
 
+    def test_index_illumina_filenames(self):
+        fnames = ['S22205_S104_L001_R1_001.fastq.gz',
+                  'README.txt',
+                  'S22205_S104_L001_R2_001.fastq.gz',
+                  'S22205_S104_L001_R3_001.fastq.gz']
+        df, unmatched = index_illumina_filenames(fnames)
+        exp_df = pd.DataFrame(
+            [['S22205_S104_L001_R1_001.fastq.gz', 'S22205', 'S104', 'L001',
+              'R1', '001', 'fastq.gz'],
+             ['S22205_S104_L001_R2_001.fastq.gz', 'S22205', 'S104', 'L001',
+              'R2', '001', 'fastq.gz']],
+            columns=['File', 'Sample', 'Index', 'Lane',
+                     'Read', 'Run', 'Extension'])
+        pdt.assert_frame_equal(df, exp_df)
+        self.assertListEqual(unmatched, ['README.txt',
+                                         'S22205_S104_L001_R3_001.fastq.gz'])
+
+        df, unmatched = index_illumina_filenames([])
+        self.assertListEqual(list(df.columns),
+                             ['File', 'Sample', 'Index', 'Lane',
+                              'Read', 'Run', 'Extension'])
+        self.assertEqual(len(df), 0)
+        self.assertListEqual(unmatched, [])
+
+    def test_illumina_filenames_to_df_unmatched(self):
+        with self.assertWarnsRegex(UserWarning, '1 file\\(s\\) did not match'):
+            df = illumina_filenames_to_df(['S22205_S104_L001_R1_001.fastq.gz',
+                                           'README.txt'])
+        self.assertListEqual(list(df['File']),
+                             ['S22205_S104_L001_R1_001.fastq.gz'])
+
     def test_extract_sample_reads(self):
         fnames =[
             'S22205_S104_L001_R1_001.fastq.gz',
@@ -139,6 +173,69 @@ class TestParse(unittest.TestCase):
 
         self.assertDictEqual(d, exp_d)
 
+    def test_extract_sample_paths_multiple_dirs(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            run1 = os.path.join(temp_dir, 'run1')
+            run2 = os.path.join(temp_dir, 'run2')
+            os.mkdir(run1)
+            os.mkdir(run2)
+            # S22205 was sequenced in both runs, S22282 only in the second
+            for i, d in enumerate((run1, run2)):
+                for r in ('R1', 'R2'):
+                    with open(os.path.join(
+                            d, 'S22205_S104_L001_%s_001.fastq.gz' % r),
+                            'w') as f:
+                        f.write('@read\n' * (i + 1))
+            for r in ('R1', 'R2'):
+                Path(os.path.join(
+                    run2, 'S22282_S102_L002_%s_001.fastq.gz' % r)).touch()
+            # files reached through links to the first and second run are
+            # only used once, but a copy of a file is used again
+            run3 = os.path.join(temp_dir, 'run3')
+            os.symlink(run1, run3)
+            run4 = os.path.join(temp_dir, 'run4')
+            os.mkdir(run4)
+            os.symlink(
+                os.path.join(run2, 'S22282_S102_L002_R1_001.fastq.gz'),
+                os.path.join(run4, 'S22282_S102_L002_R1_001.fastq.gz'))
+            shutil.copy(
+                os.path.join(run2, 'S22282_S102_L002_R2_001.fastq.gz'),
+                os.path.join(run4, 'S22282_S102_L003_R2_001.fastq.gz'))
+
+            files_df = index_input_dirs([run1, run2, run3, run4, run1])
+            self.assertEqual(len(files_df), 7)
+            self.assertListEqual(
+                sorted(files_df['Path']),
+                sorted(['%s/S22205_S104_L001_R1_001.fastq.gz' % run1,
+                        '%s/S22205_S104_L001_R2_001.fastq.gz' % run1,
+                        '%s/S22205_S104_L001_R1_001.fastq.gz' % run2,
+                        '%s/S22205_S104_L001_R2_001.fastq.gz' % run2,
+                        '%s/S22282_S102_L002_R1_001.fastq.gz' % run2,
+                        '%s/S22282_S102_L002_R2_001.fastq.gz' % run2,
+                        '%s/S22282_S102_L003_R2_001.fastq.gz' % run4]))
+
+            files_df = index_input_dirs([run1, run2, run3])
+            d = extract_sample_paths([run1, run2, run3], threads=2)
+            exp_d = {
+                'S22205': {
+                    'forward': ['%s/S22205_S104_L001_R1_001.fastq.gz' % run1,
+                                '%s/S22205_S104_L001_R1_001.fastq.gz' % run2],
+                    'reverse': ['%s/S22205_S104_L001_R2_001.fastq.gz' % run1,
+                                '%s/S22205_S104_L001_R2_001.fastq.gz' % run2]},
+                'S22282': {
+                    'forward': ['%s/S22282_S102_L002_R1_001.fastq.gz' % run2],
+                    'reverse': ['%s/S22282_S102_L002_R2_001.fastq.gz' % run2]}}
+            self.assertDictEqual(d, exp_d)
+
+            ss_df = pd.DataFrame(
+                [[1, 'S22205', 'sample_S22205'],
+                 [2, 'S22282', 'sample_S22282']],
+                columns=['Lane', 'Sample_ID', 'Description'])
+            sample_paths = extract_samples_from_sample_sheet(
+                ss_df, None, files_df=files_df, file_col='Path')
+            self.assertDictEqual(sample_paths, {
+                'sample_%s' % s: paths for s, paths in exp_d.items()})
+
     def test_read_sample_sheet(self):
         fname = 'example_sample_sheet.txt'
         curfile = os.path.abspath(
@@ -156,6 +253,7 @@ class TestParse(unittest.TestCase):
             columns=['Lane', 'Sample_ID', 'Sample_Name', 'Sample_Plate',
                    'Sample_Well', 'I7_Index_ID', 'Index', 'I5_Index_ID',
                    'Index2', 'Sample_Project', 'Description'])
+        exp_df['Lane'] = exp_df['Lane'].astype('Int64')
 
         pdt.assert_frame_equal(df, exp_df)
 
@@ -195,6 +293,47 @@ class TestParse(unittest.TestCase):
             self.assertDictEqual(sample_paths, exp_sample_paths)
 
 
+    def test_read_sample_sheet_dtypes(self):
+        sample_sheet = ('[Header]\n'
+                        'IEMFileVersion,4\n\n'
+                        '[Data]\n'
+                        'Lane,Sample_ID,Sample_Name,Index,Description\n'
+                        '1,10317,10317,ACCGACAA,sample_10317\n'
+                        '2,10317,10317,ACCGACAA,sample_10317\n'
+                        '\n'
+                        '[Extra]\n'
+                        'not,part,of,the,data\n')
+
+        with tempfile.NamedTemporaryFile() as ss_temp:
+            with open(ss_temp.name, 'w') as f:
+                f.write(sample_sheet)
+            df = read_sample_sheet(ss_temp.name)
+
+        exp_df = pd.DataFrame(
+            [[1, '10317', '10317', 'ACCGACAA', 'sample_10317'],
+             [2, '10317', '10317', 'ACCGACAA', 'sample_10317']],
+            columns=['Lane', 'Sample_ID', 'Sample_Name', 'Index',
+                     'Description'])
+        exp_df['Lane'] = exp_df['Lane'].astype('Int64')
+        pdt.assert_frame_equal(df, exp_df)
+
+        # integer lanes are matched to the lanes of file names
+        files_df = illumina_filenames_to_df(
+            ['10317_S1_L002_R1_001.fastq.gz', '10317_S1_L002_R2_001.fastq.gz'])
+        self.assertDictEqual(
+            extract_samples_from_sample_sheet(df, 'reads', files_df=files_df),
+            {'sample_10317': {
+                'forward': ['reads/10317_S1_L002_R1_001.fastq.gz'],
+                'reverse': ['reads/10317_S1_L002_R2_001.fastq.gz']}})
+
+        # a sample without lane can not be matched to its files
+        with tempfile.NamedTemporaryFile() as ss_temp:
+            with open(ss_temp.name, 'w') as f:
+                f.write(sample_sheet.replace('2,10317', ',10318'))
+            with self.assertRaisesRegex(ValueError,
+                                        'Samples without lane: 10318'):
+                read_sample_sheet(ss_temp.name)
+
     def test_read_sample_sheet_duplicates(self):
 
         bad_sample_sheet = ('[Header]\n'
@@ -257,6 +396,36 @@ class TestParse(unittest.TestCase):
         }
         self.assertDictEqual(sample_paths, exp_sample_paths)
 
+    def test_extract_samples_from_sample_sheet_many_lanes(self):
+        # 10k samples x 8 lanes, resolved against an in-memory file table
+        n_samples, n_lanes = 10000, 8
+        fnames = ['S%d_S%d_L%03d_R%d_001.fastq.gz' % (i, i + 1, lane, read)
+                  for i in range(n_samples)
+                  for lane in range(1, n_lanes + 1)
+                  for read in (1, 2)]
+        files_df = illumina_filenames_to_df(fnames)
+        ss_df = pd.DataFrame(
+            [[lane, 'S%d' % i, 'sample_S%d' % i]
+             for i in range(n_samples)
+             for lane in range(1, n_lanes + 1)],
+            columns=['Lane', 'Sample_ID', 'Description'])
+
+        sample_paths = extract_samples_from_sample_sheet(
+            ss_df, '/seqs', files_df=files_df)
+
+        self.assertEqual(len(sample_paths), n_samples)
+        self.assertDictEqual(
+            sample_paths['sample_S42'],
+            {'forward': ['/seqs/S42_S43_L%03d_R1_001.fastq.gz' % lane
+                         for lane in range(1, n_lanes + 1)],
+             'reverse': ['/seqs/S42_S43_L%03d_R2_001.fastq.gz' % lane
+                         for lane in range(1, n_lanes + 1)]})
+
+        # the per-sample view of the same files must agree
+        sample_reads = extract_sample_reads(files_df, '/seqs')
+        self.assertDictEqual(
+            sample_paths,
+            {'sample_%s' % s: paths for s, paths in sample_reads.items()})
 
 
 if __name__ == '__main__':
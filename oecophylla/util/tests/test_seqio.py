@@ -0,0 +1,112 @@
+import os
+import gzip
+import unittest
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+from oecophylla.util.seqio import (open_input,
+                                   read_blocks,
+                                   fasta_headers,
+                                   simplify_headers)
+
+
+FASTA = (b'>NODE_1_length_60_cov_2.5 extra\n'
+         b'ACGTACGTAC\n'
+         b'GTACGT  \r\n'
+         b'>NODE_2_length_20_cov_1.0\n'
+         b'TTTT\n'
+         b'>NODE_3\n'
+         b'GG')
+
+
+class TestSeqIO(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fa = os.path.join(self.temp_dir.name, 'contigs.fa')
+        with open(self.fa, 'wb') as f:
+            f.write(FASTA)
+        self.fa_gz = os.path.join(self.temp_dir.name, 'contigs.fa.gz')
+        with gzip.open(self.fa_gz, 'wb') as f:
+            f.write(FASTA)
+        self.headers = ['NODE_1_length_60_cov_2.5 extra',
+                        'NODE_2_length_20_cov_1.0', 'NODE_3']
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_open_input(self):
+        for fp in (self.fa, self.fa_gz):
+            with open_input(fp) as f:
+                self.assertEqual(f.read(), FASTA)
+
+        # without any decompressor tool installed
+        with mock.patch('shutil.which', return_value=None):
+            with open_input(self.fa_gz) as f:
+                self.assertEqual(f.read(), FASTA)
+
+    def test_read_blocks(self):
+        for size in (1, 7, 1000):
+            blocks = list(read_blocks(BytesIO(FASTA), size))
+            self.assertEqual(b''.join(blocks), FASTA)
+            for block in blocks[:-1]:
+                self.assertTrue(block.endswith(b'\n'))
+        self.assertEqual(list(read_blocks(BytesIO(b''))), [])
+
+        # a line spanning many reads
+        line = b'A' * 1000 + b'\n'
+        self.assertEqual(list(read_blocks(BytesIO(line * 2 + b'C'), 3)),
+                         [line, line, b'C'])
+
+    def test_fasta_headers(self):
+        self.assertEqual(list(fasta_headers(self.fa)), self.headers)
+        self.assertEqual(list(fasta_headers(self.fa_gz)), self.headers)
+
+    def test_simplify_headers(self):
+        out = os.path.join(self.temp_dir.name, 'simple.fa')
+        table = os.path.join(self.temp_dir.name, 'headers.txt')
+        obs = simplify_headers(self.fa_gz, prepend='S1_contig_',
+                               output_fp=out, header_fp=table)
+        self.assertEqual(obs, 3)
+        with open(out, 'rb') as f:
+            self.assertEqual(f.read(), b'>S1_contig_0\n'
+                                       b'ACGTACGTAC\n'
+                                       b'GTACGT\n'
+                                       b'>S1_contig_1\n'
+                                       b'TTTT\n'
+                                       b'>S1_contig_2\n'
+                                       b'GG\n')
+        with open(table, 'r') as f:
+            self.assertEqual(f.read().splitlines(),
+                             ['S1_contig_%d\t%s' % (i, h)
+                              for i, h in enumerate(self.headers)])
+
+    def test_simplify_headers_whitespace(self):
+        # the same output as the former simplify_fasta script, except for
+        # its repeated table lines, one per line rather than per sequence
+        with open(self.fa, 'wb') as f:
+            f.write(b'>  NODE_1 extra \r\n'
+                    b'  ACGT\t\n'
+                    b'\n'
+                    b'>NODE_2\n'
+                    b' \n'
+                    b'\tTT')
+        out = os.path.join(self.temp_dir.name, 'simple.fa')
+        table = os.path.join(self.temp_dir.name, 'headers.txt')
+        self.assertEqual(simplify_headers(self.fa, output_fp=out,
+                                          header_fp=table), 2)
+        with open(out, 'rb') as f:
+            self.assertEqual(f.read(), b'>sequence_0\n'
+                                       b'ACGT\n'
+                                       b'\n'
+                                       b'>sequence_1\n'
+                                       b'\n'
+                                       b'TT\n')
+        with open(table, 'rb') as f:
+            self.assertEqual(f.read(), b'sequence_0\t  NODE_1 extra\n'
+                                       b'sequence_1\tNODE_2\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+import os
+import time
+import resource
+import tracemalloc
+import multiprocessing
+
+import click
+import pandas as pd
+
+from oecophylla.util.parse import (illumina_filenames_to_df,
+                                   extract_sample_reads,
+                                   extract_samples_from_sample_sheet)
+
+"""
+This script times the resolution of sample sheet rows to sequence files, and
+measures its memory use, against the former code path, which built boolean
+masks over the whole file table for every sample sheet row.
+
+Both are given the same synthetic file table (SAMPLES samples with LANES
+lanes of R1 and R2 each), so that listing the directory is not part of the
+measurement. Each one runs in a fresh process, which reports its wall time,
+the growth of its peak RSS and the peak of memory allocated by Python
+during the call. The outputs of both are checked to be equal.
+
+The former code path grows with the square of the run size: it takes about a
+minute for 1k samples x 8 lanes, and hours for 10k samples x 8 lanes.
+
+Example usage:
+==============
+
+benchmark_sample_sheet.py --samples 500 --lanes 8
+
+benchmark_sample_sheet.py --samples 10000 --lanes 8 --skip-baseline
+"""
+
+
+def _baseline_sample_sheet(sample_sheet_df, seq_dir, files_df,
+                           name_col='Description', sample_col='Sample',
+                           lane_col='Lane', file_col='File', read_col='Read',
+                           prefix_col='Sample_ID'):
+    # extract_samples_from_sample_sheet before the grouped file index
+    sample_reads_dict = {}
+
+    for s, sample_rows in sample_sheet_df.groupby(name_col):
+
+        f_fps, r_fps = [], []
+
+        for idx, row in sample_rows.iterrows():
+            lane = 'L{0:03d}'.format(row[lane_col])
+            f_fps.extend(files_df.loc[(files_df[sample_col] == row[prefix_col]) &
+                                      (files_df[lane_col] == lane) &
+                                      (files_df[read_col] == 'R1'),
+                                      file_col].values)
+
+            r_fps.extend(files_df.loc[(files_df[sample_col] == row[prefix_col]) &
+                                      (files_df[lane_col] == lane) &
+                                      (files_df[read_col] == 'R2'),
+                                      file_col].values)
+
+        f_fps = sorted(f_fps)
+        r_fps = sorted(r_fps)
+
+        if f_fps != [] and r_fps != []:
+          sample_reads_dict[s] = {
+              'forward': [os.path.join(seq_dir, x) for x in f_fps],
+              'reverse': [os.path.join(seq_dir, x) for x in r_fps]
+          }
+
+    return(sample_reads_dict)
+
+
+def _baseline_sample_reads(df, seq_dir, sample_col='Sample', read_col='Read',
+                           file_col='File'):
+    # extract_sample_reads before the grouped file index
+    sample_reads_dict = {}
+
+    samples = list(df[sample_col].unique())
+
+    for s in samples:
+        fwd = df.loc[(df[sample_col] == s) & (df[read_col] == 'R1'), file_col]
+        rev = df.loc[(df[sample_col] == s) & (df[read_col] == 'R2'), file_col]
+        f_fps = sorted(list(fwd.values))
+        r_fps = sorted(list(rev.values))
+
+        sample_reads_dict[s] = {'forward': [os.path.join(seq_dir, x) for x in f_fps],
+                                'reverse': [os.path.join(seq_dir, x) for x in r_fps]}
+
+    return(sample_reads_dict)
+
+
+def _indexed_sample_sheet(sample_sheet_df, seq_dir, files_df):
+    return extract_samples_from_sample_sheet(sample_sheet_df, seq_dir,
+                                             files_df=files_df)
+
+
+def _indexed_sample_reads(sample_sheet_df, seq_dir, files_df):
+    return extract_sample_reads(files_df, seq_dir)
+
+
+def _baseline_reads(sample_sheet_df, seq_dir, files_df):
+    return _baseline_sample_reads(files_df, seq_dir)
+
+
+def synthetic_run(n_samples, n_lanes):
+    """ Builds a file table and a sample sheet of a sequencing run.
+
+    Parameters
+    ----------
+    n_samples : int
+       Number of samples.
+    n_lanes : int
+       Number of lanes every sample was sequenced on.
+
+    Returns
+    -------
+    tuple of pd.DataFrame
+       Sample sheet and file table of the run.
+    """
+    fnames = ['S%d_S%d_L%03d_R%d_001.fastq.gz' % (i, i + 1, lane, read)
+              for i in range(n_samples)
+              for lane in range(1, n_lanes + 1)
+              for read in (1, 2)]
+    files_df = illumina_filenames_to_df(fnames)
+    sample_sheet_df = pd.DataFrame(
+        [[lane, 'S%d' % i, 'sample_S%d' % i]
+         for i in range(n_samples)
+         for lane in range(1, n_lanes + 1)],
+        columns=['Lane', 'Sample_ID', 'Description'])
+    sample_sheet_df['Lane'] = sample_sheet_df['Lane'].astype('Int64')
+    return sample_sheet_df, files_df
+
+
+def _peak_rss():
+    # Linux reports kilobytes
+    return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(func, args, trace, queue):
+    rss = _peak_rss()
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    allocated = tracemalloc.get_traced_memory()[1] if trace else None
+    tracemalloc.stop()
+    queue.put((seconds, _peak_rss() - rss, allocated,
+               sorted(result.items())))
+
+
+def _run(func, args, trace):
+    # fork, so that the arguments are not copied through a pipe
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_measure, args=(func, args, trace, queue))
+    proc.start()
+    measured = queue.get()
+    proc.join()
+    return measured
+
+
+def measure(func, *args):
+    """ Runs a function in fresh processes and measures its resources.
+
+    Parameters
+    ----------
+    func : callable
+       Function to call with `args`, returning a dict.
+    args
+       Arguments of `func`.
+
+    Returns
+    -------
+    tuple of (float, int, int, list)
+       Wall time in seconds, growth of the peak RSS in bytes, peak of
+       memory allocated by Python in bytes and the sorted items of the
+       result.
+
+    Notes
+    -----
+    Tracing allocations slows Python down several times, so the wall time
+    and RSS are taken from one run, and the allocations from another.
+    """
+    seconds, rss, _, result = _run(func, args, False)
+    allocated = _run(func, args, True)[2]
+    return seconds, rss, allocated, result
+
+
+@click.command()
+@click.option('--samples', '-n', type=click.INT, default=500,
+              show_default=True, help='Number of samples in the run.')
+@click.option('--lanes', '-l', type=click.INT, default=8,
+              show_default=True, help='Number of lanes per sample.')
+@click.option('--skip-baseline', is_flag=True, default=False,
+              help='Only measure the current code path.')
+def benchmark(samples, lanes, skip_baseline):
+    sample_sheet_df, files_df = synthetic_run(samples, lanes)
+    click.echo('%d samples x %d lanes, %d files' % (samples, lanes,
+                                                   len(files_df)))
+    cases = [('sample sheet', _indexed_sample_sheet, _baseline_sample_sheet),
+             ('sample reads', _indexed_sample_reads, _baseline_reads)]
+    for name, indexed, baseline in cases:
+        funcs = [('indexed', indexed)]
+        if not skip_baseline:
+            funcs.append(('baseline', baseline))
+        results = []
+        for label, func in funcs:
+            seconds, rss, allocated, result = measure(
+                func, sample_sheet_df, '/seqs', files_df)
+            results.append(result)
+            click.echo('%-12s %-8s %10.3f s %10.1f MB peak RSS growth '
+                       '%10.1f MB allocated' % (name, label, seconds,
+                                               rss / 2**20,
+                                               allocated / 2**20))
+        if len(results) == 2 and results[0] != results[1]:
+            raise click.ClickException('%s: outputs differ' % name)
+
+
+if __name__ == '__main__':
+    benchmark()